@@ -350,8 +350,78 @@ def parse(text):
         
     return res
 
+class ParsedText(object):
+    """The result of parse_cached(): a parsed description list, plus the
+    structure of its conditionals worked out in advance.
+
+    The nodes field is a tuple of strings and InterpNodes, as parse()
+    would return. These are shared between every caller, so nobody should
+    modify them.
+
+    The jumps field is a tuple of the same length. For If, ElIf, and Else
+    nodes, the entry is (nextbranch, end): the position of the next ElIf,
+    Else, or End of the same conditional, and the position of its End.
+    (If the conditional is never closed, these are len(nodes).) A matched
+    End node has (pos, pos). Other nodes, including ElIf/Else/End nodes
+    with no matching $if, have None.
+
+    The unterminated field is true if any $if lacks an $end.
+    """
+    def __init__(self, text, nodes):
+        self.size = len(text)
+        self.nodes = tuple(nodes)
+        self.unterminated = False
+        
+        count = len(self.nodes)
+        jumps = [ None ] * count
+        # Stack of open conditionals. Each is a list of the positions
+        # of its If, ElIf, and Else nodes.
+        stack = []
+        for (pos, nod) in enumerate(self.nodes):
+            if not isinstance(nod, InterpNode):
+                continue
+            nodkey = nod.classname
+            if nodkey == 'If':
+                stack.append([pos])
+            elif nodkey in ('ElIf', 'Else'):
+                if stack:
+                    stack[-1].append(pos)
+            elif nodkey == 'End':
+                if stack:
+                    branches = stack.pop()
+                    branches.append(pos)
+                    for ix in range(len(branches)-1):
+                        jumps[branches[ix]] = (branches[ix+1], pos)
+                    jumps[pos] = (pos, pos)
+        if stack:
+            self.unterminated = True
+            for branches in stack:
+                branches.append(count)
+                for ix in range(len(branches)-1):
+                    jumps[branches[ix]] = (branches[ix+1], count)
+        self.jumps = tuple(jumps)
+
+    def __repr__(self):
+        return '<ParsedText %r>' % (self.nodes,)
+
+def parse_cached(text):
+    """Parse a string into a ParsedText. This is parse() plus the
+    conditional structure, and the results are cached (see parse_cache),
+    since the same descriptions get rendered over and over.
+    Raises ValueError if the text is malformed; that is not cached.
+    """
+    res = parse_cache.get(text)
+    if res is None:
+        res = ParsedText(text, parse(text))
+        parse_cache.put(text, res)
+    return res
+
 
 # Late imports
-from twcommon.misc import sluggify
+from twcommon.misc import sluggify, LRUCache
+
+# Parse results for parse_cached(). This is bounded by the total length
+# of the cached source text, not the number of entries.
+parse_cache = LRUCache(4000000, sizefunc=lambda parsed: parsed.size)
 
 
@@ -1,6 +1,7 @@
 import datetime
 import re
 import unicodedata
+import collections
 
 # The maximum length of an editable description, such as a player desc
 # or editstr line.
@@ -15,6 +16,71 @@ class SuiGeneris(object):
     def __repr__(self):
         return '<%s>' % (self.name,)
 
+class LRUCache(object):
+    """A bounded map which discards its least-recently-used entries when
+    it fills up. We use these for parse results (script code, interpolated
+    text, and so on), which are keyed by their source text.
+
+    The limit counts entries, unless a sizefunc is supplied; then it
+    counts the sum of sizefunc(val) over all entries.
+
+    The hits and misses fields count get() results, so that we can see
+    whether the cache is earning its keep.
+    """
+    def __init__(self, limit, sizefunc=None):
+        self.limit = limit
+        self.sizefunc = sizefunc
+        self.map = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return '<LRUCache %d entries, size %d/%d; %d hits, %d misses>' % (len(self.map), self.size, self.limit, self.hits, self.misses)
+
+    def __len__(self):
+        return len(self.map)
+
+    def get(self, key, default=None):
+        """Look up a key. A hit makes the entry most-recently-used.
+        """
+        tup = self.map.get(key, None)
+        if tup is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.map.move_to_end(key)
+        return tup[0]
+
+    def put(self, key, val):
+        """Add an entry, discarding old ones if we go over the limit.
+        (An entry larger than the whole limit is not stored at all.)
+        """
+        if key in self.map:
+            self.discard(key)
+        if self.sizefunc:
+            size = self.sizefunc(val)
+        else:
+            size = 1
+        if size > self.limit:
+            return
+        self.map[key] = (val, size)
+        self.size += size
+        while self.size > self.limit:
+            (oldkey, (oldval, oldsize)) = self.map.popitem(last=False)
+            self.size -= oldsize
+
+    def discard(self, key):
+        """Remove an entry, if present.
+        """
+        tup = self.map.pop(key, None)
+        if tup is not None:
+            self.size -= tup[1]
+
+    def clear(self):
+        self.map.clear()
+        self.size = 0
+
 def gen_bool_parse(val):
     """Convert a string, as a human might type it, to a boolean. Unrecognized
     values raise an exception.
@@ -192,6 +258,31 @@ class TestMiscModule(unittest.TestCase):
         for (val, res) in tests:
             self.assertEqual(sluggify(val), res)
 
+    def test_lrucache(self):
+        cache = LRUCache(3)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.put('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('d', 4)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+        cache.discard('a')
+        self.assertEqual(cache.get('a', 'none'), 'none')
+
+        cache = LRUCache(10, sizefunc=len)
+        cache.put('x', 'xxxx')
+        cache.put('y', 'yyyy')
+        cache.put('z', 'zzzz')
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(cache.get('x'), None)
+        cache.put('w', 'w'*11)
+        self.assertEqual(cache.get('w'), None)
+        self.assertEqual(cache.get('z'), 'zzzz')
+
 
 if __name__ == '__main__':
     unittest.main()
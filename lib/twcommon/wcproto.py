@@ -7,15 +7,82 @@ The protocol between tweb and tworld is brutally simple:
 - Message content (length bytes)
 
 The length and connid are little-endian integers.
-The content is always JSON, UTF-8, and starts and ends with "{}".
+
+In protocol version 1, the content is always JSON, UTF-8, and starts and
+ends with "{}".
+
+Version 2 is negotiated at connect time: tweb's "connect" message offers
+a "protocol" number, and tworld's "connectok" reply says which version
+it accepted. (Both of those messages are version 1; the new version takes
+effect for every message after them.) In version 2, server messages --
+the ones with connid zero -- are BSON documents, which are cheaper to
+encode and decode and carry ObjectIds natively. Player messages are still
+JSON, because they are going to or coming from a browser, which wants
+JSON anyway; tweb passes them through without decoding them.
+
+Run this module ("python3 -m twcommon.wcproto") to benchmark the two
+encodings.
 """
 
 import types
 import struct
 import json
+import zlib
+
+import bson
+from bson.objectid import ObjectId
 
 HEADER_LENGTH = 8  # two four-byte fields
 
+PROTOCOL_JSON = 1
+PROTOCOL_BSON = 2
+PROTOCOL_LATEST = PROTOCOL_BSON
+
+# Several twebs can share one tworld, so player connection IDs are
+# partitioned among them. Each tweb has a node number (0 to MAX_NODE),
+# which goes in the top eight bits of its connids; the low bits count up
+# from 1. (So connids are never zero, and a lone tweb with node 0 uses
+# the same connids it always did.)
+CONNID_COUNTER_BITS = 24
+CONNID_COUNTER_MAX = (1 << CONNID_COUNTER_BITS) - 1
+MAX_NODE = 255
+
+def make_connid(node, counter):
+    """Construct a connection ID from a tweb node number and a counter
+    value (1 to CONNID_COUNTER_MAX).
+    """
+    if not (0 <= node <= MAX_NODE):
+        raise ValueError('tweb node number out of range: %s' % (node,))
+    return (node << CONNID_COUNTER_BITS) | counter
+
+def connid_node(connid):
+    """Return the tweb node number that a connection ID belongs to.
+    """
+    return connid >> CONNID_COUNTER_BITS
+
+# Tworld may be split into several shard processes (the tworld_shards
+# option), each running its own share of the instances. These functions
+# decide who owns what, so tweb and every shard must agree on them.
+
+def instance_shard(wid, scid, shardcount):
+    """Return the tworld shard which runs the instance of world wid in
+    scope scid. (This depends only on the world and scope, so we know
+    where an instance belongs before it has been created.) With a single
+    tworld, this is always zero.
+    """
+    if shardcount <= 1:
+        return 0
+    return zlib.crc32(wid.binary + scid.binary) % shardcount
+
+def home_shard(uid, shardcount):
+    """Return the tworld shard which a player's connections go to first.
+    If the player turns out to be somewhere else, that shard hands them
+    off to the right one.
+    """
+    if shardcount <= 1:
+        return 0
+    return zlib.crc32(uid.binary) % shardcount
+
 def namespace_wrapper(map):
     """
     Convert a dict to a SimpleNamespace. If you feed in {'key':'val'},
@@ -25,6 +92,27 @@ def namespace_wrapper(map):
     """
     return types.SimpleNamespace(**map)
 
+def namespace_tree(obj):
+    """
+    Convert every dict in a freshly-decoded structure to a SimpleNamespace,
+    the way namespace_wrapper does when it's used as a JSON object_hook.
+    (The dicts and lists are modified in place.)
+    """
+    typ = type(obj)
+    if typ is dict:
+        for (key, val) in obj.items():
+            if type(val) in _container_types:
+                obj[key] = namespace_tree(val)
+        return types.SimpleNamespace(**obj)
+    if typ is list:
+        for (ix, val) in enumerate(obj):
+            if type(val) in _container_types:
+                obj[ix] = namespace_tree(val)
+        return obj
+    return obj
+
+_container_types = frozenset([dict, list])
+
 def check_buffer(buf, namespace=False):
     """
     Given a mutable bytearray, see if it begins with a complete message.
@@ -39,6 +127,11 @@ def check_buffer(buf, namespace=False):
 
     If the content fails to parse, this throws an exception, but the
     message will still be sliced out of the buffer.
+
+    This only handles version 1 (JSON) messages, and slicing the front
+    of the buffer costs time in proportion to the buffer size. The
+    MessageReader class is a better choice when a lot of messages
+    arrive at once.
     """
     
     if len(buf) < HEADER_LENGTH:
@@ -62,14 +155,194 @@ def check_buffer(buf, namespace=False):
         raise ValueError('Message was not an object')
     return (connid, msgdat, msgobj)
 
-def message(connid, obj, alreadyjson=False):
+def decode_content(connid, dat, version=PROTOCOL_JSON, namespace=False):
+    """
+    Decode the content of a message (as bytes) into a dict, or a
+    SimpleNamespace if namespace is true. This throws an exception if
+    the content is malformed or is not an object.
+    """
+    if version >= PROTOCOL_BSON and not connid:
+        msgobj = bson.BSON(dat).decode()
+        if namespace:
+            msgobj = namespace_tree(msgobj)
+        return msgobj
+    
+    object_hook = namespace_wrapper if namespace else None
+
+    msgstr = dat.decode()  # Decode UTF-8
+    msgobj = json.loads(msgstr, object_hook=object_hook)  # Decode JSON
+    if (type(msgobj) not in [dict, types.SimpleNamespace]):
+        raise ValueError('Message was not an object')
+    return msgobj
+
+class MessageReader(object):
+    """
+    Accumulates data from a stream and pulls complete messages out of it.
+
+    The reader keeps an offset to the first unread message, rather than
+    slicing each message off the front of the buffer as check_buffer()
+    does. The consumed part of the buffer is discarded in feed(), and
+    only once it's at least half the buffer; so a big burst of messages
+    costs time in proportion to its size, not its size squared.
+
+    The version field is the protocol version to decode with. Change it
+    after the connect handshake.
+    """
+    
+    def __init__(self, version=PROTOCOL_JSON, namespace=False):
+        self.version = version
+        self.namespace = namespace
+        self.buf = bytearray()
+        self.pos = 0  # offset of the first unread byte
+
+    def __len__(self):
+        """The number of unread bytes.
+        """
+        return len(self.buf) - self.pos
+
+    def feed(self, dat):
+        """Add newly-arrived data to the buffer.
+        """
+        if self.pos:
+            if self.pos >= len(self.buf):
+                del self.buf[:]
+                self.pos = 0
+            elif self.pos*2 >= len(self.buf):
+                del self.buf[:self.pos]
+                self.pos = 0
+        self.buf.extend(dat)
+
+    def read(self):
+        """
+        If a complete message is available, return (connid, content) and
+        move past it. (The content is bytes, still encoded.) Otherwise
+        return None.
+        """
+        pos = self.pos
+        if len(self.buf) - pos < HEADER_LENGTH:
+            return None
+        (datlen, connid) = struct.unpack_from('<2I', self.buf, pos)
+        start = pos + HEADER_LENGTH
+        end = start + datlen
+        if len(self.buf) < end:
+            return None
+        with memoryview(self.buf) as view:
+            dat = bytes(view[start:end])
+        self.pos = end
+        return (connid, dat)
+
+    def check(self):
+        """
+        Like check_buffer(): if a complete message is available, return
+        (connid, content, decoded). If the content fails to parse, this
+        throws an exception, but the reader still moves past the message.
+        """
+        tup = self.read()
+        if not tup:
+            return None
+        (connid, dat) = tup
+        msgobj = decode_content(connid, dat, version=self.version, namespace=self.namespace)
+        return (connid, dat, msgobj)
+
+def json_default(obj):
+    """
+    JSON encoder hook: in version 1, ObjectIds are sent as strings.
+    (The receiver has to know which fields to convert back.)
+    """
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError('%r is not JSON serializable' % (obj,))
+
+def message(connid, obj, alreadyjson=False, version=PROTOCOL_JSON):
+    """
+    Encode a message. The obj may be a dict, or (if alreadyjson is true)
+    a JSON string, or bytes of UTF-8 JSON.
+    """
+    if version >= PROTOCOL_BSON and not connid:
+        if type(obj) is bytes:
+            obj = json.loads(obj.decode())
+        elif alreadyjson:
+            obj = json.loads(obj)
+        msgdat = bson.BSON.encode(obj)
+        head = struct.pack('<2I', len(msgdat), connid)
+        return head + msgdat
+    
     if type(obj) is bytes:
         msgdat = obj
     else:
         if alreadyjson:
             msgstr = obj
         else:
-            msgstr = json.dumps(obj)
+            msgstr = json.dumps(obj, default=json_default)
         msgdat = msgstr.encode()  # Encode UTF-8
     head = struct.pack('<2I', len(msgdat), connid)
     return head + msgdat
+
+
+def benchmark(count=5000):
+    """
+    Time the JSON and BSON encodings on a realistic update message (sent
+    as if it were a server message, so that version 2 really uses BSON).
+    We encode count messages, concatenate them into a single burst, and
+    then read them back through a MessageReader. For JSON, we also time
+    splitting the burst without decoding (as tweb does for player
+    messages) and the old check_buffer() loop.
+    """
+    import time
+    from bson.objectid import ObjectId
+
+    desc = [
+        'You are standing in a ', ['link', 'room'], 'small stone room',
+        ['/link'], '. Light filters in through a ', ['style', 'emph'],
+        'narrow', ['/style'], ' window. ', ['para'],
+        'A passage leads ', ['exit', ObjectId()], 'north', ['/exit'], '.',
+        ] * 3
+    update = {
+        'cmd': 'update',
+        'world': {'world':'The Meadow', 'scope':'Personal instance', 'creator':'Zarf'},
+        'locale': {'name':'Stone Room', 'desc':desc},
+        'populace': ['Alice', ' and ', 'Bob', ' are here.'],
+        'focus': False,
+        'insttool': False,
+        'iid': ObjectId(),
+        'locid': ObjectId(),
+        }
+    # Version 1 has to send the ObjectIds as strings.
+    jsonupdate = json.loads(json.dumps(update, default=json_default))
+
+    for (label, version, obj) in [
+            ('json', PROTOCOL_JSON, jsonupdate),
+            ('bson', PROTOCOL_BSON, update) ]:
+        start = time.perf_counter()
+        burst = b''.join([ message(0, obj, version=version) for ix in range(count) ])
+        encodetime = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        reader = MessageReader(version=version, namespace=True)
+        reader.feed(burst)
+        while reader.check():
+            pass
+        readtime = time.perf_counter() - start
+        
+        print('%s: %d messages of %d bytes: encode %.1f us/msg, read %.1f us/msg' % (label, count, len(burst)//count, 1000000*encodetime/count, 1000000*readtime/count))
+        
+        if version == PROTOCOL_JSON:
+            # This is what tweb does with player messages: split them
+            # out without decoding them.
+            start = time.perf_counter()
+            reader = MessageReader(version=version)
+            reader.feed(burst)
+            while reader.read():
+                pass
+            passtime = time.perf_counter() - start
+            print('%s: read without decoding %.1f us/msg' % (label, 1000000*passtime/count))
+            
+            start = time.perf_counter()
+            buf = bytearray(burst)
+            while check_buffer(buf, namespace=True):
+                pass
+            slicetime = time.perf_counter() - start
+            print('%s: check_buffer read %.1f us/msg' % (label, 1000000*slicetime/count))
+
+if __name__ == '__main__':
+    benchmark()
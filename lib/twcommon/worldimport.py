@@ -0,0 +1,312 @@
+"""
+Bulk import of world data: locations, realm properties, location
+properties, and all-player properties.
+
+The import is worked out in two stages. First, plan_import() compares
+the incoming world (an ImportWorld) against what's in the database, and
+returns an ImportPlan listing only the changes. Then the plan is broken
+into ImportSteps: batches of database operations, which the caller runs
+however it talks to the database. (twloadworld uses pymongo directly;
+the build page's import handler goes through Motor.) So this module never
+touches the database itself.
+
+An ImportWorld can be read from a world export file (read_export()) or
+built up by hand, as twloadworld does with its parse_world() output.
+
+Portlists are not imported; neither are the worlds' settings (name,
+copyable, instancing).
+"""
+
+import re
+import collections
+
+import bson
+from bson.objectid import ObjectId
+
+import twcommon.misc
+from twcommon.misc import sluggify
+
+# How many documents go into one batched insert or remove (and how many
+# updates go into one step).
+BATCH_SIZE = 500
+
+# Valid property keys; see also re_valididentifier in bhandlers.py.
+re_valididentifier = re.compile('^[a-zA-Z_][a-zA-Z0-9_]*$')
+
+class ImportWorld(object):
+    """The world data to be imported. Each property map goes from key to
+    value, where the value is in database form.
+
+    The locations map goes from location key to an ImportLocation, in
+    the order they were added.
+    """
+    def __init__(self, name=None):
+        self.name = name
+        self.realmprops = collections.OrderedDict()
+        self.playerprops = collections.OrderedDict()
+        self.locations = collections.OrderedDict()
+        # Problems which don't stop the import.
+        self.warnings = []
+
+    def add_location(self, key, name=None):
+        """Add a location (with no properties yet) and return it. If the
+        key is already present, return the existing one.
+        """
+        loc = self.locations.get(key, None)
+        if loc is None:
+            loc = ImportLocation(key, name)
+            self.locations[key] = loc
+        return loc
+
+    def propcount(self):
+        return (len(self.realmprops) + len(self.playerprops)
+                + sum([ len(loc.props) for loc in self.locations.values() ]))
+
+    def check(self):
+        """Check the data for problems that would make a mess of the
+        database: bad keys, and values that can't be stored. Returns a
+        list of error strings (empty if all is well).
+        """
+        errors = []
+        def check_props(label, props):
+            for (key, val) in props.items():
+                if not re_valididentifier.match(key):
+                    errors.append('Invalid property key in %s: %s' % (label, key))
+                    continue
+                try:
+                    bson.BSON.encode({'val':val}, check_keys=True)
+                except Exception as ex:
+                    errors.append('Property %s in %s cannot be stored: %s' % (key, label, ex))
+        check_props('realm', self.realmprops)
+        check_props('$player', self.playerprops)
+        for (lockey, loc) in self.locations.items():
+            if not lockey or lockey != sluggify(lockey):
+                errors.append('Invalid location key: %s' % (lockey,))
+                continue
+            check_props(lockey, loc.props)
+        return errors
+
+class ImportLocation(object):
+    def __init__(self, key, name=None):
+        self.key = key
+        self.name = name if name is not None else key
+        self.props = collections.OrderedDict()
+    def __repr__(self):
+        return '<ImportLocation %s: "%s">' % (self.key, self.name)
+
+def import_value(val):
+    """Convert a property value from a world export back to database
+    form. The exporter writes datetimes as {type:'datetime'} objects, so
+    we convert those back. (ObjectIds were exported as plain strings, so
+    they stay that way.)
+    """
+    if type(val) is dict:
+        if val.get('type', None) == 'datetime' and len(val) == 2 and 'value' in val:
+            return twcommon.misc.gen_datetime_parse(val['value'])
+        return { key:import_value(subval) for (key, subval) in val.items() }
+    if type(val) is list:
+        return [ import_value(subval) for subval in val ]
+    return val
+
+def read_export(obj):
+    """Convert a decoded world export file into an ImportWorld. Raises
+    ValueError if it doesn't look like an export.
+    """
+    if type(obj) is not dict or 'locations' not in obj:
+        raise ValueError('This is not a world export file.')
+    world = ImportWorld(obj.get('name', None))
+
+    def read_props(label, ls, props):
+        for prop in ls:
+            key = prop.get('key', None)
+            if key is None or 'val' not in prop:
+                raise ValueError('Property without key or value in %s' % (label,))
+            if key in props:
+                world.warnings.append('Property %s appears twice in %s; using the later one' % (key, label))
+            props[key] = import_value(prop['val'])
+
+    read_props('realm', obj.get('realmprops', []), world.realmprops)
+    read_props('$player', obj.get('playerprops', []), world.playerprops)
+    for locobj in obj['locations']:
+        lockey = locobj.get('key', None)
+        if not lockey:
+            raise ValueError('Location without a key')
+        if lockey in world.locations:
+            world.warnings.append('Location %s appears twice; merging' % (lockey,))
+        loc = world.add_location(lockey, locobj.get('name', None))
+        read_props(lockey, locobj.get('props', []), loc.props)
+    if obj.get('portlists', None):
+        world.warnings.append('Portlists are not imported.')
+    return world
+
+class ImportStep(object):
+    """One batch of database work. The ops field is a list of
+    (collection, method, args) tuples, to be performed in order as
+    db[collection].method(*args). The label describes the step, for
+    progress reports.
+    """
+    def __init__(self, label, ops):
+        self.label = label
+        self.ops = ops
+    def __repr__(self):
+        return '<ImportStep "%s" (%d ops)>' % (self.label, len(self.ops))
+
+class ImportPlan(object):
+    """The changes needed to make the database match an ImportWorld.
+    See plan_import().
+
+    For each property collection ('worldprop' and 'wplayerprop'), there
+    are lists of documents to insert, (_id, val) pairs to update, and
+    _ids to remove. The changes list holds the dependency keys of every
+    property touched, so that tworld can be told about them.
+    """
+    def __init__(self, wid):
+        self.wid = wid
+        self.newlocs = []
+        self.renamelocs = []
+        self.inserts = { 'worldprop':[], 'wplayerprop':[] }
+        self.updates = { 'worldprop':[], 'wplayerprop':[] }
+        self.removes = { 'worldprop':[], 'wplayerprop':[] }
+        self.trash = []
+        self.unchanged = 0
+        # Database locations not in the import. (These are never deleted.)
+        self.extralocs = []
+        self.changes = []
+
+    def is_empty(self):
+        return not (self.newlocs or self.renamelocs
+                    or any(self.inserts.values()) or any(self.updates.values())
+                    or any(self.removes.values()))
+
+    def summary(self):
+        """A one-line description of the plan.
+        """
+        counts = [ sum([ len(ls) for ls in map.values() ])
+                   for map in (self.inserts, self.updates, self.removes) ]
+        return '%d new locations, %d renamed; %d properties added, %d changed, %d removed, %d unchanged' % (len(self.newlocs), len(self.renamelocs), counts[0], counts[1], counts[2], self.unchanged)
+
+    def steps(self, batchsize=BATCH_SIZE):
+        """Break the plan into ImportSteps. Locations come first, since
+        the new properties may refer to them.
+        """
+        def batches(ls):
+            for pos in range(0, len(ls), batchsize):
+                yield ls[pos:pos+batchsize]
+
+        total = len(self.newlocs)
+        done = 0
+        for batch in batches(self.newlocs):
+            done += len(batch)
+            yield ImportStep('Created locations (%d/%d)' % (done, total),
+                             [ ('locations', 'insert', (batch,)) ])
+        if self.renamelocs:
+            ops = [ ('locations', 'update', ({'_id':locid}, {'$set':{'name':name}}))
+                    for (locid, name) in self.renamelocs ]
+            yield ImportStep('Renamed %d locations' % (len(ops),), ops)
+
+        total = len(self.trash)
+        done = 0
+        for batch in batches(self.trash):
+            done += len(batch)
+            yield ImportStep('Saved old values to the trash (%d/%d)' % (done, total),
+                             [ ('trashprop', 'insert', (batch,)) ])
+
+        for coll in ('worldprop', 'wplayerprop'):
+            label = 'realm and location' if coll == 'worldprop' else 'player'
+            ls = self.removes[coll]
+            total = len(ls)
+            done = 0
+            for batch in batches(ls):
+                done += len(batch)
+                yield ImportStep('Removed %s properties (%d/%d)' % (label, done, total),
+                                 [ (coll, 'remove', ({'_id':{'$in':batch}},)) ])
+            ls = self.updates[coll]
+            total = len(ls)
+            done = 0
+            for batch in batches(ls):
+                done += len(batch)
+                ops = [ (coll, 'update', ({'_id':propid}, {'$set':{'val':val}}))
+                        for (propid, val) in batch ]
+                yield ImportStep('Changed %s properties (%d/%d)' % (label, done, total), ops)
+            ls = self.inserts[coll]
+            total = len(ls)
+            done = 0
+            for batch in batches(ls):
+                done += len(batch)
+                yield ImportStep('Added %s properties (%d/%d)' % (label, done, total),
+                                 [ (coll, 'insert', (batch,)) ])
+
+def plan_import(world, wid, dblocs, dbprops, dbplayerprops, prune=False, trash=False):
+    """Work out what has to change to make world wid's database entries
+    match the ImportWorld. The dblocs, dbprops, and dbplayerprops
+    arguments are the world's current locations, worldprop entries, and
+    all-player wplayerprop entries (uid None), as lists of documents.
+
+    Properties are matched by location and key. Existing ones are only
+    updated if their values differ. If prune is true, properties which
+    aren't in the import are removed. (Locations are never removed; the
+    plan lists the extras.) If trash is true, the old values of changed
+    and removed properties are saved to the trashprop collection, as the
+    build page does for single edits.
+
+    New locations are given their ObjectIds here, so that the plan can
+    refer to them before they exist.
+    """
+    plan = ImportPlan(wid)
+    now = twcommon.misc.now()
+
+    locids = {}
+    dblocmap = { loc['key']:loc for loc in dblocs }
+    for (lockey, loc) in world.locations.items():
+        dbloc = dblocmap.get(lockey, None)
+        if dbloc is None:
+            locid = ObjectId()
+            plan.newlocs.append({ '_id':locid, 'wid':wid, 'key':lockey, 'name':loc.name })
+        else:
+            locid = dbloc['_id']
+            if dbloc.get('name', None) != loc.name:
+                plan.renamelocs.append( (locid, loc.name) )
+        locids[lockey] = locid
+    plan.extralocs = [ lockey for lockey in dblocmap if lockey not in world.locations ]
+
+    # The import's properties, keyed by (locid, key).
+    wanted = collections.OrderedDict()
+    for (key, val) in world.realmprops.items():
+        wanted[(None, key)] = val
+    for (lockey, loc) in world.locations.items():
+        for (key, val) in loc.props.items():
+            wanted[(locids[lockey], key)] = val
+    wantedplayer = collections.OrderedDict()
+    for (key, val) in world.playerprops.items():
+        wantedplayer[(None, key)] = val
+
+    for (coll, wantmap, dbls, locfield) in (
+            ('worldprop', wanted, dbprops, 'locid'),
+            ('wplayerprop', wantedplayer, dbplayerprops, 'uid')):
+        seen = set()
+        for prop in dbls:
+            tup = (prop.get(locfield, None), prop['key'])
+            seen.add(tup)
+            if tup in wantmap:
+                val = wantmap[tup]
+                if val == prop.get('val', None):
+                    plan.unchanged += 1
+                    continue
+                plan.updates[coll].append( (prop['_id'], val) )
+            elif prune:
+                plan.removes[coll].append(prop['_id'])
+            else:
+                continue
+            plan.changes.append( (coll, wid, tup[0], tup[1]) )
+            if trash:
+                trashprop = { 'wid':wid, locfield:tup[0], 'key':tup[1],
+                              'val':prop.get('val', None),
+                              'origtype':coll, 'changed':now }
+                plan.trash.append(trashprop)
+        for (tup, val) in wantmap.items():
+            if tup in seen:
+                continue
+            plan.inserts[coll].append({ 'wid':wid, locfield:tup[0], 'key':tup[1], 'val':val })
+            plan.changes.append( (coll, wid, tup[0], tup[1]) )
+
+    return plan
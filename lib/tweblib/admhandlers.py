@@ -46,6 +46,7 @@ class AdminMainHandler(AdminBaseHandler):
                     uptime=uptime,
                     mongoavailable=(self.application.mongodb is not None),
                     tworldavailable=(self.application.twservermgr.tworldavailable),
+                    sessioncache=self.application.twsessionmgr.cache_stats(),
                     conntable=self.application.twconntable.as_dict())
 
     @tornado.gen.coroutine
@@ -63,6 +64,21 @@ class AdminMainHandler(AdminBaseHandler):
             self.application.twservermgr.tworld_write(0, msg)
             self.redirect('/admin')
             return
+        if (self.get_argument('cachestats', None)):
+            msg = { 'cmd':'logcachestats' }
+            self.application.twservermgr.tworld_write(0, msg)
+            self.redirect('/admin')
+            return
+        if (self.get_argument('clearpropcache', None)):
+            msg = { 'cmd':'clearpropcache' }
+            self.application.twservermgr.tworld_write(0, msg)
+            self.redirect('/admin')
+            return
+        if (self.get_argument('clearsessioncache', None)):
+            self.application.twsessionmgr.cache.clear()
+            self.application.twlog.warning('Admin command: cleared session cache.')
+            self.redirect('/admin')
+            return
         if (self.get_argument('clearcaches', None)):
             def func(self):
                 # This code is snarfed from Tornado's web.py. May break
@@ -198,6 +214,9 @@ class AdminPlayerHandler(AdminBaseHandler):
         if (self.get_argument('playerkillconn', None)):
             connid = int(self.get_argument('connid'))
             conn = self.application.twconntable.find(connid)
+            # Make the player's next page load or reconnect check the
+            # database, rather than trusting any tweb's session cache.
+            self.application.twsessionmgr.broadcast_invalidation(conn.sessionid)
             conn.close('Connection closed by administrator.')
             self.redirect(self.request.path)
             return
@@ -7,6 +7,7 @@ import random
 import json
 import ast
 import re
+import zlib
 import collections
 
 from bson.objectid import ObjectId
@@ -20,6 +21,7 @@ import tweblib.handlers
 import twcommon.misc
 import twcommon.interp
 import twcommon.gentext
+import twcommon.worldimport
 from twcommon.misc import sluggify
 
 # Utility class for JSON-encoding objects that contain ObjectIds.
@@ -826,8 +828,7 @@ class BuildSetPropHandler(BuildBaseHandler):
 
                 # Send dependency key to tworld
                 try:
-                    encoder = JSONEncoderExtra()
-                    depmsg = encoder.encode({ 'cmd':'notifydatachange', 'change':dependency })
+                    depmsg = { 'cmd':'notifydatachange', 'change':dependency }
                     self.application.twservermgr.tworld_write(0, depmsg)
                 except Exception as ex:
                     self.application.twlog.warning('Unable to notify tworld of data change: %s', ex)
@@ -874,11 +875,10 @@ class BuildSetPropHandler(BuildBaseHandler):
             # Send dependency key to tworld. (Two of them, if we changed the
             # property key!)
             try:
-                encoder = JSONEncoderExtra()
-                depmsg = encoder.encode({ 'cmd':'notifydatachange', 'change':dependency })
+                depmsg = { 'cmd':'notifydatachange', 'change':dependency }
                 self.application.twservermgr.tworld_write(0, depmsg)
                 if dependency2:
-                    depmsg = encoder.encode({ 'cmd':'notifydatachange', 'change':dependency2 })
+                    depmsg = { 'cmd':'notifydatachange', 'change':dependency2 }
                     self.application.twservermgr.tworld_write(0, depmsg)
             except Exception as ex:
                 self.application.twlog.warning('Unable to notify tworld of data change: %s', ex)
@@ -935,8 +935,7 @@ class BuildAddPropHandler(BuildBaseHandler):
             # be holding a dependency on a brand-new key. But we'll be
             # paranoid.
             try:
-                encoder = JSONEncoderExtra()
-                depmsg = encoder.encode({ 'cmd':'notifydatachange', 'change':dependency })
+                depmsg = { 'cmd':'notifydatachange', 'change':dependency }
                 self.application.twservermgr.tworld_write(0, depmsg)
             except Exception as ex:
                 self.application.twlog.warning('Unable to notify tworld of data change: %s', ex)
@@ -1022,8 +1021,7 @@ class BuildDelPortListHandler(BuildBaseHandler):
 
             try:
                 dependency = ('portlist', plistid, None)
-                encoder = JSONEncoderExtra()
-                depmsg = encoder.encode({ 'cmd':'notifydatachange', 'change':dependency })
+                depmsg = { 'cmd':'notifydatachange', 'change':dependency }
                 self.application.twservermgr.tworld_write(0, depmsg)
             except Exception as ex:
                 self.application.twlog.warning('Unable to notify tworld of data change: %s', ex)
@@ -1083,8 +1081,7 @@ class BuildAddPortHandler(BuildBaseHandler):
             
             try:
                 dependency = ('portlist', plistid, None)
-                encoder = JSONEncoderExtra()
-                depmsg = encoder.encode({ 'cmd':'notifydatachange', 'change':dependency })
+                depmsg = { 'cmd':'notifydatachange', 'change':dependency }
                 self.application.twservermgr.tworld_write(0, depmsg)
             except Exception as ex:
                 self.application.twlog.warning('Unable to notify tworld of data change: %s', ex)
@@ -1405,8 +1402,8 @@ class BuildSetDataHandler(BuildBaseHandler):
                     raise Exception('No location declared')
                 uid = self.twsession['uid']
                 # The server will have to figure out scope.
-                msg = { 'cmd':'buildcopyportal', 'uid':str(uid), 'locid':str(locid), 'wid':str(wid) }
-                self.application.twservermgr.tworld_write(0, msg)
+                msg = { 'cmd':'buildcopyportal', 'uid':uid, 'locid':locid, 'wid':wid }
+                self.application.twservermgr.tworld_write_player(uid, msg)
                 # Any failure in this request will not be returned to the
                 # client. Oh well.
                 self.write( { 'ok':True } )
@@ -1468,10 +1465,28 @@ class BuildDelLocHandler(BuildBaseHandler):
             ### Have not tested how this affects portals that link to the
             ### location. Or people in the location!
 
+            # Note which properties are in this location, so that we can
+            # tell tworld about them.
+            propkeys = []
+            cursor = self.application.mongodb.worldprop.find({'wid':wid, 'locid':locid}, {'key':1})
+            while (yield cursor.fetch_next):
+                prop = cursor.next_object()
+                propkeys.append(prop['key'])
+            # cursor autoclose
+
             # First delete all world properties in this location.
             yield motor.Op(self.application.mongodb.worldprop.remove,
                            { 'wid':wid, 'locid':locid })
 
+            # Send dependency keys to tworld
+            try:
+                for key in propkeys:
+                    dependency = ('worldprop', wid, locid, key)
+                    depmsg = { 'cmd':'notifydatachange', 'change':dependency }
+                    self.application.twservermgr.tworld_write(0, depmsg)
+            except Exception as ex:
+                self.application.twlog.warning('Unable to notify tworld of data change: %s', ex)
+
             ### And also instance properties?
 
             # Then the location itself.
@@ -1506,18 +1521,29 @@ class BuildAddWorldHandler(BuildBaseHandler):
             self.write( { 'error': str(ex) } )
 
 class BuildExportWorldHandler(BuildBaseHandler):
+    """Download a world as a JSON file. (With the gzip=1 query argument,
+    a gzipped JSON file.)
+
+    A world can have many thousands of properties, so we stream them
+    out rather than building the whole file in memory. Each section
+    (realmprops, a location's props, and so on) comes from a cursor
+    sorted on an indexed field, and is encoded one document at a time.
+    Whenever FLUSH_SIZE bytes have piled up, we flush them to the network
+    (with chunked transfer encoding), which also lets the ioloop get on
+    with other work.
+    """
+
+    FLUSH_SIZE = 65536
+    
     @tornado.gen.coroutine
     def get(self, wid):
         wid = ObjectId(wid)
         (world, locations) = yield self.find_build_world(wid)
         
-        # The handling of this export stuff is a nuisance. I don't want
-        # to load the entire world data set into memory. But the json
-        # module isn't set up for yieldy output.
-        #
-        # Therefore, evil hackery! We make assumptions about the formatting
-        # of json.dump output, and stick in stuff iteratively. This requires
-        # care with commas, because the format of JSON is annoying.
+        # The json module isn't set up for yieldy output. Therefore, evil
+        # hackery! We make assumptions about the formatting of json.dump
+        # output, and stick in stuff iteratively. This requires care with
+        # commas, because the format of JSON is annoying.
 
         rootobj = collections.OrderedDict()
         rootobj['name'] =  world.get('name', '???')
@@ -1540,76 +1566,58 @@ class BuildExportWorldHandler(BuildBaseHandler):
         assert rootdump.endswith('\n}')
         rootdumphead, rootdumptail = rootdump[0:-2], rootdump[-2:]
         slugname = sluggify(rootobj['name'])
-        
-        self.set_header("Content-Type", "application/json; charset=UTF-8")
-        self.set_header("Content-Disposition", "attachment; filename=%s.json" % (slugname,))
-        self.write(rootdumphead)
+
+        self.exportpending = 0
+        self.exportgzip = None
+        if self.get_argument('gzip', None):
+            # wbits=31 means a gzip header and trailer.
+            self.exportgzip = zlib.compressobj(9, zlib.DEFLATED, 31)
+            self.set_header("Content-Type", "application/gzip")
+            self.set_header("Content-Disposition", "attachment; filename=%s.json.gz" % (slugname,))
+        else:
+            self.set_header("Content-Type", "application/json; charset=UTF-8")
+            self.set_header("Content-Disposition", "attachment; filename=%s.json" % (slugname,))
+        self.export_write(rootdumphead)
         
         encoder = JSONEncoderExtra(indent=True, sort_keys=True, ensure_ascii=False)
 
-        portlists = []
-        cursor = self.application.mongodb.portlists.find({'wid':wid, 'type':'world'})
+        # Portlists are short, so each one is encoded whole.
+        count = 0
+        cursor = self.application.mongodb.portlists.find({'wid':wid, 'type':'world'},
+                                                         sort=[('_id', 1)])
         while (yield cursor.fetch_next):
             plist = cursor.next_object()
-            portlists.append(plist)
-        # cursor autoclose
-        if portlists:
-            portlists.sort(key=lambda plist:plist['_id']) ### or other criterion?
-            for plist in portlists:
-                ls = []
-                cursor = self.application.mongodb.portals.find({'plistid':plist['_id'], 'iid':None})
-                while (yield cursor.fetch_next):
-                    port = cursor.next_object()
-                    ls.append(port)
-                # cursor autoclose
-                ls.sort(key=lambda port:port.get('listpos', 0.0))
-                for port in ls:
-                    ### The locid, scid, wid values are not actually good for anything
-                    del port['_id']
-                    del port['iid']
-                    del port['plistid']  # always gonna be this list
-                del plist['_id']
-                del plist['wid']  # always gonna be this world
-                plist['portals'] = ls
-                
-            res = encoder.encode(portlists)
-            self.write(',\n "portlists": ')
-            self.write(res)
-
-        worldprops = []
-        cursor = self.application.mongodb.worldprop.find({'wid':wid, 'locid':None}, {'key':1, 'val':1})
-        while (yield cursor.fetch_next):
-            prop = cursor.next_object()
-            worldprops.append(prop)
-        # cursor autoclose
-
-        if worldprops:
-            worldprops.sort(key=lambda prop:prop['_id']) ### or other criterion?
-            for prop in worldprops:
-                del prop['_id']
-
-            res = encoder.encode(worldprops)
-            self.write(',\n "realmprops": ')
-            self.write(res)
-
-        playerprops = []
-        cursor = self.application.mongodb.wplayerprop.find({'wid':wid, 'uid':None}, {'key':1, 'val':1})
-        while (yield cursor.fetch_next):
-            prop = cursor.next_object()
-            playerprops.append(prop)
+            ls = []
+            portcursor = self.application.mongodb.portals.find({'plistid':plist['_id'], 'iid':None},
+                                                               sort=[('listpos', 1)])
+            while (yield portcursor.fetch_next):
+                port = portcursor.next_object()
+                ### The locid, scid, wid values are not actually good for anything
+                del port['_id']
+                del port['iid']
+                del port['plistid']  # always gonna be this list
+                ls.append(port)
+            # cursor autoclose
+            del plist['_id']
+            del plist['wid']  # always gonna be this world
+            plist['portals'] = ls
+            if self.export_list_item(encoder, ',\n "portlists": ', count, plist):
+                yield tornado.gen.Task(self.flush)
+            count += 1
         # cursor autoclose
+        self.export_list_end(count)
 
-        if playerprops:
-            playerprops.sort(key=lambda prop:prop['_id']) ### or other criterion?
+        # Properties are sorted by key, which the worldprop and wplayerprop
+        # indexes provide.
+        cursor = self.application.mongodb.worldprop.find({'wid':wid, 'locid':None}, {'key':1, 'val':1},
+                                                         sort=[('key', 1)])
+        yield self.export_prop_cursor(encoder, ',\n "realmprops": ', cursor)
 
-            for prop in playerprops:
-                del prop['_id']
+        cursor = self.application.mongodb.wplayerprop.find({'wid':wid, 'uid':None}, {'key':1, 'val':1},
+                                                           sort=[('key', 1)])
+        yield self.export_prop_cursor(encoder, ',\n "playerprops": ', cursor)
 
-            res = encoder.encode(playerprops)
-            self.write(',\n "playerprops": ')
-            self.write(res)
-
-        self.write(',\n "locations": [\n')
+        self.export_write(',\n "locations": [\n')
         
         for ix, loc in enumerate(locations):
             locobj = collections.OrderedDict()
@@ -1620,33 +1628,167 @@ class BuildExportWorldHandler(BuildBaseHandler):
             assert locdump.endswith('\n}')
             locdumphead, locdumptail = locdump[0:-2], locdump[-2:]
 
-            self.write(locdumphead)
-
-            locprops = []
-            cursor = self.application.mongodb.worldprop.find({'wid':wid, 'locid':loc['_id']}, {'key':1, 'val':1})
-            while (yield cursor.fetch_next):
-                prop = cursor.next_object()
-                locprops.append(prop)
-            # cursor autoclose
+            self.export_write(locdumphead)
 
-            if locprops:
-                locprops.sort(key=lambda prop:prop['_id']) ### or other criterion?
-                
-                for prop in locprops:
-                    del prop['_id']
-
-                res = encoder.encode(locprops)
-                self.write(',\n "props": ')
-                self.write(res)
+            cursor = self.application.mongodb.worldprop.find({'wid':wid, 'locid':loc['_id']}, {'key':1, 'val':1},
+                                                             sort=[('key', 1)])
+            yield self.export_prop_cursor(encoder, ',\n "props": ', cursor)
             
-            self.write(locdumptail)
+            self.export_write(locdumptail)
             if ix < len(locations)-1:
-                self.write(',\n')
+                self.export_write(',\n')
             else:
-                self.write('\n')
+                self.export_write('\n')
             
-        self.write(' ]')
+        self.export_write(' ]')
+
+        self.export_write(rootdumptail)
+        self.export_write('\n')
+        if self.exportgzip:
+            self.write(self.exportgzip.flush())
+            self.exportgzip = None
 
-        self.write(rootdumptail)
-        self.write('\n')
+    def export_write(self, val):
+        """Add a string to the output (compressing it, if we're doing
+        that).
+        """
+        dat = val.encode()
+        self.exportpending += len(dat)
+        if self.exportgzip:
+            dat = self.exportgzip.compress(dat)
+        if dat:
+            self.write(dat)
+
+    def export_list_item(self, encoder, label, index, obj):
+        """Write one entry of a JSON list, formatted as if the whole list
+        had been encoded at once. The label (the key and colon) and the
+        open bracket are written before the first entry; export_list_end()
+        closes it off. (So an empty list doesn't appear at all.)
+
+        Returns True if it's time to flush; the caller should then yield
+        on flush().
+        """
+        # Encoding a one-entry list gives us the right indentation. Then
+        # we strip off the "[\n" and "\n]".
+        res = encoder.encode([obj])[2:-2]
+        if index == 0:
+            self.export_write(label)
+            self.export_write('[\n')
+        else:
+            self.export_write(',\n')
+        self.export_write(res)
+        if self.exportpending >= self.FLUSH_SIZE:
+            self.exportpending = 0
+            return True
+        return False
+
+    def export_list_end(self, count):
+        """Close off a list begun by export_list_item(), if there were any
+        entries.
+        """
+        if count:
+            self.export_write('\n]')
+
+    @tornado.gen.coroutine
+    def export_prop_cursor(self, encoder, label, cursor):
+        """Write out the properties from a cursor as a JSON list (if
+        there are any).
+        """
+        count = 0
+        while (yield cursor.fetch_next):
+            prop = cursor.next_object()
+            del prop['_id']
+            if self.export_list_item(encoder, label, count, prop):
+                yield tornado.gen.Task(self.flush)
+            count += 1
+        # cursor autoclose
+        self.export_list_end(count)
         
+
+class BuildImportWorldHandler(BuildBaseHandler):
+    """Upload a world file (as produced by BuildExportWorldHandler,
+    optionally gzipped) and load it into an existing world.
+
+    The file is compared against the world's current contents, and only
+    the differences are written, in batches. (See twcommon.worldimport.)
+    Old values of changed properties go to the trash, as with single
+    edits. With the prune=1 argument, properties which are not in the
+    file are removed as well. Locations are never removed.
+
+    The response is a plain-text progress report, flushed after each
+    batch.
+    """
+
+    # How many dependency keys go into one notifydatachange message.
+    NOTIFY_BATCH = 1000
+
+    @tornado.gen.coroutine
+    def post(self, wid):
+        wid = ObjectId(wid)
+        (dbworld, dblocs) = yield self.find_build_world(wid)
+
+        self.set_header("Content-Type", "text/plain; charset=UTF-8")
+
+        try:
+            files = self.request.files.get('worldfile', None)
+            if not files:
+                raise Exception('No file uploaded.')
+            dat = files[0]['body']
+            if dat[0:2] == b'\x1f\x8b':
+                # wbits=47 means accept a gzip header.
+                dat = zlib.decompress(dat, 47)
+            world = twcommon.worldimport.read_export(json.loads(dat.decode()))
+            errors = world.check()
+            if errors:
+                raise Exception('\n'.join(errors))
+        except Exception as ex:
+            self.application.twlog.warning('Caught exception (importing world): %s', ex)
+            self.write('Unable to import world: %s\n' % (ex,))
+            return
+
+        for warning in world.warnings:
+            self.write('Warning: %s\n' % (warning,))
+        
+        dbprops = []
+        cursor = self.application.mongodb.worldprop.find({'wid':wid})
+        while (yield cursor.fetch_next):
+            dbprops.append(cursor.next_object())
+        # cursor autoclose
+        dbplayerprops = []
+        cursor = self.application.mongodb.wplayerprop.find({'wid':wid, 'uid':None})
+        while (yield cursor.fetch_next):
+            dbplayerprops.append(cursor.next_object())
+        # cursor autoclose
+
+        plan = twcommon.worldimport.plan_import(
+            world, wid, dblocs, dbprops, dbplayerprops,
+            prune=bool(self.get_argument('prune', None)), trash=True)
+        
+        if plan.is_empty():
+            self.write('Nothing to change.\n')
+        try:
+            for step in plan.steps():
+                for (collection, method, opargs) in step.ops:
+                    yield motor.Op(getattr(self.application.mongodb[collection], method), *opargs)
+                self.write(step.label + '\n')
+                yield tornado.gen.Task(self.flush)
+        except Exception as ex:
+            # Whatever got written is still there; tworld still has to
+            # hear about it, below.
+            self.application.twlog.warning('Caught exception (importing world): %s', ex)
+            self.write('Import failed: %s\n' % (ex,))
+
+        # Send dependency keys to tworld
+        try:
+            changes = plan.changes
+            for pos in range(0, len(changes), self.NOTIFY_BATCH):
+                depmsg = { 'cmd':'notifydatachange',
+                           'changes':changes[pos:pos+self.NOTIFY_BATCH] }
+                self.application.twservermgr.tworld_write(0, depmsg)
+        except Exception as ex:
+            self.application.twlog.warning('Unable to notify tworld of data change: %s', ex)
+
+        self.application.twlog.info('Player %s imported world %s: %s', self.twsession['email'], wid, plan.summary())
+        self.write(plan.summary() + '\n')
+        for lockey in plan.extralocs:
+            self.write('Location is in the world but not the file: %s\n' % (lockey,))
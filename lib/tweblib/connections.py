@@ -8,14 +8,25 @@ to the table. We use simple incrementing integers for the ID. There's no
 need to track across tweb sessions, because if tweb crashes, we lose all
 the websockets anyway...)
 
+If several twebs share a tworld, each one must have a different
+tweb_node option. The node number goes in the top bits of the connection
+ID (see twcommon.wcproto.make_connid), so the twebs never hand out the
+same ID.
+
 A Connection is "available" once it has been sent to the tworld (and we
 got an ack back). If tworld crashes, all connections become unavailable
 until it returns (and then we have to ack them again).
+
+If tworld is sharded, each Connection belongs to one shard at a time. It
+starts on the player's home shard (see twcommon.wcproto.home_shard), and
+is reopened on another shard whenever tworld says the player has moved
+there. While that's happening, it's unavailable.
 """
 
 import datetime
 
 import twcommon.misc
+from twcommon import wcproto
 import tweblib.handlers
 
 class ConnectionTable(object):
@@ -24,13 +35,24 @@ class ConnectionTable(object):
         self.app = app
         self.table = {}
         self.counter = 1
+        self.node = app.twopts.tweb_node
+        if not (0 <= self.node <= wcproto.MAX_NODE):
+            raise Exception('tweb_node must be between 0 and %d' % (wcproto.MAX_NODE,))
 
-    def generate_connid(self):
-        """Pull out another connection ID to use.
+    def generate_connid(self, node=None):
+        """Pull out another connection ID to use. The node is this tweb's
+        node number; it defaults to the tweb_node option.
         """
-        res = self.counter
-        self.counter += 1
-        return res
+        if node is None:
+            node = self.node
+        while True:
+            res = wcproto.make_connid(node, self.counter)
+            self.counter += 1
+            if self.counter > wcproto.CONNID_COUNTER_MAX:
+                self.counter = 1
+            # If the counter has wrapped around, skip IDs still in use.
+            if res not in self.table:
+                return res
 
     def all(self):
         """A (non-dynamic) list of all player connections.
@@ -60,7 +82,8 @@ class ConnectionTable(object):
         assert handler.twconnid, 'handler.twconnid is not positive'
         conn = Connection(handler, uid, email, session['sid'],
                           refreshtime=session['refreshtime'],
-                          guest=session.get('guest', False))
+                          guest=session.get('guest', False),
+                          shard=wcproto.home_shard(uid, self.app.twopts.tworld_shards))
         self.table[conn.connid] = conn
         return conn
 
@@ -92,7 +115,7 @@ class Connection(object):
     """
     
     def __init__(self, handler, uid, email, sessionid,
-                 refreshtime, guest=False):
+                 refreshtime, guest=False, shard=0):
         self.handler = handler
         self.connid = handler.twconnid
         self.uid = uid
@@ -103,6 +126,7 @@ class Connection(object):
         self.lastmsgtime = self.starttime    # last user activity
         self.sessiontime = refreshtime       # last session refresh
         self.available = False
+        self.shard = shard  # the tworld shard that has this connection
 
     def __repr__(self):
         return '<Connection %d>' % (self.connid,)
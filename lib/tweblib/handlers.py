@@ -679,7 +679,7 @@ class PortLinkHandler(MyRequestHandler):
         uid = self.twsession['uid']
         msg = { 'cmd':'externalcopyportal', 'uid':str(uid),
                 'portid':str(portid), 'focus':True }
-        self.application.twservermgr.tworld_write(0, msg)
+        self.application.twservermgr.tworld_write_player(uid, msg)
 
         # Check whether the player has an active web session.
         ls = self.application.twconntable.for_uid(uid)
@@ -844,7 +844,7 @@ class PlayHandler(MyRequestHandler):
                 uid = self.twsession['uid']
                 msg = { 'cmd':'externalcopyportal', 'uid':str(uid),
                         'portid':str(portid), 'focus':True }
-                self.application.twservermgr.tworld_write(0, msg)
+                self.application.twservermgr.tworld_write_player(uid, msg)
             except Exception as ex:
                 self.application.twlog.info('Unable to load portlink info for play: %s', ex)
         
@@ -943,7 +943,7 @@ class PlayWebSocketHandler(MyHandlerMixin, tornado.websocket.WebSocketHandler):
 
         self.twconn.lastmsgtime = twcommon.misc.now()
 
-        if not self.application.twservermgr.tworldavailable:
+        if not self.application.twservermgr.shard_available(self.twconn.shard):
             self.application.twlog.warning('Tworld is not available.')
             self.write_tw_error('Tworld service is not available.')
             return
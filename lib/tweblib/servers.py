@@ -1,8 +1,14 @@
 """
 Manage the connections to the MongoDB server and the Tworld server.
+
+Tworld may be split into several shard processes (the tworld_shards
+option). We keep a link to each one. Every player connection belongs to
+one shard at a time -- the one that runs the player's current instance
+-- and tworld tells us when a player moves to another shard.
 """
 
 import socket
+import functools
 
 import tornado.gen
 import tornado.ioloop
@@ -10,10 +16,40 @@ import tornado.iostream
 import tornado.platform
 
 import motor
+from bson.objectid import ObjectId
 
 import twcommon.localize
 from twcommon import wcproto
 
+class TworldLink(object):
+    """The connection to one tworld shard. (If tworld isn't sharded,
+    there's just the one.)
+    """
+    def __init__(self, shard):
+        self.shard = shard
+        self.stream = None
+        self.available = False  # true if self.stream exists and is ready
+        self.timerbusy = False
+        # Reader for this shard's message data, and the protocol version
+        # we're using. (The version is negotiated at connect time.)
+        self.reader = None
+        self.version = wcproto.PROTOCOL_JSON
+
+    def __repr__(self):
+        return '<TworldLink %d>' % (self.shard,)
+
+    def write(self, connid, msg):
+        """Write a message (a dict, or a string of JSON) to this shard.
+        May raise exceptions.
+        """
+        if not self.available:
+            raise Exception('Tworld service is not available.')
+        if type(msg) is dict:
+            val = wcproto.message(connid, msg, version=self.version)
+        else:
+            val = wcproto.message(connid, msg, alreadyjson=True, version=self.version)
+        self.stream.write(val)
+
 class ServerMgr(object):
     def __init__(self, app):
         # Keep a link to the owning application.
@@ -29,13 +65,24 @@ class ServerMgr(object):
         # We also manage self.app.mongodb, a MotorDatabase. This must be
         # non-None exactly when mongoavailable is true.
 
-        # This will be the Tworld connection. Handled by monitor_tworld_status.
-        self.tworld = None
-        self.tworldavailable = False  # true if self.tworld exists and is ready
-        self.tworldtimerbusy = False
+        # These will be the Tworld connections, one per shard. Handled
+        # by monitor_tworld_status.
+        self.tworldshards = max(1, self.app.twopts.tworld_shards)
+        self.tworldlinks = [ TworldLink(shard) for shard in range(self.tworldshards) ]
 
-        # Buffer for Tworld message data.
-        self.twbuffer = None
+    @property
+    def tworldavailable(self):
+        """True if every tworld shard is connected and ready.
+        """
+        for link in self.tworldlinks:
+            if not link.available:
+                return False
+        return True
+
+    def shard_available(self, shard):
+        """True if the given tworld shard is connected and ready.
+        """
+        return self.tworldlinks[shard].available
 
     def init_timers(self):
         """Start the ioloop timers for this module.
@@ -53,16 +100,34 @@ class ServerMgr(object):
         res = tornado.ioloop.PeriodicCallback(self.monitor_tworld_status, 5000)
         res.start()
 
-    def tworld_write(self, connid, msg):
+    def tworld_write(self, connid, msg, shard=None):
         """Shortcut for writing to the tworld process. May raise exceptions.
+
+        A player message goes to the shard which has the player's
+        connection. A server message (connid 0) goes to every shard,
+        unless a shard is given.
         """
+        if shard is None and connid:
+            shard = self.app.twconntable.find(connid).shard
+        if shard is not None:
+            self.tworldlinks[shard].write(connid, msg)
+            return
         if not self.tworldavailable:
             raise Exception('Tworld service is not available.')
-        if type(msg) is dict:
-            val = wcproto.message(connid, msg)
+        for link in self.tworldlinks:
+            link.write(connid, msg)
+
+    def tworld_write_player(self, uid, msg):
+        """Write a server message which concerns a particular player (uid)
+        to one shard. We pick the shard which has the player's connection,
+        or their home shard if they're not connected. May raise exceptions.
+        """
+        ls = self.app.twconntable.for_uid(uid)
+        if ls:
+            shard = ls[0].shard
         else:
-            val = wcproto.message(connid, msg, alreadyjson=True)
-        self.tworld.write(val)
+            shard = wcproto.home_shard(uid, self.tworldshards)
+        self.tworld_write(0, msg, shard=shard)
 
     def mongo_disconnect(self):
         """Close the connection to mongodb. (The monitor will start it
@@ -140,115 +205,150 @@ class ServerMgr(object):
             
 
     def monitor_tworld_status(self):
-        """Check the status of the Tworld connection. If the socket is
+        """Check the status of the Tworld connections. If a socket is
         closed (or has never been opened), try to open it.
 
         This is called once when the app launches, to open the initial
-        connection, and every few seconds thereafter.
+        connections, and every few seconds thereafter.
+        """
+        for link in self.tworldlinks:
+            self.monitor_tworld_link(link)
+
+    def monitor_tworld_link(self, link):
+        """Check the status of one Tworld shard's connection, and open it
+        if necessary.
 
-        The tworldtimerbusy flag protects us from really slow connection
+        The link.timerbusy flag protects us from really slow connection
         attempts.
         
         This routine is *not* a coroutine, because it doesn't do anything
         yieldy. Instead, it has an old-fashioned (ugly) callback structure.
         """
         
-        if (self.tworldtimerbusy):
-            self.log.warning('monitor_tworld_status: already in flight; did a previous call jam?')
+        if (link.timerbusy):
+            self.log.warning('monitor_tworld_status: already in flight for shard %d; did a previous call jam?', link.shard)
             return
 
-        if (self.tworldavailable):
+        if (link.available):
             # Nothing to do
             return
 
         # We're going to hold this "lock" until the connection attempt
         # fails or definitely succeeds.
-        self.tworldtimerbusy = True
+        link.timerbusy = True
 
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
             # We do a sync connect, because I don't understand how the
             # async version works. (IOStream.connect seems to hang forever
             # when the other process is down?)
-            sock.connect(('localhost', self.app.twopts.tworld_port))
+            # Each shard listens on its own port.
+            sock.connect((self.app.twopts.tworld_host, self.app.twopts.tworld_port + link.shard))
             sock.setblocking(0)
             tornado.platform.auto.set_close_exec(sock.fileno())
-            self.tworld = tornado.iostream.IOStream(sock)
-            self.twbuffer = bytearray()
+            link.stream = tornado.iostream.IOStream(sock)
+            link.version = wcproto.PROTOCOL_JSON
+            link.reader = wcproto.MessageReader(version=link.version, namespace=True)
         except Exception as ex:
-            self.log.error('Could not open tworld socket: %s', ex)
-            self.tworldavailable = False
-            self.tworldtimerbusy = False
+            self.log.error('Could not open tworld socket (shard %d): %s', link.shard, ex)
+            link.available = False
+            link.timerbusy = False
             return
             
-        self.log.info('Tworld socket open')
+        self.log.info('Tworld socket open (shard %d)', link.shard)
 
         # But it won't count as available until we get a response from it.
         try:
+            # Tell the shard about the connections that belong to it.
             arr = []
             for (connid, conn) in self.app.twconntable.as_dict().items():
-                arr.append( { 'connid':connid, 'uid':str(conn.uid), 'email':conn.email } )
-            self.tworld.write(wcproto.message(0, {'cmd':'connect', 'connections':arr}))
+                if conn.shard == link.shard:
+                    arr.append( { 'connid':connid, 'uid':str(conn.uid), 'email':conn.email } )
+            # This message is always protocol version 1, but it offers
+            # tworld a newer version.
+            msg = {'cmd':'connect', 'connections':arr,
+                   'node':self.app.twconntable.node,
+                   'protocol':self.app.twopts.tworld_protocol}
+            link.stream.write(wcproto.message(0, msg))
         except Exception as ex:
-            self.log.error('Could not write connect message to tworld socket: %s', ex)
-            self.tworld = None
-            self.twbuffer = None
-            self.tworldavailable = False
-            self.tworldtimerbusy = False
+            self.log.error('Could not write connect message to tworld socket (shard %d): %s', link.shard, ex)
+            link.stream = None
+            link.reader = None
+            link.available = False
+            link.timerbusy = False
             return
         
-        self.tworld.read_until_close(self.close_tworld, self.read_tworld_data)
-        # Exit, still holding tworldtimerbusy. We'll drop it if the connect
+        link.stream.read_until_close(functools.partial(self.close_tworld, link),
+                                     functools.partial(self.read_tworld_data, link))
+        # Exit, still holding link.timerbusy. We'll drop it if the connect
         # pong arrives, or if the socket closes.
 
-    def read_tworld_data(self, dat):
+    def read_tworld_data(self, link, dat):
         """Callback from tworld reading handler.
         """
-        self.twbuffer.extend(dat)
+        link.reader.feed(dat)
         while True:
-            # This slices a chunk off the buffer and returns it, if a
+            # This pulls a chunk out of the buffer and returns it, if a
             # complete chunk is available.
-            try:
-                ### this unnecessarily de-jsons the message! We only care
-                ### about raw, in the common case.
-                tup = wcproto.check_buffer(self.twbuffer, namespace=True)
-                if not tup:
-                    # No more complete messages to pull! (This is the
-                    # only return point from this method.)
-                    return
-            except Exception as ex:
-                self.log.warning('Malformed message: %s', ex)
-                continue
+            tup = link.reader.read()
+            if not tup:
+                # No more complete messages to pull! (This is the
+                # only return point from this method.)
+                return
+            
+            (connid, raw) = tup
+            if connid != 0 and link.available:
+                # A player message. We only need the raw JSON, so we
+                # don't decode it here.
+                obj = None
+            else:
+                try:
+                    obj = wcproto.decode_content(connid, raw, version=link.version, namespace=True)
+                except Exception as ex:
+                    self.log.warning('Malformed message: %s', ex)
+                    continue
 
             try:
-                (connid, raw, obj) = tup
-                self.handle_tworld_message(connid, raw, obj)
+                self.handle_tworld_message(link, connid, raw, obj)
             except Exception as ex:
                 self.log.warning('Error handling tworld message', exc_info=True)
             continue
 
-    def handle_tworld_message(self, connid, raw, obj):
-        """Handle a single message from tworld, or throw an exception.
-        (This does not do anything yieldy.)
+    def handle_tworld_message(self, link, connid, raw, obj):
+        """Handle a single message from a tworld shard, or throw an
+        exception. (This does not do anything yieldy.)
+
+        For player messages, obj may be None; the raw JSON is passed
+        along as-is.
         """
-        if not self.tworldavailable:
+        if not link.available:
             # Special case: if we're connecting, only accept 'connectok'
             if (connid != 0):
                 self.log.warning('Cannot pass message back to client before tworld is available!')
             elif getattr(obj, 'cmd', None) != 'connectok':
                 self.log.warning('Cannot handle command before tworld is available!')
             else:
-                self.log.info('Tworld socket available')
-                self.tworldavailable = True
-                self.tworldtimerbusy = False
+                # An older tworld won't mention the protocol (or shard)
+                # at all.
+                shard = getattr(obj, 'shard', 0)
+                if shard != link.shard:
+                    self.log.error('Tworld on port %d says it is shard %d, not %d! Check the tworld_shard options.', self.app.twopts.tworld_port + link.shard, shard, link.shard)
+                link.version = getattr(obj, 'protocol', wcproto.PROTOCOL_JSON)
+                link.reader.version = link.version
+                self.log.info('Tworld socket available (shard %d, protocol version %d)', link.shard, link.version)
+                link.available = True
+                link.timerbusy = False
             return
         
         if (connid != 0):
             # Pass the raw message along to the client. (As UTF-8.)
             try:
                 conn = self.app.twconntable.find(connid)
-                if not conn.available and obj.cmd != 'error':
-                    raise Exception('Connection not available')
+                if not conn.available:
+                    if obj is None:
+                        obj = wcproto.decode_content(connid, raw, namespace=True)
+                    if obj.cmd != 'error':
+                        raise Exception('Connection not available')
                 conn.handler.write_message(raw.decode())
             except Exception as ex:
                 self.log.error('Unable to pass message back to connection %d (%s): %s', connid, raw[0:50], ex)
@@ -263,6 +363,8 @@ class ServerMgr(object):
                 conn = self.app.twconntable.find(obj.connid)
                 if conn.available:
                     raise Exception('Connection is already available')
+                if conn.shard != link.shard:
+                    raise Exception('Connection belongs to shard %d, not %d' % (conn.shard, link.shard))
                 self.log.info('Player connection registered: %s (connid %d)', conn.email, conn.connid)
                 conn.available = True
             except Exception as ex:
@@ -283,28 +385,95 @@ class ServerMgr(object):
             return
 
         if cmd == 'messageall':
-            # send a message to every connection
+            # send a message to every connection (on this shard -- the
+            # other shards send their own)
             msgobj = { 'cmd':'message', 'text':obj.text }
             for conn in self.app.twconntable.all():
+                if conn.shard != link.shard:
+                    continue
                 try:
                     conn.handler.write_message(msgobj)
                 except Exception as ex:
                     self.log.error('Unable to send messageall message: %s', ex)
             return
+
+        if cmd == 'playermoved':
+            # The player has moved to an instance on another shard.
+            # Reopen their connections over there.
+            uid = ObjectId(obj.uid)
+            for conn in self.app.twconntable.for_uid(uid):
+                if conn.shard == obj.shard:
+                    continue
+                oldshard = conn.shard
+                conn.shard = obj.shard
+                conn.available = False
+                self.log.info('Player connection moved from shard %d to %d: %s (connid %d)', oldshard, conn.shard, conn.email, conn.connid)
+                try:
+                    if oldshard != link.shard:
+                        # Whoever had it doesn't know it's moving.
+                        self.tworld_write(conn.connid, {'cmd':'playerclose'}, shard=oldshard)
+                except Exception as ex:
+                    self.log.warning('Unable to close moved connection on shard %d: %s', oldshard, ex)
+                try:
+                    msg = { 'cmd':'playeropen', 'uid':str(uid), 'email':conn.email }
+                    self.tworld_write(conn.connid, msg)
+                except Exception as ex:
+                    # It will be reopened when that shard reconnects.
+                    self.log.error('Unable to reopen moved connection on shard %d: %s', conn.shard, ex)
+            return
+
+        if cmd == 'sessionremoved':
+            # Tworld has deleted a session (an idle guest's), or a tweb
+            # has (sign-out or kick). Sessionids are bytes, but this
+            # arrives as a string.
+            self.app.twsessionmgr.invalidate_session(obj.sid.encode())
+            return
+
+        if cmd == 'playerevent':
+            # An event for a player whose connections are on another shard.
+            uid = ObjectId(obj.uid)
+            msgobj = { 'cmd':'event', 'text':obj.text }
+            for conn in self.app.twconntable.for_uid(uid):
+                try:
+                    conn.handler.write_message(msgobj)
+                except Exception as ex:
+                    self.log.error('Unable to send playerevent message: %s', ex)
+            return
+
+        if cmd == 'relay':
+            # A command from one shard to another (or to all the others).
+            # We re-encode it for each shard's protocol version, so decode
+            # it fresh, without the namespace wrapping.
+            msg = wcproto.decode_content(0, raw, version=link.version)['msg']
+            relayobj = { 'cmd':'relayed', 'msg':msg }
+            shard = getattr(obj, 'shard', None)
+            for other in self.tworldlinks:
+                if other is link:
+                    continue
+                if shard is not None and other.shard != shard:
+                    continue
+                try:
+                    other.write(0, relayobj)
+                except Exception as ex:
+                    self.log.error('Unable to relay %s to shard %d: %s', msg.get('cmd'), other.shard, ex)
+            return
         
         raise Exception('Tworld message not implemented: %s' % (cmd,))
     
 
-    def close_tworld(self, dat):
+    def close_tworld(self, link, dat):
         """Callback from tworld reading handler.
         """
-        self.log.error('Connection to tworld closed.')
-        # All connections we're holding are back to unavailable status.
+        self.log.error('Connection to tworld closed (shard %d).', link.shard)
+        # All connections we're holding on that shard are back to
+        # unavailable status.
         for (connid, conn) in self.app.twconntable.as_dict().items():
-            conn.available = False
-        self.tworld = None
-        self.twbuffer = None
-        self.tworldavailable = False
-        self.tworldtimerbusy = False
+            if conn.shard == link.shard:
+                conn.available = False
+        link.stream = None
+        link.reader = None
+        link.version = wcproto.PROTOCOL_JSON
+        link.available = False
+        link.timerbusy = False
 
         
@@ -6,12 +6,23 @@ those disappears.
 
 (Note that sessions are not web socket connections. See the connections.py
 module for those.)
+
+Every page load and websocket open needs the session, so the SessionMgr
+keeps the ones it has looked up recently in memory, for session_cache_ttl
+seconds. (A reconnect storm after a tworld restart would otherwise be a
+flood of identical database queries.) A session that goes away -- sign
+out, idle guest cleanup -- has to be dropped from the cache with
+invalidate_session(), or it will stay valid until its entry expires.
+Other twebs may have it cached too, so use broadcast_invalidation() to
+have tworld tell all of them.
 """
 
 import os
 import binascii
 import datetime
 import hashlib
+import time
+import collections
 
 import bson.son
 import tornado.gen
@@ -31,10 +42,108 @@ class SessionMgr(object):
     methods have to be async. Pain in the butt, it is.
     """
 
+    # The most sessions we'll cache. (Past this, the oldest entries go
+    # early.)
+    CACHE_LIMIT = 5000
+
     def __init__(self, app):
         # Keep a link to the owning application.
         self.app = app
 
+        # Maps sessionid to (expiretime, session dict). The TTL is the
+        # same for every entry, so insertion order is expiration order.
+        # Expire times are time.monotonic() values.
+        self.cache = collections.OrderedDict()
+        self.cachehits = 0
+        self.cachemisses = 0
+        self.cacheinvalidations = 0
+
+    def get_cached_session(self, sessionid):
+        """Return the cached session dict for a sessionid, or None if
+        there isn't a live cache entry. Counts hits and misses.
+        """
+        ttl = self.app.twopts.session_cache_ttl
+        if not ttl or ttl <= 0:
+            return None
+        ent = self.cache.get(sessionid, None)
+        if ent is not None:
+            (expiretime, sess) = ent
+            if expiretime > time.monotonic():
+                self.cachehits += 1
+                return sess
+            del self.cache[sessionid]
+        self.cachemisses += 1
+        return None
+
+    def cache_session(self, sessionid, sess):
+        """Add a session dict (freshly read from the database) to the
+        cache.
+        """
+        ttl = self.app.twopts.session_cache_ttl
+        if not ttl or ttl <= 0:
+            return
+        now = time.monotonic()
+        self.cache.pop(sessionid, None)
+        self.cache[sessionid] = (now + ttl, sess)
+        self.prune_cache(now)
+
+    def prune_cache(self, now=None):
+        """Discard expired cache entries, and the oldest ones if there
+        are too many.
+        """
+        if now is None:
+            now = time.monotonic()
+        cache = self.cache
+        while cache:
+            (sessionid, (expiretime, sess)) = next(iter(cache.items()))
+            if expiretime > now and len(cache) <= self.CACHE_LIMIT:
+                break
+            del cache[sessionid]
+
+    def invalidate_session(self, sessionid):
+        """Drop a session from the cache, because it has been removed or
+        changed in the database.
+        """
+        if self.cache.pop(sessionid, None) is not None:
+            self.cacheinvalidations += 1
+
+    def invalidate_expired(self, cutoff):
+        """Drop every cached session whose refreshtime is before cutoff,
+        because monitor_sessions expires those from the database.
+        (Every tweb does this for itself, whichever one removed them.)
+        """
+        ls = [ sessionid for (sessionid, (expiretime, sess)) in self.cache.items()
+               if sess.get('refreshtime') and sess['refreshtime'] < cutoff ]
+        for sessionid in ls:
+            self.invalidate_session(sessionid)
+
+    def broadcast_invalidation(self, sessionid):
+        """Drop a session from the cache, and ask tworld to have every
+        tweb do the same. (Tworld answers with a sessionremoved message
+        to each of them, us included.) If tworld isn't available, the
+        other twebs will only drop it when their entries expire.
+        """
+        self.invalidate_session(sessionid)
+        try:
+            # Any one shard will do; every tweb is connected to each.
+            msg = {'cmd':'notifysessionremoved', 'sid':sessionid.decode()}
+            self.app.twservermgr.tworld_write(0, msg, shard=0)
+        except Exception as ex:
+            self.app.twlog.warning('Unable to broadcast session removal: %s', ex)
+
+    def cache_stats(self):
+        """Return a dict of cache statistics, for the admin page.
+        """
+        lookups = self.cachehits + self.cachemisses
+        return {
+            'ttl': self.app.twopts.session_cache_ttl,
+            'size': len(self.cache),
+            'hits': self.cachehits,
+            'misses': self.cachemisses,
+            'hitrate': (100.0 * self.cachehits / lookups) if lookups else 0.0,
+            'invalidations': self.cacheinvalidations,
+            }
+
     def random_bytes(self, count):
         """Generate random hexadecimal bytes, from a good source.
         (Result will be a bytes object containing 2*N (ASCII, lowercase)
@@ -357,6 +466,9 @@ class SessionMgr(object):
         sessionid = handler.get_secure_cookie('sessionid')
         if not sessionid:
             return ('unauth', None)
+        res = self.get_cached_session(sessionid)
+        if res:
+            return ('auth', res)
         try:
             res = yield motor.Op(self.app.mongodb.sessions.find_one,
                                  { 'sid': sessionid })
@@ -365,6 +477,7 @@ class SessionMgr(object):
             return ('unknown', None)
         if not res:
             return ('unauth', None)
+        self.cache_session(sessionid, res)
         return ('auth', res)
 
     @tornado.gen.coroutine
@@ -377,6 +490,7 @@ class SessionMgr(object):
         if (sessionid):
             yield motor.Op(self.app.mongodb.sessions.remove,
                            { 'sid': sessionid })
+            self.broadcast_invalidation(sessionid)
     
     @tornado.gen.coroutine
     def monitor_sessions(self):
@@ -424,6 +538,7 @@ class SessionMgr(object):
                 try:
                     conn.sessiontime = now
                     conn.handler.write_message(msgobj)
+                    self.invalidate_session(conn.sessionid)
                     yield motor.Op(self.app.mongodb.sessions.update,
                                    { 'sid': conn.sessionid },
                                    { '$set': {'refreshtime':now }})
@@ -431,11 +546,15 @@ class SessionMgr(object):
                 except Exception as ex:
                     self.app.twlog.error('Error refreshing session: %s', ex)
 
+        # Clear out expired cache entries, so that sessions which are
+        # no longer being used don't hang around in memory.
+        self.prune_cache()
+
         # Expire old sessions.
+        eightdays = now - datetime.timedelta(days=8)
         try:
             # Order matters for the count command, so we must construct
             # it as BSON.
-            eightdays = now - datetime.timedelta(days=8)
             countquery = bson.son.SON()
             countquery['count'] = 'sessions'
             countquery['query'] = {'refreshtime': {'$lt': eightdays}}
@@ -448,6 +567,7 @@ class SessionMgr(object):
             
         except Exception as ex:
             self.app.twlog.error('Error expiring old sessions: %s', ex)
+        self.invalidate_expired(eightdays)
 
     @tornado.gen.coroutine
     def monitor_pwrecover(self):
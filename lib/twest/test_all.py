@@ -19,6 +19,14 @@ testlist = [
     'twest.test_eval',
     'twest.test_funcs',
     'twest.test_propcache',
+    'twest.test_playconn',
+    'twest.test_wcproto',
+    'twest.test_ipool',
+    'twest.test_session',
+    'twest.test_webconn',
+    'twest.test_gentext',
+    'twest.test_worldimport',
+    'twest.test_commands',
     'twcommon.misc',
     'two.grammar',
     ]
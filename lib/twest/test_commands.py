@@ -0,0 +1,68 @@
+"""
+To run:   python3 -m tornado.testing twest.test_commands
+(The twest, two, twcommon modules must be in your PYTHON_PATH.)
+"""
+
+import logging
+import unittest
+
+import tornado.testing
+from bson.objectid import ObjectId
+
+from twcommon import wcproto
+import two.commands
+
+class MockApp:
+    def __init__(self):
+        self.log = logging.getLogger('tworld')
+        self.queued = []
+    def queue_command(self, obj):
+        self.queued.append(obj)
+
+class TestRelay(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        if not two.commands.Command.all_commands:
+            two.commands.define_commands()
+        self.cmd_relayed = two.commands.Command.all_commands['relayed']
+
+    def relay(self, obj, version):
+        """Pass a command from one shard to another, the way tweb does.
+        """
+        dat = wcproto.message(0, {'cmd':'relay', 'shard':1, 'msg':obj}, version=version)
+        msg = wcproto.decode_content(0, dat[wcproto.HEADER_LENGTH:], version=version)['msg']
+        reader = wcproto.MessageReader(version=version, namespace=True)
+        reader.feed(wcproto.message(0, {'cmd':'relayed', 'msg':msg}, version=version))
+        (connid, raw, cmd) = reader.check()
+        app = MockApp()
+        return (app, self.cmd_relayed.func(app, None, cmd, None))
+
+    @tornado.testing.gen_test
+    def test_relay_tovoid(self):
+        uid = ObjectId()
+        portto = {'wid':ObjectId(), 'scid':ObjectId(), 'locid':ObjectId()}
+        # This string looks like an ObjectId, but isn't one.
+        text = str(ObjectId())
+        obj = {'cmd':'tovoid', 'uid':uid, 'portin':True, 'portto':portto,
+               'text':text, 'ls':[{'key':text}]}
+        for version in (wcproto.PROTOCOL_JSON, wcproto.PROTOCOL_BSON):
+            (app, fut) = self.relay(obj, version)
+            yield fut
+            self.assertEqual(app.queued, [obj])
+            res = app.queued[0]
+            self.assertIs(type(res['uid']), ObjectId)
+            self.assertIs(type(res['portto']), dict)
+            self.assertIs(type(res['portto']['scid']), ObjectId)
+            self.assertIs(type(res['text']), str)
+            self.assertIs(type(res['ls'][0]), dict)
+
+        # A tovoid without a destination.
+        obj = {'cmd':'tovoid', 'uid':uid, 'portin':False, 'portto':None}
+        (app, fut) = self.relay(obj, wcproto.PROTOCOL_JSON)
+        yield fut
+        self.assertEqual(app.queued, [obj])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -14,6 +14,7 @@ import tornado.testing
 import motor
 
 import twcommon.misc
+import twcommon.access
 import two.execute
 import two.symbols
 import two.task
@@ -124,6 +125,16 @@ class TestEval(unittest.TestCase):
         self.assertRaises(SyntaxError, parse_argument_spec, '**map, x=1')
         self.assertRaises(SyntaxError, parse_argument_spec, ':None;lambda')
 
+    def test_argument_spec_cache(self):
+        parse_argument_spec = two.evalctx.parse_argument_spec
+        
+        spec1 = parse_argument_spec('x, y=1')
+        spec1.defaults = [2]
+        spec2 = parse_argument_spec('x, y=1')
+        self.assertFalse(spec1 is spec2)
+        self.assertSpecIs(spec2, ['x', 'y'], defaults=[1])
+        self.assertTrue(two.evalctx.argspec_parse_cache.hits > 0)
+
     def assertSpecResolves(self, specstr, *args, **kwargs):
         spec = two.evalctx.parse_argument_spec(specstr)
         if spec.defaults:
@@ -663,6 +674,165 @@ class TestEvalAsync(twest.mock.MockAppTestCase):
         res = yield ctx.eval('foo()', locals={'foo':str}, evaltype=EVALTYPE_CODE)
         self.assertEqual(res, '')
 
+
+    @tornado.testing.gen_test
+    def test_player_dependence(self):
+        yield self.resetTables()
+        
+        task = two.task.Task(self.app, None, 1, 2, twcommon.misc.now())
+        ctx = EvalPropContext(task, loctx=self.loctx, level=LEVEL_EXECUTE)
+
+        res = yield ctx.eval('[x, ls, _.random]', evaltype=EVALTYPE_CODE)
+        self.assertFalse(task.playerdependent)
+        res = yield ctx.eval('player', evaltype=EVALTYPE_CODE)
+        self.assertEqual(res, two.execute.PlayerProxy(self.exuid))
+        self.assertTrue(task.playerdependent)
+
+        # Random choices differ between players too.
+        task = two.task.Task(self.app, None, 1, 2, twcommon.misc.now())
+        ctx = EvalPropContext(task, loctx=self.loctx, level=LEVEL_EXECUTE)
+        res = yield ctx.eval('random.randint(1, 6)', evaltype=EVALTYPE_CODE)
+        self.assertTrue(task.playerdependent)
+
+    @tornado.testing.gen_test
+    def test_shared_render(self):
+        yield self.resetTables()
+        plainloctx = two.task.LocContext(
+            uid=self.exuid, wid=self.exwid, scid=self.exscid,
+            iid=self.exiid, locid=ObjectId())
+        yield motor.Op(self.app.mongodb.worldprop.insert,
+                       {'wid':self.exwid, 'locid':self.exlocid,
+                        'key':'desc', 'val':{'type':'text', 'text':'You roll [[ random.randint(1, 1000000) ]].'}})
+        yield motor.Op(self.app.mongodb.worldprop.insert,
+                       {'wid':self.exwid, 'locid':plainloctx.locid,
+                        'key':'desc', 'val':{'type':'text', 'text':'Nothing here.'}})
+
+        task = two.task.Task(self.app, None, 1, 2, twcommon.misc.now())
+        task.sharedrenders = {}
+        calls = []
+        @tornado.gen.coroutine
+        def render(loctx):
+            calls.append(loctx.locid)
+            res = yield two.execute.render_locale(task, loctx)
+            return res
+
+        # A description with a random roll is rendered separately for
+        # each connection.
+        for ix in range(2):
+            yield two.execute.shared_render(task, 'roll', render, self.loctx)
+        self.assertEqual(calls, [self.exlocid, self.exlocid])
+
+        # One without is rendered once, and shared.
+        calls.clear()
+        for ix in range(2):
+            res = yield two.execute.shared_render(task, 'plain', render, plainloctx)
+            self.assertEqual(res[0], ['Nothing here.'])
+        self.assertEqual(calls, [plainloctx.locid])
+
+        # Nor does a description which interpolates a text property.
+        textloctx = two.task.LocContext(
+            uid=self.exuid, wid=self.exwid, scid=self.exscid,
+            iid=self.exiid, locid=ObjectId())
+        yield motor.Op(self.app.mongodb.worldprop.insert,
+                       {'wid':self.exwid, 'locid':textloctx.locid,
+                        'key':'breeze', 'val':{'type':'text', 'text':'A breeze blows.'}})
+        yield motor.Op(self.app.mongodb.worldprop.insert,
+                       {'wid':self.exwid, 'locid':textloctx.locid,
+                        'key':'desc', 'val':{'type':'text', 'text':'Nothing here. [[ breeze ]]'}})
+        calls.clear()
+        for uid in (self.exuid, ObjectId()):
+            otherloctx = two.task.LocContext(
+                uid=uid, wid=self.exwid, scid=self.exscid,
+                iid=self.exiid, locid=textloctx.locid)
+            res = yield two.execute.shared_render(task, 'text', render, otherloctx)
+            self.assertEqual(res[0], ['Nothing here. A breeze blows.'])
+        self.assertEqual(calls, [textloctx.locid])
+
+    @tornado.testing.gen_test
+    def test_remote_write_lanes(self):
+        yield self.resetTables()
+        world = {'_id':self.exwid, 'creator':ObjectId()}
+        perms = twcommon.access.RemoteAccessMap(world, world)
+        remote = two.execute.RemoteRealmProxy(self.exwid, self.exscid, self.exiid, perms)
+        self.app.busylanes = set()
+
+        # Two concurrent tasks in other instances, both reaching into
+        # exiid. The first takes its lane; the second must not write.
+        tasks = []
+        for ix in range(2):
+            task = two.task.Task(self.app, None, ix+1, 2, twcommon.misc.now())
+            task.changeset = set()
+            task.lanes = set([('uid', ObjectId()), ('iid', ObjectId())])
+            self.app.busylanes.update(task.lanes)
+            tasks.append(task)
+        ctx = EvalPropContext(tasks[0], loctx=self.loctx, level=LEVEL_EXECUTE)
+        yield remote.setprop(ctx, self.loctx, 'r', 21)
+        self.assertIn(('iid', self.exiid), tasks[0].lanes)
+        self.assertIn(('iid', self.exiid), self.app.busylanes)
+        ctx = EvalPropContext(tasks[1], loctx=self.loctx, level=LEVEL_EXECUTE)
+        with self.assertRaises(Exception):
+            yield remote.setprop(ctx, self.loctx, 'r', 22)
+        with self.assertRaises(Exception):
+            yield remote.delprop(ctx, self.loctx, 'r')
+        self.assertNotIn(('iid', self.exiid), tasks[1].lanes)
+        res = yield self.app.propcache.get(('instanceprop', self.exiid, None, 'r'))
+        self.assertEqual(res.val, 21)
+
+        # A task with the server to itself can write anywhere.
+        task = two.task.Task(self.app, None, 3, 2, twcommon.misc.now())
+        task.changeset = set()
+        ctx = EvalPropContext(task, loctx=self.loctx, level=LEVEL_EXECUTE)
+        yield remote.setprop(ctx, self.loctx, 'r', 23)
+        self.assertIsNone(task.lanes)
+
+    @tornado.testing.gen_test
+    def test_compiler_conformance(self):
+        yield self.resetTables()
+
+        task = two.task.Task(self.app, None, 1, 2, twcommon.misc.now())
+        
+        snippets = [
+            'x', 'r', 'nosuch', '_', '-x', 'not ls', 'x+y*3', 'ls[0:2][1]',
+            '1 if ls else nosuch', 'x < y <= 3', 'x and nosuch',
+            '{1:x, 2:[y,w], 3:(r,)}', '[_a*_b for _a in ls for _b in ls if _b != _a]',
+            '[_a*b for _a in ls for b in ls]', 'random.choice([x])',
+            '_x = 0\nwhile _x < 5:\n _x += 1\n_x',
+            '_q = [1,2]\n_q[0] += 5\n_q', '(_a, _b) = (1, 2)\n_a+_b',
+            'for _x in ls:\n for _y in ls:\n  if _y == 2:\n   break\n _z = _x\nreturn _z',
+            '_x = 1\ndel _x\n_x', '_x = 1\n_x()', 'ls.nosuch', 'x // 0',
+            ]
+
+        # Each snippet must produce the same result (or exception), and
+        # use the same number of ticks, whether it's interpreted or
+        # compiled.
+        for text in snippets:
+            results = []
+            for compile_code in (False, True):
+                EvalPropContext.compile_code = compile_code
+                task.resetticks()
+                ctx = EvalPropContext(task, loctx=self.loctx, level=LEVEL_EXECUTE)
+                try:
+                    res = yield ctx.eval(text, evaltype=EVALTYPE_CODE)
+                except Exception as ex:
+                    res = type(ex)
+                results.append( (res, task.cputicks) )
+            EvalPropContext.compile_code = True
+            self.assertEqual(results[0], results[1], text)
+
+class TestEvalAsyncInterpreted(TestEvalAsync):
+    """Run all the async eval tests again, with compiled code turned off.
+    """
+    def setUp(self):
+        super().setUp()
+        EvalPropContext.compile_code = False
+        
+    def tearDown(self):
+        EvalPropContext.compile_code = True
+        super().tearDown()
+
+    def test_compiler_conformance(self):
+        pass
+
         
 from two.evalctx import LEVEL_EXECUTE, LEVEL_DISPSPECIAL, LEVEL_DISPLAY, LEVEL_MESSAGE, LEVEL_FLAT, LEVEL_RAW
 from two.evalctx import EVALTYPE_SYMBOL, EVALTYPE_RAW, EVALTYPE_CODE, EVALTYPE_TEXT
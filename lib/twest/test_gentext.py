@@ -0,0 +1,73 @@
+"""
+To run:   python3 -m tornado.testing twest.test_gentext
+(The twest, two, twcommon modules must be in your PYTHON_PATH.)
+"""
+
+import types
+import hashlib
+import struct
+import unittest
+
+import twcommon.gentext
+from twcommon.gentext import GenText, SeqNode, AltNode, SymbolNode
+
+class TestGenText(unittest.TestCase):
+
+    def test_parse_cached(self):
+        tree = twcommon.gentext.parse_cached('[foo, (bar, baz)]')
+        self.assertIsInstance(tree, GenText)
+        self.assertIsInstance(tree.nod, SeqNode)
+        self.assertIsInstance(tree.nod.nodes[1], AltNode)
+        self.assertEqual(tree.nod.nodes[1].prefix, b':seq_1')
+        self.assertIs(twcommon.gentext.parse_cached('[foo, (bar, baz)]'), tree)
+        
+        # Errors are not cached.
+        for ix in range(2):
+            self.assertRaises(SyntaxError, twcommon.gentext.parse_cached, 'Alt')
+        self.assertNotIn('Alt', twcommon.gentext.parse_cache.map)
+
+    def test_computeseed(self):
+        # The seeds must not change, or every world's generated text
+        # would change with them.
+        def oldseed(genseed, count, propname, prefix):
+            hash = hashlib.md5()
+            hash.update(genseed)
+            hash.update(str(count).encode())
+            hash.update(propname)
+            hash.update(prefix)
+            return struct.unpack('!I', hash.digest()[-4:])[0]
+
+        nod = AltNode(SymbolNode('x'), SymbolNode('y'))
+        nod.prefix = b':seq_3'
+        for genseed in (b'5200a3f46ab1ac0e3ca67d01', b'???', b'5200a3f46ab1ac0e3ca67d01'):
+            ctx = types.SimpleNamespace(genseed=genseed, gencount=0,
+                                        genengine=twcommon.gentext.seed_engine(None))
+            for count in range(12):
+                res = nod.computeseed(ctx, b'desc')
+                self.assertEqual(res, oldseed(genseed, count, b'desc', b':seq_3'))
+            self.assertEqual(ctx.gencount, 12)
+
+    def test_engines(self):
+        seed_engine = twcommon.gentext.seed_engine
+        self.assertIs(seed_engine('md5'), twcommon.gentext.seed_md5)
+        self.assertIs(seed_engine('fast'), twcommon.gentext.seed_fast)
+        self.assertIs(seed_engine('bogus'), twcommon.gentext.seed_md5)
+        self.assertIs(seed_engine(['fast']), twcommon.gentext.seed_md5)
+
+        # The fast engine's output is documented, so pin it down.
+        fast = twcommon.gentext.seed_fast
+        self.assertEqual(fast(b'seed', b'0desc'), fast(b'seed', b'0desc'))
+        self.assertEqual(fast(b'seed', b'0desc'), fast(b'', b'seed0desc'))
+        self.assertEqual(fast(b'', b''), 0)
+        self.assertEqual(fast(b'', b'a'), 0xB3D206B7)
+        ls = [ fast(b'5200a3f46ab1ac0e3ca67d01', str(ix).encode()+b'desc') for ix in range(3000) ]
+        self.assertTrue(all([ 0 <= val <= 0xFFFFFFFF for val in ls ]))
+        for mod in (2, 3, 7):
+            counts = [ 0 ] * mod
+            for val in ls:
+                counts[val % mod] += 1
+            self.assertTrue(min(counts) > 0.8 * len(ls) / mod)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,7 +5,8 @@ To run:   python3 -m tornado.testing twest.test_interp
 
 import unittest
 
-from twcommon.interp import parse
+from twcommon.interp import parse, parse_cached
+from twcommon.interp import If, ElIf, Else, End
 from twcommon.interp import Interpolate, Link, EndLink, ParaBreak, PlayerRef, Style, EndStyle
 
 class TestInterpModule(unittest.TestCase):
@@ -75,3 +76,19 @@ class TestInterpModule(unittest.TestCase):
         self.assertRaises(ValueError, parse, '[bar')
         self.assertRaises(ValueError, parse, '[[bar')
         self.assertRaises(ValueError, parse, '[ [x] ]')
+
+    def test_parse_cached(self):
+        res = parse_cached('[[$if x]]A[[$elif y]]B[[$else]]C[[$end]]D')
+        self.assertEqual(res.nodes, (If('x'), 'A', ElIf('y'), 'B', Else(), 'C', End(), 'D'))
+        self.assertEqual(res.jumps, ((2,6), None, (4,6), None, (6,6), None, (6,6), None))
+        self.assertFalse(res.unterminated)
+        self.assertIs(res, parse_cached('[[$if x]]A[[$elif y]]B[[$else]]C[[$end]]D'))
+
+        res = parse_cached('[$if x][$if y]A[$end][$else]B[$end]')
+        self.assertEqual(res.jumps, ((4,6), (3,3), None, (3,3), (6,6), None, (6,6)))
+        
+        res = parse_cached('[$end][$if x]A[$elif y]B')
+        self.assertEqual(res.jumps, (None, (3,5), None, (5,5), None))
+        self.assertTrue(res.unterminated)
+        
+        self.assertRaises(ValueError, parse_cached, '[bar')
@@ -0,0 +1,236 @@
+"""
+To run:   python3 -m tornado.testing twest.test_ipool
+(The twest, two, twcommon modules must be in your PYTHON_PATH.)
+"""
+
+import types
+import logging
+import datetime
+import unittest
+
+import tornado.testing
+import motor
+from bson.objectid import ObjectId
+
+import twest.mock
+import twcommon.misc
+import two.ipool
+import two.symbols
+
+class MockIOLoop:
+    """Just enough of an IOLoop to drive the timer wheel by hand.
+    """
+    def __init__(self):
+        self.now = 1000.0
+        self.timeouts = []
+    def time(self):
+        return self.now
+    def add_timeout(self, deadline, callback):
+        self.timeouts.append( (deadline, callback) )
+        return callback
+    def run_until(self, when):
+        while True:
+            ls = [ tup for tup in self.timeouts if tup[0] <= when ]
+            if not ls:
+                break
+            tup = min(ls, key=lambda tup: tup[0])
+            self.timeouts.remove(tup)
+            self.now = max(self.now, tup[0])
+            tup[1]()
+        self.now = when
+
+class MockApp:
+    def __init__(self):
+        self.log = logging.getLogger('tworld')
+        self.opts = types.SimpleNamespace(persist_timers=False)
+        self.ioloop = MockIOLoop()
+        self.ipool = two.ipool.InstancePool(self)
+        self.queued = []
+        self.commands = []
+    def queue_command(self, obj):
+        for func in obj['funcs']:
+            self.queued.append( (self.ioloop.now, obj['iid'], func) )
+        self.commands.append(obj)
+
+sec = lambda val: datetime.timedelta(seconds=val)
+
+class TestTimerWheel(unittest.TestCase):
+
+    def test_timers(self):
+        app = MockApp()
+        app.ipool.notify_instance('iid1')
+        app.ipool.notify_instance('iid2')
+        inst1 = app.ipool.get('iid1')
+        inst2 = app.ipool.get('iid2')
+
+        inst1.add_timer_event(sec(2), 'a')
+        inst1.add_timer_event(sec(3), 'b', cancel='key')
+        inst2.add_timer_event(sec(3), 'c', cancel='key')
+        # Further away than a whole turn of the wheel.
+        inst2.add_timer_event(sec(600), 'd')
+        self.assertEqual(len(app.ipool.wheel), 4)
+
+        # Cancel keys are per-instance.
+        inst1.remove_timer_events(cancel='key')
+        self.assertEqual(len(app.ipool.wheel), 3)
+        app.ioloop.run_until(1010)
+        self.assertEqual([ (iid, func) for (when, iid, func) in app.queued ],
+                         [ ('iid1', 'a'), ('iid2', 'c') ])
+        for (when, iid, func) in app.queued:
+            self.assertTrue(when >= 1002)
+            self.assertTrue(when <= 1003.5)
+        self.assertEqual(len(app.ipool.wheel), 1)
+
+        # Events for one instance that come due together are queued as
+        # a single command.
+        app.commands.clear()
+        inst1.add_timer_event(sec(5), 'e')
+        inst1.add_timer_event(sec(5), 'f')
+        inst2.add_timer_event(sec(5), 'g')
+        app.ioloop.run_until(1020)
+        self.assertEqual(app.commands, [
+            {'cmd':'timerevent', 'iid':'iid1', 'funcs':['e', 'f']},
+            {'cmd':'timerevent', 'iid':'iid2', 'funcs':['g']} ])
+
+        app.queued.clear()
+        app.ioloop.run_until(1700)
+        self.assertEqual([ func for (when, iid, func) in app.queued ], ['d'])
+        self.assertTrue(1600 <= app.queued[0][0] <= 1600.5)
+        # The wheel stops when it's empty.
+        self.assertEqual(len(app.ipool.wheel), 0)
+        self.assertEqual(app.ioloop.timeouts, [])
+
+    def test_repeat(self):
+        app = MockApp()
+        app.ipool.notify_instance('iid')
+        inst = app.ipool.get('iid')
+        inst.add_timer_event(datetime.timedelta(seconds=10.2), 'r', repeat=True)
+        app.ioloop.run_until(1100)
+        # Repeats are counted from the due time, so they don't drift.
+        ls = [ when for (when, iid, func) in app.queued ]
+        self.assertEqual(len(ls), 9)
+        for (ix, when) in enumerate(ls):
+            self.assertTrue(0 <= when - (1000 + 10.2 * (ix+1)) <= 0.5)
+
+        # If the loop stalls, missed repeats are skipped, not bunched up.
+        app.queued.clear()
+        app.ioloop.timeouts.clear()
+        app.ioloop.now = 1200
+        app.ipool.wheel.advance()
+        self.assertEqual(len(app.queued), 1)
+        app.ioloop.run_until(1210)
+        self.assertEqual(len(app.queued), 2)
+
+        app.ipool.remove_instance('iid')
+        self.assertEqual(len(app.ipool.wheel), 0)
+
+class TestStoredTimers(twest.mock.MockAppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Borrow the timer machinery from MockApp, but keep the database.
+        mockapp = MockApp()
+        mockapp.mongodb = self.app.mongodb
+        mockapp.opts.persist_timers = True
+        self.timerapp = mockapp
+
+    @tornado.testing.gen_test
+    def test_store_and_load(self):
+        app = self.timerapp
+        yield motor.Op(app.mongodb.schedevents.remove, {})
+        iid = ObjectId()
+        yield motor.Op(app.mongodb.instances.insert, {'_id':iid})
+        app.ipool.notify_instance(iid)
+        inst = app.ipool.get(iid)
+
+        timer1 = inst.add_timer_event(sec(5), 'once')
+        yield app.ipool.store_timer_event(timer1)
+        timer2 = inst.add_timer_event(sec(10), {'type':'code', 'text':'rep'}, repeat=True, cancel='key')
+        yield app.ipool.store_timer_event(timer2)
+        doortimer = inst.add_timer_event(sec(30), 'door', cancel=('door', 1))
+        yield app.ipool.store_timer_event(doortimer)
+        # Callables can't be stored. The instance is marked, so that
+        # it will get an on_wake call instead of resuming.
+        timer3 = inst.add_timer_event(sec(20), two.symbols.ScriptCallable())
+        yield app.ipool.store_timer_event(timer3)
+        self.assertIsNone(timer3.dbid)
+        res = yield motor.Op(app.mongodb.schedevents.find({'iid':iid}).count)
+        self.assertEqual(res, 3)
+        res = yield motor.Op(app.mongodb.instances.find_one, {'_id':iid})
+        self.assertTrue(res.get('unstoredtimers'))
+
+        # The one-shot event's id goes along with its timerevent command,
+        # which deletes it after running.
+        app.ioloop.run_until(1006)
+        self.assertEqual(app.commands, [
+            {'cmd':'timerevent', 'iid':iid, 'funcs':['once'], 'dbids':[timer1.dbid]} ])
+
+        # Pretend the server restarted. The stored events come back.
+        app.ipool = two.ipool.InstancePool(app)
+        app.ipool.notify_instance(iid)
+        res = yield app.ipool.load_timer_events(iid)
+        self.assertEqual(res, 3)
+        inst = app.ipool.get(iid)
+        # The tuple cancel key came back as a list, but still works.
+        ls = inst.remove_timer_events(cancel=('door', 1))
+        self.assertEqual([ timer.dbid for timer in ls ], [doortimer.dbid])
+        yield app.ipool.unstore_timer_events(ls)
+        ls = inst.remove_timer_events(cancel='key')
+        self.assertEqual([ timer.func for timer in ls ], [{'type':'code', 'text':'rep'}])
+        self.assertEqual(ls[0].dbid, timer2.dbid)
+        self.assertTrue(ls[0].repeat)
+        yield app.ipool.unstore_timer_events(ls)
+        res = yield motor.Op(app.mongodb.schedevents.find({'iid':iid}).count)
+        self.assertEqual(res, 1)
+
+        app.ipool.remove_instance(iid)
+        yield app.ipool.unstore_instance_timers(iid)
+        res = yield motor.Op(app.mongodb.schedevents.find({'iid':iid}).count)
+        self.assertEqual(res, 0)
+        res = yield motor.Op(app.mongodb.instances.find_one, {'_id':iid})
+        self.assertNotIn('unstoredtimers', res)
+        yield motor.Op(app.mongodb.instances.remove, {'_id':iid})
+
+    @tornado.testing.gen_test
+    def test_restart_repeating(self):
+        app = self.timerapp
+        yield motor.Op(app.mongodb.schedevents.remove, {})
+        iid = ObjectId()
+        app.ipool.notify_instance(iid)
+        inst = app.ipool.get(iid)
+        timer = inst.add_timer_event(sec(10), 'rep', repeat=True)
+        yield app.ipool.store_timer_event(timer)
+        app.ipool.remove_instance(iid)
+
+        # Say the event was first due 25 seconds ago; so it last came
+        # due 5 seconds ago.
+        nowdt = twcommon.misc.now()
+        yield motor.Op(app.mongodb.schedevents.update,
+                       {'_id':timer.dbid},
+                       {'$set':{'due':nowdt-sec(25)}})
+
+        # The server was running after that, so the event fired. It
+        # waits for its next period.
+        app.ipool = two.ipool.InstancePool(app)
+        app.ipool.notify_instance(iid)
+        yield app.ipool.load_timer_events(iid, nowdt-sec(2))
+        app.ioloop.run_until(app.ioloop.now+3)
+        self.assertEqual(app.queued, [])
+        app.ioloop.run_until(app.ioloop.now+3)
+        self.assertEqual(len(app.queued), 1)
+        app.ipool.remove_instance(iid)
+
+        # The server went down before then, so the event missed a
+        # firing. It fires right away.
+        app.queued.clear()
+        app.ipool = two.ipool.InstancePool(app)
+        app.ipool.notify_instance(iid)
+        yield app.ipool.load_timer_events(iid, nowdt-sec(8))
+        app.ioloop.run_until(app.ioloop.now+1)
+        self.assertEqual(len(app.queued), 1)
+        app.ipool.remove_instance(iid)
+        yield app.ipool.unstore_instance_timers(iid)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+"""
+To run:   python3 -m tornado.testing twest.test_playconn
+(The twest, two, twcommon modules must be in your PYTHON_PATH.)
+"""
+
+import logging
+import unittest
+
+from bson.objectid import ObjectId
+
+import two.playconn
+from two.task import DIRTY_LOCALE, DIRTY_POPULACE, DIRTY_FOCUS, DIRTY_TOOL
+
+class MockApp:
+    def __init__(self):
+        self.log = logging.getLogger('tworld')
+
+class MockStream:
+    twwcid = 1
+
+class TestPlayConn(unittest.TestCase):
+
+    def test_depindex(self):
+        table = two.playconn.PlayerConnectionTable(MockApp())
+        stream = MockStream()
+        conn1 = table.add(1, str(ObjectId()), 'one@example.com', stream)
+        conn2 = table.add(2, str(ObjectId()), 'two@example.com', stream)
+
+        key1 = ('instanceprop', 'iid', 'desc')
+        key2 = ('populace', 'iid', 'locid')
+        key3 = ('worldprop', 'wid', 'name')
+
+        self.assertEqual(table.dirty_for_changes(set([key1, key2])), {})
+
+        conn1.localedependencies.update([key1, key3])
+        conn1.focusdependencies.add(key1)
+        conn1.populacedependencies.add(key2)
+        conn2.populacedependencies.add(key2)
+        conn2.tooldependencies.add(key3)
+
+        self.assertEqual(table.dirty_for_changes(set([key1])),
+                         {1: DIRTY_LOCALE|DIRTY_FOCUS})
+        self.assertEqual(table.dirty_for_changes(set([key2])),
+                         {1: DIRTY_POPULACE, 2: DIRTY_POPULACE})
+        self.assertEqual(table.dirty_for_changes(set([key1, key3])),
+                         {1: DIRTY_LOCALE|DIRTY_FOCUS, 2: DIRTY_TOOL})
+        self.assertEqual(table.dirty_for_changes(set([('other',)])), {})
+
+        conn1.localedependencies.clear()
+        self.assertEqual(table.dirty_for_changes(set([key1, key3])),
+                         {1: DIRTY_FOCUS, 2: DIRTY_TOOL})
+        conn1.focusdependencies.discard(key1)
+        self.assertNotIn(key1, table.depindex)
+
+        table.remove(2)
+        self.assertEqual(table.dirty_for_changes(set([key2, key3])),
+                         {1: DIRTY_POPULACE})
+        table.remove(1)
+        self.assertEqual(table.depindex, {})
@@ -204,8 +204,11 @@ class TestPropcache(twest.mock.MockAppTestCase):
         res = yield cache.get(instq('ls'))
         self.assertFalse(res.haschanged())
 
+        # Script code reports in-place changes to the cache; we have
+        # to do it by hand here.
         ls = res.val
         ls.append(4)
+        cache.note_mutation(ls)
         
         self.assertFalse(res.dirty)
         self.assertTrue(res.haschanged())
@@ -234,7 +237,9 @@ class TestPropcache(twest.mock.MockAppTestCase):
         self.assertTrue(cache.get_by_object(map) is res)
 
         ls[0] = 'zero'
+        cache.note_mutation(ls)
         map['zero'] = 'ZERO'
+        cache.note_mutation(map)
 
         self.assertTrue(cache.get_by_object(map) is res)
         self.assertEqual(len(cache.note_changed_entries()), 2)
@@ -255,8 +260,10 @@ class TestPropcache(twest.mock.MockAppTestCase):
         self.assertEqual(res, {'one':1, 'two':2, 'three':3, 'zero':'ZERO'})
         
         map['tt'] = 44
+        cache.note_mutation(map)
         yield cache.set(instq('map'), {'tt':33})
         map['tt'] = 55
+        cache.note_mutation(map)
 
         self.assertEqual(cache.note_changed_entries(), []) ####
         self.assertEqual(len(cache.dirty_entries()), 1)
@@ -272,6 +279,73 @@ class TestPropcache(twest.mock.MockAppTestCase):
         res = yield self.get_db_prop(instq('map'))
         self.assertEqual(res, {'tt':33})
         
+    @tornado.testing.gen_test
+    def test_nested_mutation(self):
+        yield self.resetTables()
+        
+        # Fresh propcache for each test (don't use app.propcache).
+        cache = two.propcache.PropCache(self.app)
+
+        instq = lambda key: ('instanceprop', self.exiid, self.exlocid, key)
+
+        inner = [1, 2]
+        yield cache.set(instq('nest'), {'ls':inner, 'map':{'x':[]}})
+        yield cache.write_all_dirty()
+        self.assertEqual(cache.dirty_entries(), [])
+
+        # The stored value is a copy; find the inner list through it.
+        res = yield cache.get(instq('nest'))
+        inner = res.val['ls']
+        inner.append(3)
+        cache.note_mutation(inner)
+        self.assertTrue(res.haschanged())
+        self.assertEqual(len(cache.note_changed_entries()), 1)
+        yield cache.write_all_dirty()
+        self.assertFalse(res.haschanged())
+
+        res = yield self.get_db_prop(instq('nest'))
+        self.assertEqual(res, {'ls':[1,2,3], 'map':{'x':[]}})
+
+        # Mutating an unrelated container does nothing.
+        cache.note_mutation([1, 2, 3])
+        self.assertEqual(cache.note_changed_entries(), [])
+        
+    @tornado.testing.gen_test
+    def test_write_back(self):
+        yield self.resetTables()
+        
+        # Fresh propcache for each test (don't use app.propcache).
+        cache = two.propcache.PropCache(self.app)
+        flushes = two.propcache.write_stats.flushes
+
+        instq = lambda key: ('instanceprop', self.exiid, self.exlocid, key)
+
+        # One bad value shouldn't stop the other writes.
+        res = yield cache.get(instq('ls'))
+        res.val.append(object())
+        cache.note_mutation(res.val)
+        yield cache.set(instq('y'), 12)
+        yield cache.set(instq('new'), 'new')
+        yield cache.delete(instq('x'))
+        yield cache.delete(instq('true'))
+
+        self.assertEqual(len(cache.note_changed_entries()), 1)
+        self.assertEqual(len(cache.dirty_entries()), 5)
+        yield cache.write_all_dirty()
+        self.assertEqual([ ent.tup for ent in cache.dirty_entries() ], [instq('ls')])
+        self.assertEqual(two.propcache.write_stats.flushes, flushes+1)
+
+        res = yield self.get_db_prop(instq('ls'))
+        self.assertEqual(res, [1,2,3])
+        res = yield self.get_db_prop(instq('y'))
+        self.assertEqual(res, 12)
+        res = yield self.get_db_prop(instq('new'))
+        self.assertEqual(res, 'new')
+        res = yield self.get_db_prop(instq('x'))
+        self.assertEqual(res, NotFound)
+        res = yield self.get_db_prop(instq('true'))
+        self.assertEqual(res, NotFound)
+        
     @tornado.testing.gen_test
     def test_prop_aliasing(self):
         yield self.resetTables()
@@ -361,8 +435,123 @@ class TestPropcache(twest.mock.MockAppTestCase):
         self.assertEqual(res.val, {'one':1})
         res = yield cache.get(instq('map2'))
         self.assertEqual(res.val, {'one':1})
-        
-        
+
+    @tornado.testing.gen_test
+    def test_persistent(self):
+        yield self.resetTables()
+
+        # Fresh propcache for each test (don't use app.propcache).
+        cache = two.propcache.PropCache(self.app, limit=3)
+
+        instq = lambda key: ('instanceprop', self.exiid, self.exlocid, key)
+
+        res = yield cache.get(instq('x'))
+        res = yield cache.get(instq('y'))
+        res = yield cache.get(instq('true'))
+        res = yield cache.get(instq('ls'))
+        res = yield cache.get(instq('x'))
+        cache.finish_task()
+
+        # 'y' was least recently used.
+        self.assertEqual(len(cache.propmap), 3)
+        self.assertFalse(instq('y') in cache.propmap)
+        self.assertTrue(instq('x') in cache.propmap)
+
+        # A change behind the cache's back is invisible until invalidated.
+        yield motor.Op(self.app.mongodb.instanceprop.update,
+                       {'iid':self.exiid, 'locid':self.exlocid, 'key':'x'},
+                       {'$set':{'val':11}})
+        res = yield cache.get(instq('x'))
+        self.assertEqual(res.val, 1)
+        cache.invalidate(instq('x'))
+        res = yield cache.get(instq('x'))
+        self.assertEqual(res.val, 11)
+
+        # Dirty entries survive invalidation.
+        yield cache.set(instq('true'), False)
+        cache.invalidate(instq('true'))
+        res = yield cache.get(instq('true'))
+        self.assertEqual(res.val, False)
+        yield cache.write_all_dirty()
+
+        # A mutation which was never noted leaves an entry we can't trust.
+        res = yield cache.get(instq('ls'))
+        res.val.append(4)
+        cache.finish_task()
+        self.assertFalse(instq('ls') in cache.propmap)
+        res = yield cache.get(instq('ls'))
+        self.assertEqual(res.val, [1,2,3])
+
+        cache.invalidate_instance(self.exiid)
+        self.assertEqual(len(cache.propmap), 0)
+
+    @tornado.testing.gen_test
+    def test_prefetch(self):
+        yield self.resetTables()
+
+        # Fresh propcache for each test (don't use app.propcache).
+        cache = two.propcache.PropCache(self.app)
+        deps = set()
+
+        instq = lambda key: ('instanceprop', self.exiid, self.exlocid, key)
+        realmq = lambda key: ('instanceprop', self.exiid, None, key)
+        worldq = lambda key: ('worldprop', self.exwid, None, key)
+
+        yield cache.set(instq('y'), 7)
+        yield cache.prefetch([instq('x'), instq('y'), instq('ls'), instq('qqq'),
+                              realmq('x'), worldq('x')])
+        self.assertEqual(len(cache.propmap), 6)
+        self.assertEqual(cache.propmap[instq('x')].val, 1)
+        self.assertFalse(cache.propmap[instq('qqq')].found)
+        self.assertFalse(cache.propmap[realmq('x')].found)
+        self.assertFalse(cache.propmap[worldq('x')].found)
+        self.assertEqual(deps, set())
+
+        # The dirty entry was not overwritten.
+        res = yield cache.get(instq('y'), dependencies=deps)
+        self.assertEqual(res.val, 7)
+        self.assertTrue(res.dirty)
+
+        # Prefetched values behave as if get() had loaded them.
+        res = yield cache.get(instq('ls'), dependencies=deps)
+        self.assertEqual(res.val, [1,2,3])
+        self.assertTrue(cache.get_by_object(res.val) is res)
+        res = yield cache.get(instq('qqq'), dependencies=deps)
+        self.assertTrue(res is None)
+        self.assertEqual(deps, set([instq('y'), instq('ls'), instq('qqq')]))
+
+        # Prefetched not-found entries are trusted, even if the database
+        # changes. (Just like get().)
+        yield motor.Op(self.app.mongodb.instanceprop.insert,
+                       {'iid':self.exiid, 'locid':None,
+                        'key':'x', 'val':5})
+        res = yield cache.get(realmq('x'))
+        self.assertTrue(res is None)
+
+    @tornado.testing.gen_test
+    def test_load_location(self):
+        yield self.resetTables()
+
+        # Fresh propcache for each test (don't use app.propcache).
+        cache = two.propcache.PropCache(self.app)
+
+        instq = lambda key: ('instanceprop', self.exiid, self.exlocid, key)
+
+        count = yield cache.load_location(self.exwid, self.exiid, None, 100000)
+        self.assertEqual(count, 0)
+        count = yield cache.load_location(self.exwid, self.exiid, self.exlocid, 100000)
+        self.assertEqual(count, 5)
+        res = yield cache.get(instq('ls'))
+        self.assertEqual(res.val, [1,2,3])
+        self.assertTrue(cache.get_by_object(res.val) is res)
+
+        # A tiny budget loads nothing.
+        cache = two.propcache.PropCache(self.app)
+        count = yield cache.load_location(self.exwid, self.exiid, self.exlocid, 10)
+        self.assertEqual(count, 0)
+        self.assertEqual(len(cache.propmap), 0)
+
+
 class TestCheckWritable(unittest.TestCase):
     def test_checkwritable(self):
         checkwritable = two.propcache.checkwritable
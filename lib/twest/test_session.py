@@ -0,0 +1,81 @@
+"""
+To run:   python3 -m tornado.testing twest.test_session
+(The twest, tweblib, twcommon modules must be in your PYTHON_PATH.)
+"""
+
+import types
+import datetime
+import unittest
+
+import tweblib.session
+
+class TestSessionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.opts = types.SimpleNamespace(session_cache_ttl=60)
+        app = types.SimpleNamespace(twopts=self.opts)
+        self.mgr = tweblib.session.SessionMgr(app)
+
+    def test_cache(self):
+        mgr = self.mgr
+        sess = {'sid':b'abc', 'email':'x@example.com'}
+        self.assertIsNone(mgr.get_cached_session(b'abc'))
+        mgr.cache_session(b'abc', sess)
+        self.assertIs(mgr.get_cached_session(b'abc'), sess)
+        self.assertIs(mgr.get_cached_session(b'abc'), sess)
+        self.assertIsNone(mgr.get_cached_session(b'def'))
+        stats = mgr.cache_stats()
+        self.assertEqual((stats['size'], stats['hits'], stats['misses']), (1, 2, 2))
+        self.assertEqual(stats['hitrate'], 50.0)
+
+        mgr.invalidate_session(b'abc')
+        mgr.invalidate_session(b'abc')
+        self.assertIsNone(mgr.get_cached_session(b'abc'))
+        self.assertEqual(mgr.cache_stats()['invalidations'], 1)
+
+    def test_expire(self):
+        mgr = self.mgr
+        mgr.cache_session(b'abc', {'sid':b'abc'})
+        # Pretend the entry was made long ago.
+        (expiretime, sess) = mgr.cache[b'abc']
+        mgr.cache[b'abc'] = (expiretime-100, sess)
+        self.assertIsNone(mgr.get_cached_session(b'abc'))
+        self.assertEqual(len(mgr.cache), 0)
+
+        # The oldest entries go when the cache is full.
+        mgr.CACHE_LIMIT = 3
+        for ix in range(5):
+            mgr.cache_session(ix, {'sid':ix})
+        self.assertEqual(list(mgr.cache.keys()), [2, 3, 4])
+
+        # A TTL of zero turns the cache off.
+        self.opts.session_cache_ttl = 0
+        mgr.cache_session(b'abc', {'sid':b'abc'})
+        self.assertNotIn(b'abc', mgr.cache)
+        self.assertIsNone(mgr.get_cached_session(2))
+
+    def test_invalidate_expired(self):
+        mgr = self.mgr
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cutoff = now - datetime.timedelta(days=8)
+        mgr.cache_session(b'old', {'sid':b'old', 'refreshtime':now-datetime.timedelta(days=9)})
+        mgr.cache_session(b'new', {'sid':b'new', 'refreshtime':now})
+        mgr.invalidate_expired(cutoff)
+        self.assertIsNone(mgr.get_cached_session(b'old'))
+        self.assertIsNotNone(mgr.get_cached_session(b'new'))
+
+    def test_broadcast(self):
+        mgr = self.mgr
+        written = []
+        class MockServerMgr:
+            def tworld_write(self, connid, msg, shard=None):
+                written.append( (connid, msg, shard) )
+        mgr.app.twservermgr = MockServerMgr()
+        mgr.cache_session(b'abc', {'sid':b'abc'})
+        mgr.broadcast_invalidation(b'abc')
+        self.assertIsNone(mgr.get_cached_session(b'abc'))
+        self.assertEqual(written, [ (0, {'cmd':'notifysessionremoved', 'sid':'abc'}, 0) ])
+
+
+if __name__ == '__main__':
+    unittest.main()
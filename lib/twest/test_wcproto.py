@@ -0,0 +1,132 @@
+"""
+To run:   python3 -m tornado.testing twest.test_wcproto
+(The twest, two, twcommon modules must be in your PYTHON_PATH.)
+"""
+
+import struct
+import unittest
+
+from bson.objectid import ObjectId
+
+from twcommon import wcproto
+
+class TestWCProto(unittest.TestCase):
+
+    def test_check_buffer(self):
+        buf = bytearray()
+        buf.extend(wcproto.message(0, {'cmd':'connectok'}))
+        buf.extend(wcproto.message(5, '{"cmd":"say"}', alreadyjson=True))
+        self.assertEqual(wcproto.check_buffer(buf), (0, b'{"cmd": "connectok"}', {'cmd':'connectok'}))
+        (connid, raw, obj) = wcproto.check_buffer(buf, namespace=True)
+        self.assertEqual((connid, obj.cmd), (5, 'say'))
+        self.assertEqual(len(buf), 0)
+        self.assertEqual(wcproto.check_buffer(buf), None)
+
+    def test_reader(self):
+        msgs = [ wcproto.message(ix, {'cmd':'ping', 'ix':ix}) for ix in range(20) ]
+        dat = b''.join(msgs)
+
+        reader = wcproto.MessageReader()
+        res = []
+        # Feed the data in awkward chunks, so that headers and contents
+        # are split across feeds.
+        for pos in range(0, len(dat), 7):
+            reader.feed(dat[pos:pos+7])
+            while True:
+                tup = reader.check()
+                if not tup:
+                    break
+                res.append(tup)
+        self.assertEqual([ obj['ix'] for (connid, raw, obj) in res ], list(range(20)))
+        self.assertEqual([ connid for (connid, raw, obj) in res ], list(range(20)))
+        self.assertEqual(len(reader), 0)
+        # The consumed data is discarded on the next feed.
+        self.assertTrue(len(reader.buf) < len(dat))
+        reader.feed(b'')
+        self.assertEqual(len(reader.buf), 0)
+
+        # A burst all at once.
+        reader.feed(dat)
+        self.assertEqual(reader.read(), (0, msgs[0][wcproto.HEADER_LENGTH:]))
+        count = 1
+        while reader.read():
+            count += 1
+        self.assertEqual(count, 20)
+
+    def test_reader_malformed(self):
+        reader = wcproto.MessageReader()
+        bad = b'[1,2]'
+        reader.feed(struct.pack('<2I', len(bad), 0) + bad)
+        reader.feed(wcproto.message(0, {'cmd':'ok'}))
+        self.assertRaises(ValueError, reader.check)
+        (connid, raw, obj) = reader.check()
+        self.assertEqual(obj, {'cmd':'ok'})
+        self.assertEqual(reader.check(), None)
+
+    def test_versions(self):
+        oid = ObjectId()
+        obj = {'cmd':'notifydatachange', 'change':['worldprop', oid, None, 'desc']}
+
+        # Version 1 sends the ObjectId as a string.
+        reader = wcproto.MessageReader(namespace=True)
+        reader.feed(wcproto.message(0, obj))
+        (connid, raw, res) = reader.check()
+        self.assertEqual(res.change, ['worldprop', str(oid), None, 'desc'])
+
+        # Version 2 sends server messages as BSON.
+        reader = wcproto.MessageReader(version=wcproto.PROTOCOL_BSON, namespace=True)
+        dat = wcproto.message(0, obj, version=wcproto.PROTOCOL_BSON)
+        self.assertFalse(dat[wcproto.HEADER_LENGTH:].startswith(b'{'))
+        reader.feed(dat)
+        (connid, raw, res) = reader.check()
+        self.assertEqual(res.cmd, 'notifydatachange')
+        self.assertEqual(res.change, ['worldprop', oid, None, 'desc'])
+
+        # Nested objects become namespaces too.
+        reader.feed(wcproto.message(0, {'cmd':'connect', 'connections':[{'connid':3}]}, version=wcproto.PROTOCOL_BSON))
+        (connid, raw, res) = reader.check()
+        self.assertEqual(res.connections[0].connid, 3)
+
+        # Pre-encoded JSON is converted.
+        reader.feed(wcproto.message(0, '{"cmd":"holler"}', alreadyjson=True, version=wcproto.PROTOCOL_BSON))
+        (connid, raw, res) = reader.check()
+        self.assertEqual(res.cmd, 'holler')
+
+        # But player messages are still JSON.
+        dat = wcproto.message(7, {'cmd':'event', 'text':'Hi.'}, version=wcproto.PROTOCOL_BSON)
+        self.assertEqual(dat, wcproto.message(7, {'cmd':'event', 'text':'Hi.'}))
+        reader.feed(dat)
+        (connid, raw, res) = reader.check()
+        self.assertEqual((connid, raw, res.text), (7, b'{"cmd": "event", "text": "Hi."}', 'Hi.'))
+
+    def test_connids(self):
+        self.assertEqual(wcproto.make_connid(0, 5), 5)
+        connid = wcproto.make_connid(3, 5)
+        self.assertNotEqual(connid, 5)
+        self.assertEqual(wcproto.connid_node(connid), 3)
+        self.assertEqual(wcproto.connid_node(5), 0)
+        connid = wcproto.make_connid(wcproto.MAX_NODE, wcproto.CONNID_COUNTER_MAX)
+        self.assertEqual(connid, 0xFFFFFFFF)
+        self.assertEqual(wcproto.connid_node(connid), wcproto.MAX_NODE)
+        # Connids have to fit in the four-byte header field.
+        self.assertEqual(len(wcproto.message(connid, {})), wcproto.HEADER_LENGTH+2)
+        self.assertRaises(ValueError, wcproto.make_connid, wcproto.MAX_NODE+1, 1)
+
+    def test_shards(self):
+        wid = ObjectId('5200a3f46ab1ac0e3ca67d01')
+        uid = ObjectId('5200a3f46ab1ac0e3ca67d02')
+        scids = [ ObjectId() for ix in range(40) ]
+        # A single tworld owns everything.
+        self.assertEqual(wcproto.instance_shard(wid, scids[0], 1), 0)
+        self.assertEqual(wcproto.home_shard(uid, 1), 0)
+        # Otherwise, the answer is stable and in range.
+        ls = [ wcproto.instance_shard(wid, scid, 4) for scid in scids ]
+        self.assertEqual(ls, [ wcproto.instance_shard(wid, scid, 4) for scid in scids ])
+        self.assertTrue(all([ 0 <= val < 4 for val in ls ]))
+        self.assertTrue(len(set(ls)) > 1)
+        self.assertEqual(wcproto.home_shard(uid, 4), wcproto.home_shard(ObjectId(str(uid)), 4))
+        self.assertTrue(0 <= wcproto.home_shard(uid, 4) < 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+"""
+To run:   python3 -m tornado.testing twest.test_webconn
+(The twest, two, twcommon modules must be in your PYTHON_PATH.)
+"""
+
+import types
+import logging
+import socket
+import unittest
+import unittest.mock
+
+import tornado.iostream
+import tornado.testing
+
+import two.webconn
+
+class MockApp:
+    def __init__(self, limit):
+        self.log = logging.getLogger('tworld')
+        self.opts = types.SimpleNamespace(write_coalesce_limit=limit)
+        self.runningtasks = {}
+
+class TestCoalesce(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.app = MockApp(100)
+        self.table = two.webconn.WebConnectionTable(self.app)
+        (sock, self.othersock) = socket.socketpair()
+        sock.setblocking(0)
+        self.stream = two.webconn.WebConnIOStream(self.table, sock, 'localhost')
+        self.table.map[self.stream.twwcid] = self.stream
+        # Record what reaches the socket, rather than sending it.
+        patcher = unittest.mock.patch.object(tornado.iostream.IOStream, 'write', autospec=True)
+        self.rawwrite = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.table.map.clear()
+        self.stream.close()
+        self.othersock.close()
+        super().tearDown()
+
+    def written(self):
+        return [ call[0][1] for call in self.rawwrite.call_args_list ]
+
+    def test_task_buffering(self):
+        stream = self.stream
+        # Writes during a task are held until flush_all.
+        self.app.runningtasks['task'] = None
+        stream.write(b'abc')
+        stream.write(b'def')
+        self.assertEqual(self.written(), [])
+        self.assertEqual(stream.twoutlen, 6)
+        self.table.flush_all()
+        self.assertEqual(self.written(), [b'abcdef'])
+        self.assertEqual(stream.twoutbuf, [])
+
+        # Nothing held, nothing written.
+        self.table.flush_all()
+        self.assertEqual(self.written(), [b'abcdef'])
+
+    def test_threshold(self):
+        stream = self.stream
+        self.app.runningtasks['task'] = None
+        stream.write(b'x' * 60)
+        self.assertEqual(self.written(), [])
+        # Passing the limit sends the lot.
+        stream.write(b'y' * 60)
+        self.assertEqual(self.written(), [b'x' * 60 + b'y' * 60])
+        self.assertEqual(stream.twoutlen, 0)
+        stream.write(b'z')
+        self.assertEqual(len(self.written()), 1)
+        self.table.flush_all()
+        self.assertEqual(self.written()[1:], [b'z'])
+
+    def test_outside_task(self):
+        stream = self.stream
+        # With no task running, writes go out immediately.
+        stream.write(b'abc')
+        self.assertEqual(self.written(), [b'abc'])
+
+        # Anything already held goes out first.
+        self.app.runningtasks['task'] = None
+        stream.write(b'def')
+        self.app.runningtasks.clear()
+        stream.write(b'ghi')
+        self.assertEqual(self.written(), [b'abc', b'def', b'ghi'])
+
+        # A limit of zero turns coalescing off.
+        self.app.opts.write_coalesce_limit = 0
+        self.app.runningtasks['task'] = None
+        stream.write(b'jkl')
+        self.assertEqual(self.written()[-1], b'jkl')
+
+
+if __name__ == '__main__':
+    unittest.main()
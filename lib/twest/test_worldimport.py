@@ -0,0 +1,126 @@
+"""
+To run:   python3 -m tornado.testing twest.test_worldimport
+(The twest, two, twcommon modules must be in your PYTHON_PATH.)
+"""
+
+import datetime
+import unittest
+
+from bson.objectid import ObjectId
+
+import twcommon.worldimport
+from twcommon.worldimport import ImportWorld, read_export, plan_import
+
+class TestWorldImport(unittest.TestCase):
+
+    def test_read_export(self):
+        obj = {
+            'name': 'Test',
+            'realmprops': [ {'key':'x', 'val':1},
+                            {'key':'when', 'val':{'type':'datetime', 'value':'2013-09-05 12:30:00'}} ],
+            'playerprops': [ {'key':'score', 'val':0} ],
+            'locations': [
+                {'key':'start', 'name':'Start',
+                 'props':[ {'key':'desc', 'val':{'type':'text', 'text':'Hi.'}} ]},
+                {'key':'end', 'name':'End'},
+                ],
+            'portlists': [ {'key':'pl'} ],
+            }
+        world = read_export(obj)
+        self.assertEqual(world.name, 'Test')
+        self.assertEqual(world.realmprops['x'], 1)
+        when = world.realmprops['when']
+        self.assertEqual((when.year, when.month, when.hour, when.minute), (2013, 9, 12, 30))
+        self.assertEqual(list(world.locations), ['start', 'end'])
+        self.assertEqual(world.locations['start'].props['desc'], {'type':'text', 'text':'Hi.'})
+        self.assertEqual(world.propcount(), 4)
+        self.assertEqual(world.warnings, ['Portlists are not imported.'])
+        self.assertEqual(world.check(), [])
+
+        self.assertRaises(ValueError, read_export, [])
+        self.assertRaises(ValueError, read_export, {'locations':[{'props':[]}]})
+        self.assertRaises(ValueError, read_export, {'locations':[], 'realmprops':[{'key':'x'}]})
+
+        world.realmprops['bad key'] = 1
+        world.add_location('Bad Loc')
+        self.assertEqual(len(world.check()), 2)
+
+    def test_plan(self):
+        wid = ObjectId()
+        locid = ObjectId()
+        dblocs = [ {'_id':locid, 'wid':wid, 'key':'start', 'name':'Old Start'},
+                   {'_id':ObjectId(), 'wid':wid, 'key':'gone', 'name':'Gone'} ]
+        dbprops = [
+            {'_id':ObjectId(), 'wid':wid, 'locid':None, 'key':'same', 'val':1},
+            {'_id':ObjectId(), 'wid':wid, 'locid':None, 'key':'diff', 'val':1},
+            {'_id':ObjectId(), 'wid':wid, 'locid':locid, 'key':'extra', 'val':3},
+            ]
+        dbplayerprops = [
+            {'_id':ObjectId(), 'wid':wid, 'uid':None, 'key':'score', 'val':0},
+            ]
+
+        world = ImportWorld()
+        world.realmprops['same'] = 1
+        world.realmprops['diff'] = 2
+        world.playerprops['score'] = 0
+        loc = world.add_location('start', 'Start')
+        loc.props['desc'] = 'Hi.'
+        loc = world.add_location('new', 'New')
+        loc.props['desc'] = 'Bye.'
+
+        plan = plan_import(world, wid, dblocs, dbprops, dbplayerprops)
+        self.assertEqual([ loc['key'] for loc in plan.newlocs ], ['new'])
+        newlocid = plan.newlocs[0]['_id']
+        self.assertEqual(plan.renamelocs, [ (locid, 'Start') ])
+        self.assertEqual(plan.extralocs, ['gone'])
+        self.assertEqual(plan.unchanged, 2)
+        self.assertEqual(plan.updates['worldprop'], [ (dbprops[1]['_id'], 2) ])
+        self.assertEqual(sorted([ (prop['locid'], prop['key']) for prop in plan.inserts['worldprop'] ], key=str),
+                         sorted([ (locid, 'desc'), (newlocid, 'desc') ], key=str))
+        self.assertEqual(plan.removes['worldprop'], [])
+        self.assertEqual(plan.trash, [])
+        self.assertFalse(plan.is_empty())
+        self.assertEqual(len(plan.changes), 3)
+        self.assertIn( ('worldprop', wid, None, 'diff'), plan.changes )
+
+        # With prune and trash, the extra property goes, and the old
+        # values are saved.
+        plan = plan_import(world, wid, dblocs, dbprops, dbplayerprops, prune=True, trash=True)
+        self.assertEqual(plan.removes['worldprop'], [ dbprops[2]['_id'] ])
+        self.assertEqual([ (prop['key'], prop['val'], prop['origtype']) for prop in plan.trash ],
+                         [ ('diff', 1, 'worldprop'), ('extra', 3, 'worldprop') ])
+        self.assertTrue(isinstance(plan.trash[0]['changed'], datetime.datetime))
+
+        # Importing what's already there changes nothing.
+        world = ImportWorld()
+        world.realmprops['same'] = 1
+        world.add_location('start', 'Old Start')
+        plan = plan_import(world, wid, dblocs, dbprops[0:1], [])
+        self.assertTrue(plan.is_empty())
+        self.assertEqual(plan.changes, [])
+
+    def test_steps(self):
+        wid = ObjectId()
+        world = ImportWorld()
+        for ix in range(25):
+            loc = world.add_location('loc%d' % (ix,))
+            for jx in range(4):
+                loc.props['p%d' % (jx,)] = jx
+        plan = plan_import(world, wid, [], [], [])
+        steps = list(plan.steps(batchsize=10))
+        self.assertEqual([ step.label for step in steps ], [
+            'Created locations (10/25)', 'Created locations (20/25)',
+            'Created locations (25/25)',
+            'Added realm and location properties (10/100)', ] + [
+            'Added realm and location properties (%d/100)' % (val,) for val in range(20, 101, 10) ])
+        # Locations come first, since properties refer to them.
+        (coll, method, args) = steps[0].ops[0]
+        self.assertEqual((coll, method, len(args[0])), ('locations', 'insert', 10))
+        (coll, method, args) = steps[-1].ops[0]
+        self.assertEqual((coll, method, len(args[0])), ('worldprop', 'insert', 10))
+        locids = set([ loc['_id'] for loc in plan.newlocs ])
+        self.assertTrue(all([ prop['locid'] in locids for prop in plan.inserts['worldprop'] ]))
+
+
+if __name__ == '__main__':
+    unittest.main()
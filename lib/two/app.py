@@ -3,9 +3,12 @@ import sys
 import datetime
 import logging
 import signal
+import functools
+import contextlib
 
 import tornado.ioloop
 import tornado.gen
+import tornado.stack_context
 
 import motor
 
@@ -45,12 +48,34 @@ class Tworld(object):
         self.mongomgr = two.mongomgr.MongoMgr(self)
         self.ipool = two.ipool.InstancePool(self)
 
-        # The command queue.
+        # The command queue. Up to command_concurrency tasks may be
+        # running at once, as long as their lanes don't overlap. (See
+        # task_lanes.) runningtasks maps each running task to its
+        # propcache.
         self.queue = []
-        self.commandbusy = False
+        self.runningtasks = {}
+        self.busylanes = set()
+        self.exclusivebusy = False
+        self.pumppending = False
+
+        # The property caches. Each running task has its own; while a
+        # task is running, self.propcache is its cache. (See
+        # task_context.) If propcache_limit is set, caches live for the
+        # whole process, and idle ones wait in propcachepool. Otherwise,
+        # start_task creates a fresh one for each task.
+        self.propcache = None
+        self.propcachepool = []
+
+        # Sharding. If tworld_shards is more than one, this is one of
+        # several tworld processes, and it only runs the instances which
+        # wcproto.instance_shard assigns to it. Players are handed off
+        # between shards as they move. (See handoff_player.)
+        self.shard = opts.tworld_shard
+        self.shardcount = max(1, opts.tworld_shards)
+        if not (0 <= self.shard < self.shardcount):
+            raise Exception('tworld_shard must be between 0 and %d' % (self.shardcount-1,))
 
         # Miscellaneous.
-        self.propcache = None
         self.caughtinterrupt = False
         self.shuttingdown = False
         self.debugstacktraces = opts.show_stack_traces
@@ -166,8 +191,9 @@ class Tworld(object):
         is therefore unreliable; if tworld shuts down before the command
         runs, it will be lost.
         """
-        self.ioloop.add_timeout(datetime.timedelta(seconds=delay),
-                                lambda:self.queue_command(obj))
+        with tornado.stack_context.NullContext():
+            self.ioloop.add_timeout(datetime.timedelta(seconds=delay),
+                                    lambda:self.queue_command(obj))
 
     def queue_command(self, obj, connid=0, twwcid=0):
         if self.shuttingdown:
@@ -178,29 +204,193 @@ class Tworld(object):
         # If this command was caused by a message from tweb, twwcid is
         # its ID number. We will rarely need this.
         self.queue.append( (obj, connid, twwcid, twcommon.misc.now()) )
-        
-        if not self.commandbusy:
-            self.ioloop.add_callback(self.pop_queue)
+        self.schedule_pump()
 
-    @tornado.gen.coroutine
-    def pop_queue(self):
-        if self.commandbusy:
-            self.log.warning('pop_queue called when already busy!')
+    def schedule_pump(self):
+        """Arrange for pump_queue to be called soon (once, no matter how
+        many times this is called in the meantime).
+        """
+        if self.pumppending:
             return
+        self.pumppending = True
+        # The pump must not inherit the context of whatever task is
+        # calling us.
+        with tornado.stack_context.NullContext():
+            self.ioloop.add_callback(self.pump_queue)
+
+    def owns_instance(self, wid, scid):
+        """Does this shard run the instance of world wid in scope scid?
+        """
+        return wcproto.instance_shard(wid, scid, self.shardcount) == self.shard
 
-        if not self.queue:
-            self.log.warning('pop_queue called when already empty!')
+    @tornado.gen.coroutine
+    def instance_shard_for_iid(self, iid):
+        """Work out which shard runs the given instance. Returns None
+        if there is no such instance.
+        """
+        if self.shardcount <= 1 or self.ipool.get(iid):
+            return self.shard
+        instance = yield motor.Op(self.mongodb.instances.find_one,
+                                  {'_id':iid}, {'wid':1, 'scid':1})
+        if not instance:
+            return None
+        return wcproto.instance_shard(instance['wid'], instance['scid'], self.shardcount)
+
+    def relay_command(self, obj, shard=None):
+        """Pass a server command along to another shard (or, if shard is
+        None, to every other shard). Shards don't talk to each other
+        directly; a tweb forwards the message for us. If the shard is
+        this one, the command is just queued.
+        """
+        if shard == self.shard:
+            self.queue_command(obj)
             return
+        # One tweb is enough, or the command would arrive several times.
+        ls = self.webconns.all()
+        if not ls:
+            self.log.warning('Cannot relay command to shard %s, because no tweb is connected: %s', shard, obj)
+            return
+        stream = ls[0]
+        stream.write(wcproto.message(0, {'cmd':'relay', 'shard':shard, 'msg':obj}, version=stream.twversion))
 
-        (cmdobj, connid, twwcid, queuetime) = self.queue.pop(0)
-
+    def relay_data_changes(self, changeset):
+        """Tell the other shards about data changes made by a task, so
+        that they can drop stale cache entries and update their players.
+        Changes inside our own instances don't concern anybody else.
+        """
+        ls = []
+        for key in changeset:
+            if key[0] in ('instanceprop', 'iplayerprop', 'populace') and self.ipool.get(key[1]):
+                continue
+            ls.append(list(key))
+        if ls:
+            self.relay_command({'cmd':'notifydatachange', 'changes':ls})
+
+    def handoff_player(self, uid, shard):
+        """Send a player's connections to another shard. We drop them
+        here, and tell every tweb to reopen them there. (The playeropen
+        on the new shard will queue a portin, which takes it from there.)
+        """
+        self.log.info('Handing off player %s to shard %d', uid, shard)
+        for conn in self.playconns.get_for_uid(uid) or []:
+            self.playconns.remove(conn.connid, moved=True)
+        for stream in self.webconns.all():
+            stream.write(wcproto.message(0, {'cmd':'playermoved', 'uid':uid, 'shard':shard}, version=stream.twversion))
+
+    def task_lanes(self, cmdobj, connid):
+        """Work out which lanes a command needs. Two tasks can run at the
+        same time only if they have no lanes in common. Returns a set of
+        lanes, or None if the command must have the server to itself.
+
+        The lanes are ('iid', iid) for an instance, ('uid', uid) for a
+        player, and ('server',) for server housekeeping that doesn't
+        touch any instance. A task can take on more iid lanes while it
+        runs, if its scripts write into other instances. (See
+        Task.claim_lane.)
+        """
+        if self.opts.command_concurrency <= 1:
+            return None
+        cmd = self.all_commands.get(cmdobj.cmd, None)
+        if not cmd:
+            # It will fail soon enough; let it fail alone.
+            return None
+        if connid == 0:
+            if not cmd.isserver:
+                return None
+            if cmd.lane == 'server':
+                return set( [('server',)] )
+            if cmd.lane == 'iid':
+                return set( [('iid', cmdobj.iid)] )
+            if cmd.lane == 'conn':
+                connid = cmdobj.connid
+            else:
+                return None
+        conn = self.playconns.get(connid)
+        if not conn or not conn.iid:
+            # We don't know where the player is (or they're in the
+            # void). Be careful.
+            return None
+        return set( [('uid', conn.uid), ('iid', conn.iid)] )
+
+    def pump_queue(self):
+        """Start as many queued tasks as we can.
+
+        We go through the queue in order. A task can start if none of
+        its lanes are busy, and no earlier task in the queue is waiting
+        for them. (So tasks in the same lane always run in order.) A task
+        which needs the server to itself waits until everything ahead of
+        it has finished, and nothing behind it starts until it's done.
+        """
+        self.pumppending = False
+        if self.shuttingdown:
+            return
+        blocked = set()
+        ix = 0
+        while ix < len(self.queue):
+            if self.exclusivebusy:
+                break
+            if len(self.runningtasks) >= max(1, self.opts.command_concurrency):
+                break
+            (cmdobj, connid, twwcid, queuetime) = self.queue[ix]
+            lanes = self.task_lanes(cmdobj, connid)
+            if lanes is None:
+                if ix == 0 and not self.runningtasks:
+                    del self.queue[ix]
+                    self.exclusivebusy = True
+                    self.start_task(cmdobj, connid, twwcid, queuetime, None)
+                break
+            if lanes.isdisjoint(self.busylanes) and lanes.isdisjoint(blocked):
+                del self.queue[ix]
+                self.busylanes.update(lanes)
+                self.start_task(cmdobj, connid, twwcid, queuetime, lanes)
+                continue
+            blocked.update(lanes)
+            ix += 1
+
+    def start_task(self, cmdobj, connid, twwcid, queuetime, lanes):
+        """Set up a task, with its own property cache and context stack,
+        and start it running.
+        """
         task = two.task.Task(self, cmdobj, connid, twwcid, queuetime)
-        self.commandbusy = True
+        task.lanes = lanes
 
-        EvalPropContext.context_stack.clear()
+        if self.propcachepool:
+            propcache = self.propcachepool.pop()
+        else:
+            propcache = two.propcache.PropCache(self, limit=self.opts.propcache_limit)
+        self.runningtasks[task] = propcache
+
+        # The StackContext swaps the task's state in whenever the task
+        # is running.
+        stack = []
+        with tornado.stack_context.NullContext():
+            with tornado.stack_context.StackContext(functools.partial(self.task_context, propcache, stack)):
+                self.run_task(task, propcache, stack)
+
+    @contextlib.contextmanager
+    def task_context(self, propcache, stack):
+        """Context manager which makes the given propcache and context
+        stack current for its duration.
+        """
+        saved = self.propcache
+        self.propcache = propcache
+        try:
+            with EvalPropContext.swapped_context_stack(stack):
+                yield
+        finally:
+            self.propcache = saved
+
+    def all_propcaches(self):
+        """A list of all the property caches, in use or idle. Code which
+        changes properties behind the caches' backs must invalidate them
+        all.
+        """
+        return list(self.runningtasks.values()) + self.propcachepool
 
-        # Set up a property cache (only for the duration of the task).
-        self.propcache = two.propcache.PropCache(self)
+    @tornado.gen.coroutine
+    def run_task(self, task, propcache, stack):
+        cmdobj = task.cmdobj
+        queuetime = task.queuetime
 
         # Handle the command.
         try:
@@ -211,28 +401,53 @@ class Tworld(object):
         # Resolve all changes resulting from the command. We do this
         # in a separate try block, so that if the command died partway,
         # we still display the partial effects.
+        relaychanges = None
         if task.is_writable():
-            mutations = self.propcache.note_changed_entries()
+            mutations = propcache.note_changed_entries()
             if mutations:
                 task.set_data_changes(mutations)
+            if self.shardcount > 1 and task.relaychanges and task.changeset:
+                relaychanges = set(task.changeset)
             try:
                 task.resetticks()
                 yield task.resolve()
             except Exception as ex:
                 self.log.error('Error resolving task: %s', cmdobj, exc_info=True)
 
-        if EvalPropContext.context_stack:
-            self.log.error('EvalPropContext.context_stack has %d entries remaining at end of task!', len(EvalPropContext.context_stack))
+        if stack:
+            self.log.error('EvalPropContext.context_stack has %d entries remaining at end of task!', len(stack))
             
         task.resetticks()
 
-        # Write back any necessary property DB changes and drop the propcache.
+        # Send out the messages this task generated (and any that
+        # concurrent tasks have generated so far).
+        self.webconns.flush_all()
+
+        # Write back any necessary property DB changes. Other caches may
+        # have copies of what we wrote, so they drop them. Then drop our
+        # propcache, or trim it if it's long-lived.
         try:
-            yield self.propcache.write_all_dirty()
+            written = [ ent.tup for ent in propcache.dirty_entries() ]
+            yield propcache.write_all_dirty()
+            if written:
+                for othercache in self.all_propcaches():
+                    if othercache is not propcache:
+                        for tup in written:
+                            othercache.invalidate(tup)
         except Exception as ex:
             self.log.error('Error clearing propcache: %s', cmdobj, exc_info=True)
-        self.propcache.final()
-        self.propcache = None
+
+        # The other shards hear about our changes only now, so that they
+        # don't reload anything from the database before we've written it.
+        if relaychanges:
+            self.relay_data_changes(relaychanges)
+            self.webconns.flush_all()
+        del self.runningtasks[task]
+        if propcache.limit:
+            propcache.finish_task()
+            self.propcachepool.append(propcache)
+        else:
+            propcache.final()
         
         starttime = task.starttime
         endtime = twcommon.misc.now()
@@ -242,10 +457,12 @@ class Tworld(object):
                       task.maxcputicks,
                       task.totalcputicks)
 
-        self.commandbusy = False
+        if task.lanes is None:
+            self.exclusivebusy = False
+        else:
+            self.busylanes.difference_update(task.lanes)
         task.close()
 
         # Keep popping, if the queue is nonempty.
         if self.queue:
-            self.ioloop.add_callback(self.pop_queue)
-
+            self.schedule_pump()
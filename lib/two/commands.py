@@ -1,5 +1,6 @@
 
 import datetime
+import types
 import ast
 
 import tornado.gen
@@ -8,16 +9,24 @@ from bson.objectid import ObjectId
 import motor
 
 import twcommon.misc
+import twcommon.interp
+import twcommon.gentext
 import twcommon.localize
 from twcommon import wcproto
 from twcommon.excepts import MessageException, ErrorMessageException
 
+# The fields of relayed commands which hold ObjectIds. (See cmd_relayed.)
+relay_id_fields = {
+    'tovoid': ('uid', 'portto.wid', 'portto.scid', 'portto.locid'),
+    'sleepinstance': ('iid',),
+    }
+
 class Command:
     # As commands are defined with the @command decorator, they are stuffed
     # in this dict.
     all_commands = {}
 
-    def __init__(self, name, func, isserver=False, restrict=None, noneedmongo=False, preconnection=False, doeswrite=False):
+    def __init__(self, name, func, isserver=False, restrict=None, noneedmongo=False, preconnection=False, doeswrite=False, lane=None):
         self.name = name
         self.func = tornado.gen.coroutine(func)
         # isserver could be merged into restrict='server', since restrict
@@ -27,6 +36,11 @@ class Command:
         self.noneedmongo = noneedmongo
         self.preconnection = preconnection
         self.doeswrite = doeswrite
+        # What this command may run alongside, if the app runs commands
+        # concurrently. (See Tworld.task_lanes.) Player commands always
+        # run in their player's lanes. Server commands with no lane
+        # run alone.
+        self.lane = lane
         
     def __repr__(self):
         return '<Command "%s">' % (self.name,)
@@ -70,7 +84,7 @@ def define_commands():
         else:
             val = 'Server broadcast: Server is shutting down!'
         for stream in app.webconns.all():
-            stream.write(wcproto.message(0, {'cmd':'messageall', 'text':val}))
+            stream.write(wcproto.message(0, {'cmd':'messageall', 'text':val}, version=stream.twversion))
         # Bump the lastactive timestamp, if possible.
         try:
             yield motor.Op(app.mongodb.config.update,
@@ -137,6 +151,10 @@ def define_commands():
         iidls = list(inhabset.union(awakeset))
         iidls.sort()  # Just for consistency
         for iid in iidls:
+            shard = yield app.instance_shard_for_iid(iid)
+            if shard != app.shard:
+                # Another shard's instance; it will take care of it.
+                continue
             if iid not in inhabset:
                 # Instance should be asleep. We don't call the hook, just
                 # set lastawake to the lastactive time.
@@ -144,10 +162,27 @@ def define_commands():
                 yield motor.Op(app.mongodb.instances.update,
                                {'_id':iid},
                                {'$set':{'lastawake':lastactive}})
+                yield app.ipool.unstore_instance_timers(iid)
                 continue
             # Instance should be awake. Call the hook and set lastawake true.
             # The hook's _slept argument will be lastactive.
             awakening = app.ipool.notify_instance(iid)
+            if awakening and app.opts.persist_timers and iid in awakeset:
+                # It was awake when we went down, so its timer events
+                # were stored. It picks up where it left off, without
+                # an on_wake call -- unless some of its events couldn't
+                # be stored. Then it starts over.
+                instance = yield motor.Op(app.mongodb.instances.find_one,
+                                          {'_id':iid},
+                                          {'wid':1, 'unstoredtimers':1})
+                if not (instance and instance.get('unstoredtimers')):
+                    count = yield app.ipool.load_timer_events(iid, lastactive)
+                    app.log.info('Resuming instance %s (%d timer events)', iid, count)
+                    if instance:
+                        yield app.ipool.warm_up_instance(instance['wid'], iid)
+                    continue
+                app.log.warning('Instance %s had timer events which were not stored; waking it afresh', iid)
+                yield app.ipool.unstore_instance_timers(iid)
             if awakening:
                 app.log.info('Awakening instance %s (slept roughly %s)', iid, lastactive)
                 yield motor.Op(app.mongodb.instances.update,
@@ -155,6 +190,7 @@ def define_commands():
                                {'$set':{'lastawake':True}})
                 instance = yield motor.Op(app.mongodb.instances.find_one,
                                           {'_id':iid})
+                yield app.ipool.warm_up_instance(instance['wid'], iid)
                 loctx = two.task.LocContext(None, wid=instance['wid'], scid=instance['scid'], iid=iid)
                 task.resetticks()
                 yield two.execute.try_hook(task, 'on_wake', loctx, 'awakening instance',
@@ -200,11 +236,17 @@ def define_commands():
                 task.resetticks()
                 yield two.execute.try_hook(task, 'on_sleep', loctx, 'sleeping instance')
                 app.ipool.remove_instance(iid)
+                yield app.ipool.unstore_instance_timers(iid)
     
-    @command('sleepinstance', isserver=True)
+    @command('sleepinstance', isserver=True, lane='iid')
     def cmd_sleepinstance(app, task, cmd, stream):
         inst = app.ipool.get(cmd.iid)
         if not inst:
+            shard = yield app.instance_shard_for_iid(cmd.iid)
+            if shard is not None and shard != app.shard:
+                # Some other shard runs this instance.
+                app.relay_command({'cmd':'sleepinstance', 'iid':cmd.iid}, shard)
+                return
             task.log.warning('sleepinstance: instance is not awake (%s)', cmd.iid)
             return
         cursor = app.mongodb.playstate.find({'iid':cmd.iid},
@@ -223,16 +265,36 @@ def define_commands():
     @command('connect', isserver=True, noneedmongo=True)
     def cmd_connect(app, task, cmd, stream):
         assert stream is not None, 'Tweb connect command from no stream.'
-        stream.write(wcproto.message(0, {'cmd':'connectok'}))
+        # Each tweb has its own node number, which partitions the connids.
+        # Two twebs with the same number would trample each other's
+        # connections, so we refuse the second one.
+        node = getattr(cmd, 'node', 0)
+        other = app.webconns.get_for_node(node)
+        if other is not None and other is not stream:
+            app.log.error('Tweb connected with node number %d, which %s already has; closing it', node, other)
+            stream.close()
+            return
+        stream.twnode = node
+        
+        # Tweb may offer a newer protocol version. We reply in the old
+        # version; after that, both sides switch.
+        version = min(getattr(cmd, 'protocol', wcproto.PROTOCOL_JSON),
+                      wcproto.PROTOCOL_LATEST)
+        stream.write(wcproto.message(0, {'cmd':'connectok', 'protocol':version, 'shard':app.shard}))
+        stream.twsetversion(version)
+        app.log.info('Tweb connected as node %d with protocol version %d', node, version)
 
         # Accept any connections that tweb is holding.
         for connobj in cmd.connections:
             if not app.mongodb:
                 # Reject the players.
-                stream.write(wcproto.message(0, {'cmd':'playernotok', 'connid':connobj.connid, 'text':'The database is not available.'}))
+                stream.write(wcproto.message(0, {'cmd':'playernotok', 'connid':connobj.connid, 'text':'The database is not available.'}, version=stream.twversion))
+                continue
+            if wcproto.connid_node(connobj.connid) != node or app.playconns.get(connobj.connid):
+                stream.write(wcproto.message(0, {'cmd':'playernotok', 'connid':connobj.connid, 'text':'Connection ID is not valid for this tweb.'}, version=stream.twversion))
                 continue
             conn = app.playconns.add(connobj.connid, connobj.uid, connobj.email, stream)
-            stream.write(wcproto.message(0, {'cmd':'playerok', 'connid':conn.connid}))
+            stream.write(wcproto.message(0, {'cmd':'playerok', 'connid':conn.connid}, version=stream.twversion))
             app.queue_command({'cmd':'connrefreshall', 'connid':conn.connid})
             app.log.info('Player %s has reconnected (uid %s)', conn.email, conn.uid)
             # But don't queue a portin command, because people are no more
@@ -240,7 +302,7 @@ def define_commands():
         
         # Broadcast a message to the returned players.
         val = 'Server broadcast: Server has restarted!'
-        stream.write(wcproto.message(0, {'cmd':'messageall', 'text':val}))
+        stream.write(wcproto.message(0, {'cmd':'messageall', 'text':val}, version=stream.twversion))
 
     @command('disconnect', isserver=True, noneedmongo=True)
     def cmd_disconnect(app, task, cmd, stream):
@@ -252,7 +314,7 @@ def define_commands():
                     pass
         app.log.warning('Tweb has disconnected; now %d connections remain', len(app.playconns.as_dict()))
 
-    @command('checkdisconnected', isserver=True, doeswrite=True)
+    @command('checkdisconnected', isserver=True, doeswrite=True, lane='server')
     def cmd_checkdisconnected(app, task, cmd, stream):
         # Construct a list of players who are in the world, but
         # disconnected. (But disconnected more than a minute ago.)
@@ -261,9 +323,13 @@ def define_commands():
         recentcount = 0
         limit = datetime.timedelta(minutes=1)
         cursor = app.mongodb.playstate.find({'iid':{'$ne':None}},
-                                            {'_id':1})
+                                            {'_id':1, 'iid':1})
         while (yield cursor.fetch_next):
             playstate = cursor.next_object()
+            if app.shardcount > 1 and not app.ipool.get(playstate['iid']):
+                # Not in one of our instances, so their connections
+                # wouldn't be here anyway.
+                continue
             conncount = app.playconns.count_for_uid(playstate['_id'])
             inworld += 1
             if not conncount:
@@ -295,17 +361,44 @@ def define_commands():
             if not conncount:
                 ls.append(player)
         # cursor autoclose
+        if app.shardcount > 1:
+            # A guest's connections are on the shard that runs their
+            # instance, so we only judge guests in our own instances.
+            # Guests who have been in the void for a while are judged
+            # by shard 0.
+            allls = ls
+            ls = []
+            for player in allls:
+                playstate = yield motor.Op(app.mongodb.playstate.find_one,
+                                           {'_id':player['_id']},
+                                           {'iid':1, 'lastmoved':1})
+                iid = playstate.get('iid', None) if playstate else None
+                if iid:
+                    if app.ipool.get(iid):
+                        ls.append(player)
+                elif app.shard == 0:
+                    lastmoved = playstate.get('lastmoved', None) if playstate else None
+                    if not lastmoved or task.starttime - lastmoved > limit:
+                        ls.append(player)
         ### Keep a two-strikes list here too?
         for player in ls:
             app.log.info('checkdisconnected: guest %s will be disconnected from session %s', player['name'], player['guestsession'].decode())
             yield motor.Op(app.mongodb.sessions.remove,
                            {'sid':player['guestsession']})
+            # Tweb may have the session cached.
+            msg = {'cmd':'sessionremoved', 'sid':player['guestsession'].decode()}
+            for stream in app.webconns.all():
+                stream.write(wcproto.message(0, msg, version=stream.twversion))
             yield motor.Op(app.mongodb.players.update,
                            {'_id':player['_id']},
                            {'$set':{'guestsession':True}})
 
         # Third task: launch cleanup on guest accounts. Some might be
         # left over from previous attempts, so we construct a new list.
+        # (Only one shard does this. The cleanup passes along any work
+        # that belongs to other shards.)
+        if app.shard != 0:
+            return
         ls = []
         cursor = app.mongodb.players.find({'guest':True, 'guestsession':True},
                                           {'name':1})
@@ -371,8 +464,11 @@ def define_commands():
                            {'iid':instance['_id']})
             yield motor.Op(app.mongodb.portals.remove,
                            {'iid':instance['_id']})
+            yield app.ipool.unstore_instance_timers(instance['_id'])
             yield motor.Op(app.mongodb.instances.remove,
                            {'_id':instance['_id']})
+            for propcache in app.all_propcaches():
+                propcache.invalidate_instance(instance['_id'])
 
         if moretodo:
             # Some instances are still being put to sleep, so we can't
@@ -382,6 +478,8 @@ def define_commands():
         app.log.info('cleanupguest: finishing up guest %s', player['name'])
         yield motor.Op(app.mongodb.iplayerprop.remove,
                        {'uid':player['_id']})
+        for propcache in app.all_propcaches():
+            propcache.invalidate_player(player['_id'])
         yield motor.Op(app.mongodb.playprefs.remove,
                        {'uid':player['_id']})
         yield motor.Op(app.mongodb.portals.remove,
@@ -398,6 +496,12 @@ def define_commands():
     @command('tovoid', isserver=True, doeswrite=True)
     def cmd_tovoid(app, task, cmd, stream):
         oldloctx = yield task.get_loctx(cmd.uid)
+        if oldloctx.iid and not app.ipool.get(oldloctx.iid):
+            # The leave hook has to run where the instance lives.
+            shard = yield app.instance_shard_for_iid(oldloctx.iid)
+            if shard is not None and shard != app.shard:
+                app.relay_command(vars(cmd), shard)
+                return
         yield two.execute.try_hook(task, 'on_leave', oldloctx, 'leaving loc, tovoid',
                                    lambda:{
                 '_from':two.execute.LocationProxy(oldloctx.locid) if oldloctx.locid else None,
@@ -431,17 +535,35 @@ def define_commands():
         if cmd.portin:
             app.schedule_command({'cmd':'portin', 'uid':cmd.uid}, 1.5)
         
-    @command('logplayerconntable', isserver=True, noneedmongo=True)
+    @command('logplayerconntable', isserver=True, noneedmongo=True, lane='server')
     def cmd_logplayerconntable(app, task, cmd, stream):
         app.playconns.dumplog()
         
-    @command('holler', isserver=True)
+    @command('logcachestats', isserver=True, noneedmongo=True, lane='server')
+    def cmd_logcachestats(app, task, cmd, stream):
+        app.log.info('Code parse cache: %s', two.evalctx.code_parse_cache)
+        app.log.info('Argspec parse cache: %s', two.evalctx.argspec_parse_cache)
+        app.log.info('Code compile cache: %s', two.evalctx.code_compile_cache)
+        app.log.info('Markup parse cache: %s', twcommon.interp.parse_cache)
+        app.log.info('Gentext parse cache: %s', twcommon.gentext.parse_cache)
+        app.log.info('Property write-back: %s', two.propcache.write_stats)
+        
+    @command('clearpropcache', isserver=True)
+    def cmd_clearpropcache(app, task, cmd, stream):
+        # Only meaningful if the propcache is long-lived.
+        propcaches = app.all_propcaches()
+        count = sum([ len(propcache.propmap) for propcache in propcaches ])
+        app.log.warning('Admin command: clearing the property cache (%d entries).', count)
+        for propcache in propcaches:
+            propcache.clear()
+        
+    @command('holler', isserver=True, lane='server')
     def cmd_holler(app, task, cmd, stream):
         val = 'Admin broadcast: ' + cmd.text
         for stream in app.webconns.all():
-            stream.write(wcproto.message(0, {'cmd':'messageall', 'text':val}))
+            stream.write(wcproto.message(0, {'cmd':'messageall', 'text':val}, version=stream.twversion))
         
-    @command('timerevent', isserver=True, doeswrite=True)
+    @command('timerevent', isserver=True, doeswrite=True, lane='iid')
     def cmd_timerevent(app, task, cmd, stream):
         iid = cmd.iid
         instance = app.ipool.get(iid)
@@ -450,25 +572,39 @@ def define_commands():
         instance = yield motor.Op(app.mongodb.instances.find_one,
                                   {'_id':iid})
         loctx = two.task.LocContext(None, wid=instance['wid'], scid=instance['scid'], iid=iid)
-        func = cmd.func
-        locals = None
-        if isinstance(func, two.symbols.ScriptCallable):
-            # This is a cheesy way to handle callables. But it works.
-            locals = { '_timerarg': func }
-            func = { 'type':'code', 'text':'_timerarg()' }
-            functype = EVALTYPE_RAW
-        elif func and twcommon.misc.is_typed_dict(func, 'code'):
-            functype = EVALTYPE_RAW
-        else:
-            func = str(func)
-            functype = EVALTYPE_CODE
-        ctx = two.evalctx.EvalPropContext(task, loctx=loctx, level=LEVEL_EXECUTE)
-        try:
-            yield ctx.eval(func, evaltype=functype, locals=locals)
-        except Exception as ex:
-            task.log.warning('Caught exception (timer event): %s', ex, exc_info=app.debugstacktraces)
+        # The timer wheel sends all of an instance's events that came due
+        # together as one command. They share this task (and its cache,
+        # and its update pass), but each gets its own tick budget, and
+        # an error in one doesn't stop the rest.
+        funcs = getattr(cmd, 'funcs', None)
+        if funcs is None:
+            funcs = [ cmd.func ]
+        for func in funcs:
+            locals = None
+            if isinstance(func, two.symbols.ScriptCallable):
+                # This is a cheesy way to handle callables. But it works.
+                locals = { '_timerarg': func }
+                func = { 'type':'code', 'text':'_timerarg()' }
+                functype = EVALTYPE_RAW
+            elif func and twcommon.misc.is_typed_dict(func, 'code'):
+                functype = EVALTYPE_RAW
+            else:
+                func = str(func)
+                functype = EVALTYPE_CODE
+            task.resetticks()
+            ctx = two.evalctx.EvalPropContext(task, loctx=loctx, level=LEVEL_EXECUTE)
+            try:
+                yield ctx.eval(func, evaltype=functype, locals=locals)
+            except Exception as ex:
+                task.log.warning('Caught exception (timer event): %s', ex, exc_info=app.debugstacktraces)
+        # Stored one-shot events are deleted only after they've run, so
+        # a crash in between means they run again, rather than never.
+        dbids = getattr(cmd, 'dbids', None)
+        if dbids:
+            yield motor.Op(app.mongodb.schedevents.remove,
+                           {'_id':{'$in':dbids}})
         
-    @command('connrefreshall', isserver=True, doeswrite=True)
+    @command('connrefreshall', isserver=True, doeswrite=True, lane='conn')
     def cmd_connrefreshall(app, task, cmd, stream):
         # Refresh one connection (not all the player's connections!)
         conn = app.playconns.get(cmd.connid)
@@ -479,7 +615,16 @@ def define_commands():
         app.queue_command({'cmd':'connupdatescopes', 'connid':cmd.connid})
         ### probably queue a connupdatefriends, too
     
-    @command('connupdateplist', isserver=True)
+    @command('connupdate', isserver=True, doeswrite=True, lane='conn')
+    def cmd_connupdate(app, task, cmd, stream):
+        # Update one connection. A task which dirties a connection in an
+        # instance it isn't running in passes the update along this way.
+        conn = app.playconns.get(cmd.connid)
+        if not conn:
+            return
+        task.set_dirty(conn, cmd.dirty)
+    
+    @command('connupdateplist', isserver=True, lane='conn')
     def cmd_connupdateplist(app, task, cmd, stream):
         # Re-send the player's portlist to one connection.
         conn = app.playconns.get(cmd.connid)
@@ -513,7 +658,7 @@ def define_commands():
                 map[strid] = desc
         conn.write({'cmd':'updateplist', 'clear': True, 'map':map})
 
-    @command('connupdatescopes', isserver=True)
+    @command('connupdatescopes', isserver=True, lane='conn')
     def cmd_connupdatescopes(app, task, cmd, stream):
         # Re-send the player's available scope list to one connection.
         conn = app.playconns.get(cmd.connid)
@@ -623,20 +768,67 @@ def define_commands():
         
     @command('notifydatachange', isserver=True, doeswrite=True)
     def cmd_notifydatachange(app, task, cmd, stream):
-        ls = cmd.change
-        # We may need to handle other data-key formats eventually. But
-        # right now, it's all [db, wid, locid/uid, key] where db is
-        # 'worldprop' or 'wplayerprop' and the id values may be None
-        # or ObjectId.
-        ### All of this prop-access stuff will need to go through the 
-        ### propcache, when the propcache has a lifespan.
-        if type(ls[1]) is str:
-            ls[1] = ObjectId(ls[1])
-        if type(ls[2]) is str:
-            ls[2] = ObjectId(ls[2])
-        key = tuple(ls)
-        app.log.info('Build change notification: %s', key)
-        task.set_data_change(key)
+        # Tweb sends a single change (a build edit) to every shard. Other
+        # shards send a list of the changes that their commands made.
+        # Either way, every shard has heard it, so we don't pass it on.
+        task.relaychanges = False
+        changes = getattr(cmd, 'changes', None)
+        if changes is None:
+            changes = [ cmd.change ]
+            app.log.info('Build change notification: %s', cmd.change)
+        for ls in changes:
+            # The keys look like [db, id, id-or-name, ...]. The id values
+            # may be None, or ObjectId -- or a string, if they came
+            # through JSON.
+            ls = list(ls)
+            for ix in (1, 2):
+                if type(ls[ix]) is str and ObjectId.is_valid(ls[ix]):
+                    ls[ix] = ObjectId(ls[ix])
+            key = tuple(ls)
+            # The database changed behind the propcache's back.
+            for propcache in app.all_propcaches():
+                propcache.invalidate(key)
+            task.set_data_change(key)
+
+    @command('notifysessionremoved', isserver=True, noneedmongo=True, lane='server')
+    def cmd_notifysessionremoved(app, task, cmd, stream):
+        # A tweb has signed out (or kicked) a session. Every tweb may
+        # have it cached, so pass the word along to all of them.
+        msg = {'cmd':'sessionremoved', 'sid':cmd.sid}
+        for stream in app.webconns.all():
+            stream.write(wcproto.message(0, msg, version=stream.twversion))
+
+    @command('relayed', isserver=True, noneedmongo=True, lane='server')
+    def cmd_relayed(app, task, cmd, stream):
+        # A command passed along from another shard (see
+        # Tworld.relay_command). It arrives with its objects turned into
+        # namespaces, so we turn them back into dicts before queueing it.
+        # If it came through JSON, its ObjectIds have turned into strings
+        # too. We only convert the fields which we know hold ObjectIds;
+        # any other string might happen to look like one.
+        # (notifydatachange converts its own keys.) If you relay a new
+        # command, list its ObjectId fields in relay_id_fields.
+        def restore(val):
+            if isinstance(val, types.SimpleNamespace):
+                val = vars(val)
+            if isinstance(val, dict):
+                return dict([ (key, restore(subval)) for (key, subval) in val.items() ])
+            if isinstance(val, list):
+                return [ restore(subval) for subval in val ]
+            return val
+        msg = restore(cmd.msg)
+        for path in relay_id_fields.get(msg.get('cmd', None), ()):
+            obj = msg
+            keys = path.split('.')
+            for key in keys[:-1]:
+                obj = obj.get(key, None)
+                if not isinstance(obj, dict):
+                    break
+            else:
+                val = obj.get(keys[-1], None)
+                if type(val) is str:
+                    obj[keys[-1]] = ObjectId(val)
+        app.queue_command(msg)
         
     @command('playeropen', noneedmongo=True, preconnection=True)
     def cmd_playeropen(app, task, cmd, conn):
@@ -646,13 +838,18 @@ def define_commands():
         if not app.mongodb:
             # Reject the players anyhow.
             try:
-                cmd._stream.write(wcproto.message(0, {'cmd':'playernotok', 'connid':connid, 'text':'The database is not available.'}))
+                cmd._stream.write(wcproto.message(0, {'cmd':'playernotok', 'connid':connid, 'text':'The database is not available.'}, version=cmd._stream.twversion))
             except:
                 pass
             return
+
+        if wcproto.connid_node(connid) != cmd._stream.twnode:
+            app.log.error('Tweb node %s opened a connection with connid %d, which belongs to node %d', cmd._stream.twnode, connid, wcproto.connid_node(connid))
+            cmd._stream.write(wcproto.message(0, {'cmd':'playernotok', 'connid':connid, 'text':'Connection ID is not valid for this tweb.'}, version=cmd._stream.twversion))
+            return
             
         conn = app.playconns.add(connid, cmd.uid, cmd.email, cmd._stream)
-        cmd._stream.write(wcproto.message(0, {'cmd':'playerok', 'connid':connid}))
+        cmd._stream.write(wcproto.message(0, {'cmd':'playerok', 'connid':connid}, version=cmd._stream.twversion))
         app.queue_command({'cmd':'connrefreshall', 'connid':connid})
         app.log.info('Player %s has connected (uid %s)', conn.email, conn.uid)
         # If the player is in the void, put them somewhere.
@@ -679,6 +876,11 @@ def define_commands():
             raise ErrorMessageException('Portin: no such player: %s' % (cmd.uid,))
         playername = player['name']
         if playstate.get('iid', None) and playstate.get('locid', None):
+            shard = yield app.instance_shard_for_iid(playstate['iid'])
+            if shard is not None and shard != app.shard:
+                # They're in an instance that another shard runs.
+                app.handoff_player(cmd.uid, shard)
+                return
             app.log.info('Player %s is already in the world', playername)
             return
         # Figure out what destination was set. If none, default to the
@@ -710,6 +912,12 @@ def define_commands():
                                      {'wid':newwid, 'key':lockey})
                 newlocid = res['_id']
         app.log.debug('Player portin to %s, %s, %s', newwid, newscid, newlocid)
+
+        if not app.owns_instance(newwid, newscid):
+            # The destination belongs to another shard. Send the player
+            # there; the portin will happen again on that side.
+            app.handoff_player(cmd.uid, wcproto.instance_shard(newwid, newscid, app.shardcount))
+            return
         
         instance = yield motor.Op(app.mongodb.instances.find_one,
                                   {'wid':newwid, 'scid':newscid})
@@ -749,6 +957,7 @@ def define_commands():
             yield motor.Op(app.mongodb.instances.update,
                            {'_id':newiid},
                            {'$set':{'lastawake':True}})
+            yield app.ipool.warm_up_instance(newwid, newiid, newlocid)
             loctx = two.task.LocContext(None, wid=newwid, scid=newscid, iid=newiid)
             task.resetticks()
             yield two.execute.try_hook(task, 'on_wake', loctx, 'awakening instance',
@@ -1048,6 +1257,8 @@ def define_commands():
                 raise MessageException('Player instance property not set: %s' % (key,))
             yield motor.Op(app.mongodb.iplayerprop.remove,
                        {'iid':iid, 'uid':conn.uid, 'key':key})
+            for propcache in app.all_propcaches():
+                propcache.invalidate( ('iplayerprop', iid, conn.uid, key) )
             task.set_data_change( ('iplayerprop', iid, conn.uid, key) )
             raise MessageException('Player instance property deleted: %s' % (key,))
         res = yield motor.Op(app.mongodb.instanceprop.find_one,
@@ -1056,6 +1267,8 @@ def define_commands():
             raise MessageException('Instance property not set: %s' % (origkey,))
         yield motor.Op(app.mongodb.instanceprop.remove,
                        {'iid':iid, 'locid':locid, 'key':key})
+        for propcache in app.all_propcaches():
+            propcache.invalidate( ('instanceprop', iid, locid, key) )
         task.set_data_change( ('instanceprop', iid, locid, key) )
         raise MessageException('Instance property deleted: %s' % (origkey,))
                 
@@ -1104,12 +1317,16 @@ def define_commands():
                        {'iid':iid, 'uid':conn.uid, 'key':key},
                        {'iid':iid, 'uid':conn.uid, 'key':key, 'val':newval},
                        upsert=True)
+            for propcache in app.all_propcaches():
+                propcache.invalidate( ('iplayerprop', iid, conn.uid, key) )
             task.set_data_change( ('iplayerprop', iid, conn.uid, key) )
             raise MessageException('Player instance property set: %s = %s' % (key, repr(newval)))            
         yield motor.Op(app.mongodb.instanceprop.update,
                        {'iid':iid, 'locid':locid, 'key':key},
                        {'iid':iid, 'locid':locid, 'key':key, 'val':newval},
                        upsert=True)
+        for propcache in app.all_propcaches():
+            propcache.invalidate( ('instanceprop', iid, locid, key) )
         task.set_data_change( ('instanceprop', iid, locid, key) )
         raise MessageException('Instance property set: %s = %s' % (origkey, repr(newval)))
                 
@@ -1154,7 +1371,7 @@ def define_commands():
     def cmd_meta_holler(app, task, cmd, conn):
         val = 'Admin broadcast: ' + (' '.join(cmd.args))
         for stream in app.webconns.all():
-            stream.write(wcproto.message(0, {'cmd':'messageall', 'text':val}))
+            stream.write(wcproto.message(0, {'cmd':'messageall', 'text':val}, version=stream.twversion))
 
     @command('meta_shutdown', restrict='admin')
     def cmd_meta_shutdown(app, task, cmd, conn):
@@ -1326,6 +1543,7 @@ import two.execute
 import two.evalctx
 import two.task
 import two.symbols
+import two.propcache
 from two.evalctx import LEVEL_EXECUTE
 from two.evalctx import EVALTYPE_RAW, EVALTYPE_CODE
 from two.task import DIRTY_ALL, DIRTY_WORLD, DIRTY_LOCALE, DIRTY_POPULACE, DIRTY_FOCUS, DIRTY_TOOL
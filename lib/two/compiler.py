@@ -0,0 +1,882 @@
+"""
+The script compiler: converts a parsed TworldPy tree (from ast.parse) into
+a tree of Python closures, so that running the script doesn't require
+walking and dispatching on the AST every time.
+
+This is an alternative to the AST interpreter in EvalPropContext (the
+execcode_* methods). The two engines must behave identically -- same
+results, same exceptions, same sandbox rules, and the same task.tick()
+count. The interpreter is still there (set EvalPropContext.compile_code
+to False to use it), and the test_eval tests run against both.
+
+Every expression node compiles to a pair (func, yieldy). If yieldy is
+false, func(ctx) is a plain function which returns the value. If yieldy
+is true, func(ctx) is a generator function; it yields Futures (from
+propcache lookups and so on) and finally returns the value. Parent nodes
+call yieldy children with "yield from", so a whole script runs as one
+generator chain under a single tornado coroutine. Subtrees which can't
+touch the database (constants, temporary variables, arithmetic) compile
+to plain functions, with no generator overhead at all.
+
+Statement nodes always compile to generator functions.
+
+Constructs which the interpreter rejects (unknown node types, unknown
+operators) compile to closures which raise the same exception, at the
+same point in execution, rather than failing at compile time.
+"""
+
+import ast
+import itertools
+
+import tornado.gen
+
+from twcommon.excepts import ExecSandboxException
+from twcommon.excepts import ReturnException, BreakException, ContinueException
+
+def compile_module(tree):
+    """Compile an ast.Module. Returns a coroutine function: call it with
+    an EvalPropContext, and yield the result.
+    """
+    assert type(tree) is ast.Module
+    body = compile_body(tree.body)
+
+    @tornado.gen.coroutine
+    def run_module(ctx):
+        res = yield from body(ctx)
+        return res
+    return run_module
+
+def as_generator(func, yieldy):
+    """Wrap a plain (non-yieldy) function as a generator function, so that
+    it can be called with "yield from" like the yieldy ones.
+    """
+    if yieldy:
+        return func
+    def gen(ctx):
+        return func(ctx)
+        yield
+    return gen
+
+def raise_closure(exc, *args):
+    """Return a (non-yieldy) closure which ticks and then raises an
+    exception. This is how we compile constructs that the interpreter
+    rejects at execution time.
+    """
+    def run(ctx):
+        ctx.task.tick()
+        raise exc(*args)
+    return run
+
+def failing_operator(name, optyp):
+    """Return a function to stand in for an unimplemented operator. The
+    interpreter evaluates the operands before rejecting the operator,
+    so we do too.
+    """
+    def func(*args):
+        raise NotImplementedError('Script %s type not implemented: %s' % (name, optyp.__name__))
+    return func
+
+def is_local_name(key):
+    """Is this a symbol which must be a temporary (local) variable?
+    These never touch the database, so they can be accessed synchronously.
+    """
+    return (key.startswith('_') and key != '_')
+
+def compile_body(nodls):
+    """Compile a list of statements. Returns a generator function which
+    runs them and returns the result of the last one.
+    """
+    stmts = [ compile_statement(nod) for nod in nodls ]
+    if len(stmts) == 1:
+        return stmts[0]
+    def run(ctx):
+        res = None
+        for stmt in stmts:
+            res = yield from stmt(ctx)
+        return res
+    return run
+
+def compile_statement(nod):
+    """Compile one statement. Returns a generator function.
+    """
+    nodtyp = type(nod)
+    han = statement_compilers.get(nodtyp, None)
+    if han:
+        return han(nod)
+    func = raise_closure(NotImplementedError, 'Script statement type not implemented: %s' % (nodtyp.__name__,))
+    return as_generator(func, False)
+
+def compile_expr(nod):
+    """Compile one expression. Returns (func, yieldy).
+    """
+    nodtyp = type(nod)
+    han = expr_compilers.get(nodtyp, None)
+    if han:
+        return han(nod)
+    return (raise_closure(NotImplementedError, 'Script expression type not implemented: %s' % (nodtyp.__name__,)), False)
+
+def compile_expr_gen(nod):
+    """Compile one expression, and return it as a generator function
+    regardless of whether it's yieldy.
+    """
+    (func, yieldy) = compile_expr(nod)
+    return as_generator(func, yieldy)
+
+def compile_exprs(nodls):
+    """Compile a list of expressions. Returns (funcs, yieldy), where funcs
+    is a list of plain functions if none of them are yieldy, or a list
+    of generator functions if any are.
+    """
+    ls = [ compile_expr(nod) for nod in nodls ]
+    if not any(yieldy for (func, yieldy) in ls):
+        return ([ func for (func, yieldy) in ls ], False)
+    return ([ as_generator(func, yieldy) for (func, yieldy) in ls ], True)
+
+# Expression compilers.
+
+def compile_str(nod):
+    val = nod.s
+    def run(ctx):
+        ctx.task.tick()
+        return val
+    return (run, False)
+
+def compile_num(nod):
+    val = nod.n  # covers floats and ints
+    def run(ctx):
+        ctx.task.tick()
+        return val
+    return (run, False)
+
+def compile_nameconstant(nod):
+    # Python 3.4 and later
+    val = nod.value
+    def run(ctx):
+        ctx.task.tick()
+        return val
+    return (run, False)
+
+def compile_name(nod):
+    # These special cases follow the order of tests in find_symbol().
+    symbol = nod.id
+    if symbol == '_':
+        def run(ctx):
+            ctx.task.tick()
+            return ctx.app.global_symbol_table
+        return (run, False)
+    if two.symbols.is_immutable_symbol(symbol):
+        val = two.symbols.immutable_symbol_table[symbol]
+        def run(ctx):
+            ctx.task.tick()
+            return val
+        return (run, False)
+    if is_local_name(symbol):
+        def run(ctx):
+            ctx.task.tick()
+            locals = ctx.frame.locals
+            if symbol in locals:
+                return locals[symbol]
+            raise NameError('Temporary variable "%s" is not found' % (symbol,))
+        return (run, False)
+    def run(ctx):
+        ctx.task.tick()
+        locals = ctx.frame.locals
+        if symbol in locals:
+            return locals[symbol]
+        res = yield two.symbols.find_symbol(ctx.app, ctx.loctx, symbol, locals=locals, dependencies=ctx.dependencies)
+        return res
+    return (run, True)
+
+def compile_list(nod):
+    (funcs, yieldy) = compile_exprs(nod.elts)
+    if not yieldy:
+        def run(ctx):
+            ctx.task.tick()
+            return [ func(ctx) for func in funcs ]
+        return (run, False)
+    def run(ctx):
+        ctx.task.tick()
+        ls = []
+        for func in funcs:
+            val = yield from func(ctx)
+            ls.append(val)
+        return ls
+    return (run, True)
+
+def compile_tuple(nod):
+    (func, yieldy) = compile_list(nod)
+    if not yieldy:
+        def run(ctx):
+            return tuple(func(ctx))
+        return (run, False)
+    def run(ctx):
+        ls = yield from func(ctx)
+        return tuple(ls)
+    return (run, True)
+
+def compile_set(nod):
+    (func, yieldy) = compile_list(nod)
+    if not yieldy:
+        def run(ctx):
+            return set(func(ctx))
+        return (run, False)
+    def run(ctx):
+        ls = yield from func(ctx)
+        return set(ls)
+    return (run, True)
+
+def compile_dict(nod):
+    # Keys are all evaluated before values, as in the interpreter.
+    (funcs, yieldy) = compile_exprs(nod.keys + nod.values)
+    count = len(nod.keys)
+    if not yieldy:
+        def run(ctx):
+            ctx.task.tick()
+            ls = [ func(ctx) for func in funcs ]
+            return dict(zip(ls[:count], ls[count:]))
+        return (run, False)
+    def run(ctx):
+        ctx.task.tick()
+        ls = []
+        for func in funcs:
+            val = yield from func(ctx)
+            ls.append(val)
+        return dict(zip(ls[:count], ls[count:]))
+    return (run, True)
+
+def compile_unaryop(nod):
+    optyp = type(nod.op)
+    opfunc = EvalPropContext.map_unaryop_operators.get(optyp, None)
+    if not opfunc:
+        opfunc = failing_operator('unaryop', optyp)
+    (argfunc, yieldy) = compile_expr(nod.operand)
+    if not yieldy:
+        def run(ctx):
+            ctx.task.tick()
+            return opfunc(argfunc(ctx))
+        return (run, False)
+    def run(ctx):
+        ctx.task.tick()
+        argval = yield from argfunc(ctx)
+        return opfunc(argval)
+    return (run, True)
+
+def compile_binop(nod):
+    optyp = type(nod.op)
+    opfunc = EvalPropContext.map_binop_operators.get(optyp, None)
+    if not opfunc:
+        opfunc = failing_operator('binop', optyp)
+    ((leftfunc, rightfunc), yieldy) = compile_exprs([nod.left, nod.right])
+    if not yieldy:
+        def run(ctx):
+            ctx.task.tick()
+            leftval = leftfunc(ctx)
+            return opfunc(leftval, rightfunc(ctx))
+        return (run, False)
+    def run(ctx):
+        ctx.task.tick()
+        leftval = yield from leftfunc(ctx)
+        rightval = yield from rightfunc(ctx)
+        return opfunc(leftval, rightval)
+    return (run, True)
+
+def compile_boolop(nod):
+    optyp = type(nod.op)
+    assert len(nod.values) > 0
+    if optyp is ast.And:
+        wantval = False
+    elif optyp is ast.Or:
+        wantval = True
+    else:
+        return (raise_closure(NotImplementedError, 'Script boolop type not implemented: %s' % (optyp.__name__,)), False)
+    (funcs, yieldy) = compile_exprs(nod.values)
+    # Return the first value whose truth is wantval, or else the last value.
+    if not yieldy:
+        def run(ctx):
+            ctx.task.tick()
+            for func in funcs:
+                val = func(ctx)
+                if bool(val) == wantval:
+                    return val
+            return val
+        return (run, False)
+    def run(ctx):
+        ctx.task.tick()
+        for func in funcs:
+            val = yield from func(ctx)
+            if bool(val) == wantval:
+                return val
+        return val
+    return (run, True)
+
+def compile_compare(nod):
+    opfuncs = []
+    for op in nod.ops:
+        optyp = type(op)
+        opfunc = EvalPropContext.map_compare_operators.get(optyp, None)
+        if not opfunc:
+            opfunc = failing_operator('compare', optyp)
+        opfuncs.append(opfunc)
+    (funcs, yieldy) = compile_exprs([nod.left] + nod.comparators)
+    leftfunc = funcs[0]
+    pairs = list(zip(opfuncs, funcs[1:]))
+    if not yieldy:
+        def run(ctx):
+            ctx.task.tick()
+            leftval = leftfunc(ctx)
+            for (opfunc, func) in pairs:
+                rightval = func(ctx)
+                res = opfunc(leftval, rightval)
+                if not res:
+                    return res
+                leftval = rightval
+            return True
+        return (run, False)
+    def run(ctx):
+        ctx.task.tick()
+        leftval = yield from leftfunc(ctx)
+        for (opfunc, func) in pairs:
+            rightval = yield from func(ctx)
+            res = opfunc(leftval, rightval)
+            if not res:
+                return res
+            leftval = rightval
+        return True
+    return (run, True)
+
+def compile_ifexp(nod):
+    ((testfunc, bodyfunc, elsefunc), yieldy) = compile_exprs([nod.test, nod.body, nod.orelse])
+    if not yieldy:
+        def run(ctx):
+            ctx.task.tick()
+            if testfunc(ctx):
+                return bodyfunc(ctx)
+            else:
+                return elsefunc(ctx)
+        return (run, False)
+    def run(ctx):
+        ctx.task.tick()
+        val = yield from testfunc(ctx)
+        if val:
+            res = yield from bodyfunc(ctx)
+        else:
+            res = yield from elsefunc(ctx)
+        return res
+    return (run, True)
+
+def compile_comprehension(nod, eltnods, accumulate, newaccum):
+    """Compile a listcomp, setcomp, or dictcomp. The eltnods are the
+    expressions evaluated for each element (one node, or key and value).
+    accumulate(res, vals) adds the element values to the result.
+
+    This follows the interpreter's semantics, which are not quite
+    Python's: all targets are bound, and all iterables evaluated, before
+    the loop starts. We then loop over the product of the iterables.
+    """
+    bindfuncs = []
+    iterfuncs = []
+    ifss = []
+    allsync = True
+    for comp in nod.generators:
+        (bindfunc, bindyieldy) = compile_bind(comp.target)
+        (iterfunc, iteryieldy) = compile_expr(comp.iter)
+        (ifs, ifsyieldy) = compile_exprs(comp.ifs)
+        bindfuncs.append( (bindfunc, bindyieldy) )
+        iterfuncs.append( (iterfunc, iteryieldy) )
+        ifss.append( (ifs, ifsyieldy) )
+        if bindyieldy or iteryieldy or ifsyieldy or not is_local_target(comp.target):
+            allsync = False
+    (eltfuncs, eltyieldy) = compile_exprs(eltnods)
+    if eltyieldy:
+        allsync = False
+
+    if allsync:
+        # Every target is a temporary variable and nothing touches the
+        # database, so the whole comprehension can run synchronously.
+        # (Binding a temporary variable has no side effects, so we skip
+        # that step.)
+        keys = [ comp.target.id for comp in nod.generators ]
+        iterfuncs = [ func for (func, yieldy) in iterfuncs ]
+        ifss = [ ifs for (ifs, yieldy) in ifss ]
+        def run(ctx):
+            ctx.task.tick()
+            iters = [ func(ctx) for func in iterfuncs ]
+            locals = ctx.frame.locals
+            res = newaccum()
+            for tup in itertools.product(*iters):
+                flag = True
+                for key, val, ifs in zip(keys, tup, ifss):
+                    locals[key] = val
+                    for iffunc in ifs:
+                        flag = iffunc(ctx)
+                        if not flag:
+                            break
+                    if not flag:
+                        break
+                if flag:
+                    accumulate(res, [ func(ctx) for func in eltfuncs ])
+            return res
+        return (run, False)
+
+    bindfuncs = [ as_generator(func, yieldy) for (func, yieldy) in bindfuncs ]
+    iterfuncs = [ as_generator(func, yieldy) for (func, yieldy) in iterfuncs ]
+    ifss = [ [ as_generator(func, yieldy) for func in ifs ] for (ifs, yieldy) in ifss ]
+    eltfuncs = [ as_generator(func, eltyieldy) for func in eltfuncs ]
+    def run(ctx):
+        ctx.task.tick()
+        targets = []
+        iters = []
+        for (bindfunc, iterfunc) in zip(bindfuncs, iterfuncs):
+            target = yield from bindfunc(ctx)
+            iter = yield from iterfunc(ctx)
+            targets.append(target)
+            iters.append(iter)
+        res = newaccum()
+        for tup in itertools.product(*iters):
+            flag = True
+            for target, val, ifs in zip(targets, tup, ifss):
+                yield from assign_target(ctx, target, val)
+                for iffunc in ifs:
+                    flag = yield from iffunc(ctx)
+                    if not flag:
+                        break
+                if not flag:
+                    break
+            if flag:
+                vals = []
+                for func in eltfuncs:
+                    val = yield from func(ctx)
+                    vals.append(val)
+                accumulate(res, vals)
+        return res
+    return (run, True)
+
+def compile_listcomp(nod):
+    return compile_comprehension(nod, [nod.elt],
+                                 lambda res, vals: res.append(vals[0]), list)
+
+def compile_setcomp(nod):
+    return compile_comprehension(nod, [nod.elt],
+                                 lambda res, vals: res.add(vals[0]), set)
+
+def compile_dictcomp(nod):
+    def accumulate(res, vals):
+        res[vals[0]] = vals[1]
+    return compile_comprehension(nod, [nod.key, nod.value],
+                                 accumulate, dict)
+
+def compile_attribute(nod):
+    argfunc = compile_expr_gen(nod.value)
+    key = nod.attr
+    def run(ctx):
+        ctx.task.tick()
+        argument = yield from argfunc(ctx)
+        # The real getattr() is way too powerful to offer up.
+        if isinstance(argument, two.symbols.ScriptNamespace):
+            (res, yieldy) = argument.getyieldy(key)
+            if yieldy:
+                res = yield res()
+            return res
+        if isinstance(argument, two.execute.PropertyProxyMixin):
+            res = yield argument.getprop(ctx, ctx.loctx, key)
+            return res
+        return two.symbols.type_getattr_perform(ctx.app, argument, key)
+    return (run, True)
+
+def compile_slice(subnod):
+    """Compile the slice part of a subscript expression. Returns a
+    generator function which produces the subscript value (or raises
+    NotImplementedError, for unsupported slice types).
+    """
+    subtyp = type(subnod)
+    if subtyp is ast.Index:
+        return compile_expr_gen(subnod.value)
+    if subtyp is ast.Slice:
+        lowerfunc = None
+        if subnod.lower is not None:
+            lowerfunc = compile_expr_gen(subnod.lower)
+        upperfunc = None
+        if subnod.upper is not None:
+            upperfunc = compile_expr_gen(subnod.upper)
+        stepfunc = None
+        if subnod.step is not None:
+            stepfunc = compile_expr_gen(subnod.step)
+        def run(ctx):
+            lower = None
+            if lowerfunc is not None:
+                lower = yield from lowerfunc(ctx)
+            upper = None
+            if upperfunc is not None:
+                upper = yield from upperfunc(ctx)
+            if stepfunc is None:
+                return slice(lower, upper)
+            step = yield from stepfunc(ctx)
+            return slice(lower, upper, step)
+        return run
+    def run(ctx):
+        raise NotImplementedError('Unsupported subscript type: %s' % (subtyp.__name__,))
+        yield
+    return run
+
+def compile_subscript(nod):
+    argfunc = compile_expr_gen(nod.value)
+    slicefunc = compile_slice(nod.slice)
+    def run(ctx):
+        ctx.task.tick()
+        argument = yield from argfunc(ctx)
+        subscript = yield from slicefunc(ctx)
+        if isinstance(argument, two.execute.PropertyProxyMixin):
+            # Special case: property proxies can be accessed by subscript.
+            res = yield argument.getprop(ctx, ctx.loctx, subscript)
+            return res
+        return argument[subscript]
+    return (run, True)
+
+def compile_call(nod):
+    funcfunc = compile_expr_gen(nod.func)
+    argfuncs = [ compile_expr_gen(subnod) for subnod in nod.args ]
+    starargsfunc = None
+    if nod.starargs:
+        starargsfunc = compile_expr_gen(nod.starargs)
+    kwfuncs = [ (subnod.arg, compile_expr_gen(subnod.value)) for subnod in nod.keywords ]
+    kwargsfunc = None
+    if nod.kwargs:
+        kwargsfunc = compile_expr_gen(nod.kwargs)
+    def run(ctx):
+        ctx.task.tick()
+        funcval = yield from funcfunc(ctx)
+        args = []
+        for func in argfuncs:
+            val = yield from func(ctx)
+            args.append(val)
+        if starargsfunc is not None:
+            starargs = yield from starargsfunc(ctx)
+            args.extend(starargs)
+        kwargs = {}
+        for (key, func) in kwfuncs:
+            val = yield from func(ctx)
+            kwargs[key] = val
+        if kwargsfunc is not None:
+            starargs = yield from kwargsfunc(ctx)
+            # Python semantics say we should reject duplicate kwargs here
+            kwargs.update(starargs)
+
+        # The common case is handled inline; {code} dicts and the sandbox
+        # check go through exec_call_object().
+        if isinstance(funcval, two.symbols.ScriptCallable):
+            if not funcval.yieldy:
+                return funcval.func(*args, **kwargs)
+            else:
+                res = yield funcval.yieldfunc(*args, **kwargs)
+                return res
+        res = yield ctx.exec_call_object(funcval, args, kwargs)
+        return res
+    return (run, True)
+
+# Assignment targets. A target compiles to a "bind" function, which
+# evaluates any subexpressions and returns a proxy object with load(),
+# store(), and delete() methods -- the same proxies that the interpreter's
+# execcode_expr_store() returns.
+
+def is_local_target(nod):
+    """Is this an assignment target which is just a temporary variable?
+    """
+    return (type(nod) is ast.Name and is_local_name(nod.id))
+
+def compile_bind(nod):
+    """Compile an assignment target. Returns (func, yieldy); the function
+    returns a proxy.
+    """
+    if type(nod.ctx) is ast.Load:
+        def run(ctx):
+            raise AssertionError('target of assignment has Load context')
+        return (run, False)
+    nodtyp = type(nod)
+    if nodtyp is ast.Name:
+        key = nod.id
+        def run(ctx):
+            return two.execute.BoundNameProxy(key)
+        return (run, False)
+    if nodtyp is ast.Attribute:
+        argfunc = compile_expr_gen(nod.value)
+        key = nod.attr
+        def run(ctx):
+            argument = yield from argfunc(ctx)
+            if isinstance(argument, two.execute.PropertyProxyMixin):
+                return two.execute.BoundPropertyProxy(argument, key)
+            raise ExecSandboxException('%s.%s: setattr not allowed' % (type(argument).__name__, key))
+        return (run, True)
+    if nodtyp is ast.Subscript:
+        argfunc = compile_expr_gen(nod.value)
+        slicefunc = compile_slice(nod.slice)
+        def run(ctx):
+            argument = yield from argfunc(ctx)
+            subscript = yield from slicefunc(ctx)
+            if isinstance(argument, two.execute.PropertyProxyMixin):
+                # Special case: property proxies can be accessed by subscript.
+                return two.execute.BoundPropertyProxy(argument, subscript)
+            return two.execute.BoundSubscriptProxy(argument, subscript)
+        return (run, True)
+    if nodtyp in (ast.Tuple, ast.List):
+        ls = [ compile_bind(subnod) for subnod in nod.elts ]
+        if not any(yieldy for (func, yieldy) in ls):
+            funcs = [ func for (func, yieldy) in ls ]
+            def run(ctx):
+                return two.execute.MultiBoundProxy([ func(ctx) for func in funcs ])
+            return (run, False)
+        funcs = [ as_generator(func, yieldy) for (func, yieldy) in ls ]
+        def run(ctx):
+            proxies = []
+            for func in funcs:
+                val = yield from func(ctx)
+                proxies.append(val)
+            return two.execute.MultiBoundProxy(proxies)
+        return (run, True)
+    def run(ctx):
+        raise NotImplementedError('Script store-expression type not implemented: %s' % (nodtyp.__name__,))
+    return (run, False)
+
+def assign_target(ctx, proxy, val):
+    """Store a value through a proxy (as returned by a bind function).
+    This is a generator function.
+
+    Temporary variables and plain subscripts are stored inline. This
+    duplicates the logic of BoundNameProxy.store() and friends, minus
+    the coroutine overhead. Everything else goes through the proxy.
+    """
+    proxytyp = type(proxy)
+    if proxytyp is two.execute.BoundNameProxy:
+        key = proxy.key
+        if key != '_' and not two.symbols.is_immutable_symbol(key):
+            locals = ctx.frame.locals
+            if key in locals or key.startswith('_'):
+                locals[key] = val
+                return
+    elif proxytyp is two.execute.BoundSubscriptProxy:
+        proxy.arg[proxy.subscript] = val
+        ctx.app.propcache.note_mutation(proxy.arg)
+        return
+    elif proxytyp is two.execute.MultiBoundProxy:
+        vals = tuple(val)
+        if len(vals) != len(proxy.tuple):
+            raise ValueError('wrong number of values to unpack (expected %d)' % (len(proxy.tuple),))
+        for subproxy, subval in zip(proxy.tuple, vals):
+            yield from assign_target(ctx, subproxy, subval)
+        return
+    yield proxy.store(ctx, ctx.loctx, val)
+
+# Statement compilers. These all return generator functions.
+
+def compile_expr_statement(nod):
+    (func, yieldy) = compile_expr(nod.value)
+    func = as_generator(func, yieldy)
+    symbol = None
+    if type(nod.value) is ast.Name:
+        symbol = nod.value.id
+    def run(ctx):
+        ctx.task.tick()
+        res = yield from func(ctx)
+        if res is not None and type(res) is dict and 'type' in res:
+            # Top-level expression has returned a typed dict. Try
+            # invoking it.
+            res = yield ctx.invoke_typed_dict(res, symbol)
+        return res
+    return run
+
+def compile_pass(nod):
+    def run(ctx):
+        ctx.task.tick()
+        return None
+        yield
+    return run
+
+def compile_assign(nod):
+    valfunc = compile_expr_gen(nod.value)
+    if len(nod.targets) == 1 and is_local_target(nod.targets[0]):
+        # The common "_x = ..." case.
+        key = nod.targets[0].id
+        def run(ctx):
+            ctx.task.tick()
+            val = yield from valfunc(ctx)
+            ctx.frame.locals[key] = val
+            return None
+        return run
+    bindfuncs = [ compile_bind(tarnod) for tarnod in nod.targets ]
+    bindfuncs = [ as_generator(func, yieldy) for (func, yieldy) in bindfuncs ]
+    def run(ctx):
+        ctx.task.tick()
+        val = yield from valfunc(ctx)
+        for bindfunc in bindfuncs:
+            target = yield from bindfunc(ctx)
+            yield from assign_target(ctx, target, val)
+        return None
+    return run
+
+def compile_augassign(nod):
+    optyp = type(nod.op)
+    opfunc = EvalPropContext.map_binop_operators.get(optyp, None)
+    if not opfunc:
+        return as_generator(raise_closure(NotImplementedError, 'Script augop type not implemented: %s' % (optyp.__name__,)), False)
+    bindfunc = as_generator(*compile_bind(nod.target))
+    valfunc = compile_expr_gen(nod.value)
+    def run(ctx):
+        ctx.task.tick()
+        target = yield from bindfunc(ctx)
+        rightval = yield from valfunc(ctx)
+        leftval = yield from load_target(ctx, target)
+        val = opfunc(leftval, rightval)
+        yield from assign_target(ctx, target, val)
+        return None
+    return run
+
+def load_target(ctx, proxy):
+    """Load a value through a proxy, for an augmented assignment. This
+    is a generator function. As with assign_target(), temporary
+    variables are handled inline.
+    """
+    if type(proxy) is two.execute.BoundNameProxy:
+        key = proxy.key
+        if key != '_' and not two.symbols.is_immutable_symbol(key):
+            locals = ctx.frame.locals
+            if key in locals:
+                return locals[key]
+    res = yield proxy.load(ctx, ctx.loctx)
+    return res
+
+def compile_delete(nod):
+    bindfuncs = [ as_generator(*compile_bind(subnod)) for subnod in nod.targets ]
+    def run(ctx):
+        ctx.task.tick()
+        for bindfunc in bindfuncs:
+            target = yield from bindfunc(ctx)
+            yield target.delete(ctx, ctx.loctx)
+        return None
+    return run
+
+def compile_if(nod):
+    testfunc = compile_expr_gen(nod.test)
+    body = compile_body(nod.body)
+    orelse = compile_body(nod.orelse)
+    def run(ctx):
+        ctx.task.tick()
+        testval = yield from testfunc(ctx)
+        if testval:
+            res = yield from body(ctx)
+        else:
+            res = yield from orelse(ctx)
+        return res
+    return run
+
+def compile_while(nod):
+    testfunc = compile_expr_gen(nod.test)
+    body = compile_body(nod.body)
+    orelse = compile_body(nod.orelse)
+    def run(ctx):
+        ctx.task.tick()
+        while True:
+            testval = yield from testfunc(ctx)
+            if not testval:
+                break
+            try:
+                yield from body(ctx)
+            except ContinueException:
+                pass
+            except BreakException:
+                return None
+        yield from orelse(ctx)
+        return None
+    return run
+
+def compile_for(nod):
+    bindfunc = as_generator(*compile_bind(nod.target))
+    iterfunc = compile_expr_gen(nod.iter)
+    body = compile_body(nod.body)
+    orelse = compile_body(nod.orelse)
+    def run(ctx):
+        ctx.task.tick()
+        target = yield from bindfunc(ctx)
+        iter = yield from iterfunc(ctx)
+        for val in iter:
+            yield from assign_target(ctx, target, val)
+            try:
+                yield from body(ctx)
+            except ContinueException:
+                pass
+            except BreakException:
+                return None
+        yield from orelse(ctx)
+        return None
+    return run
+
+def compile_return(nod):
+    if nod.value is None:
+        def run(ctx):
+            ctx.task.tick()
+            raise ReturnException(returnvalue=None)
+            yield
+        return run
+    valfunc = compile_expr_gen(nod.value)
+    def run(ctx):
+        ctx.task.tick()
+        val = yield from valfunc(ctx)
+        raise ReturnException(returnvalue=val)
+    return run
+
+def compile_break(nod):
+    def run(ctx):
+        ctx.task.tick()
+        raise BreakException
+        yield
+    return run
+
+def compile_continue(nod):
+    def run(ctx):
+        ctx.task.tick()
+        raise ContinueException
+        yield
+    return run
+
+# Lookup tables of node compilers. These parallel the interpreter's
+# execcode_expr_handlers and execcode_statement_handlers.
+expr_compilers = {
+    ast.Str: compile_str,
+    ast.Num: compile_num,
+    ast.Name: compile_name,
+    ast.List: compile_list,
+    ast.Tuple: compile_tuple,
+    ast.Set: compile_set,
+    ast.Dict: compile_dict,
+    ast.UnaryOp: compile_unaryop,
+    ast.BinOp: compile_binop,
+    ast.BoolOp: compile_boolop,
+    ast.Compare: compile_compare,
+    ast.IfExp: compile_ifexp,
+    ast.ListComp: compile_listcomp,
+    ast.SetComp: compile_setcomp,
+    ast.DictComp: compile_dictcomp,
+    ast.Attribute: compile_attribute,
+    ast.Subscript: compile_subscript,
+    ast.Call: compile_call,
+    }
+if (hasattr(ast, 'NameConstant')):
+    # Only exists in Python 3.4 and up
+    expr_compilers[ast.NameConstant] = compile_nameconstant
+
+statement_compilers = {
+    ast.Expr: compile_expr_statement,
+    ast.Pass: compile_pass,
+    ast.Assign: compile_assign,
+    ast.AugAssign: compile_augassign,
+    ast.Delete: compile_delete,
+    ast.If: compile_if,
+    ast.While: compile_while,
+    ast.For: compile_for,
+    ast.Return: compile_return,
+    ast.Break: compile_break,
+    ast.Continue: compile_continue,
+    }
+
+# Late imports, to avoid circularity
+from two.evalctx import EvalPropContext
+import two.execute
+import two.symbols
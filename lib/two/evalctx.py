@@ -6,8 +6,10 @@ of TworldPy lives in the EvalPropContext module.
 import re
 import random
 import ast
+import copy
 import operator
 import itertools
+import contextlib
 
 import tornado.gen
 import bson
@@ -44,6 +46,14 @@ LEVEL_RAW = 0
 # Regexp: Check whether a string starts with a vowel.
 re_vowelstart = re.compile('^[aeiou]', re.IGNORECASE)
 
+# Parsed script code (ast.Module trees) and argument specs (ast.arguments),
+# keyed by source text. These are shared by all tasks. The parse trees
+# are never modified once they're built, so sharing them is safe.
+code_parse_cache = twcommon.misc.LRUCache(1000)
+argspec_parse_cache = twcommon.misc.LRUCache(500)
+# Compiled script code (see the compiler module), keyed by source text.
+code_compile_cache = twcommon.misc.LRUCache(1000)
+
 class EvalPropFrame:
     """One stack frame in the EvalPropContext. Note that depth starts at 1.
 
@@ -86,9 +96,29 @@ class EvalPropContext(object):
             raise Exception('get_current_context: no current context!')
         return EvalPropContext.context_stack[-1]
 
+    @staticmethod
+    @contextlib.contextmanager
+    def swapped_context_stack(stack):
+        """Context manager which makes the given list the context_stack
+        for its duration. Coroutines which run interleaved need separate
+        stacks; Task.resolve() uses this with a tornado StackContext,
+        which re-enters it whenever the coroutine resumes.
+        """
+        saved = EvalPropContext.context_stack
+        EvalPropContext.context_stack = stack
+        try:
+            yield
+        finally:
+            EvalPropContext.context_stack = saved
+
     # Used as a long-running counter in build_action_key.
     link_code_counter = 0
 
+    # If true, script code is compiled into closures (see the compiler
+    # module) and cached. If false, we walk the AST with the execcode_*
+    # methods every time. Both engines should behave identically.
+    compile_code = True
+
     @staticmethod
     def build_action_key():
         """Return a random (hex digit) string which will never repeat.
@@ -118,12 +148,10 @@ class EvalPropContext(object):
             assert self.task == parent.task
             self.parentdepth = parent.parentdepth + parent.depth + 1
             self.loctx = parent.loctx
-            self.uid = parent.uid
             self.caps = parent.caps
         elif loctx is not None:
             self.parentdepth = parentdepth
             self.loctx = loctx
-            self.uid = loctx.uid
             self.caps = EVALCAP_ALL
 
         # What kind of evaluation is going on.
@@ -145,6 +173,7 @@ class EvalPropContext(object):
         # Text generation state.
         self.gentexting = False
         self.genseed = None
+        self.genengine = None
         self.gencount = None
         self.genparams = None
 
@@ -153,6 +182,20 @@ class EvalPropContext(object):
         self.linktargets = None
         self.dependencies = None
 
+    @property
+    def uid(self):
+        """The player at the center of the action (from the loctx).
+        Reading this marks the task as playerdependent: whatever we're
+        rendering can't be shared with other players. (See
+        generate_update.) So use loctx.uid if you just need to pass the
+        value along.
+        """
+        self.task.playerdependent = True
+        return self.loctx.uid
+    @uid.setter
+    def uid(self, val):
+        raise Exception('EvalPropContext.uid is immutable')
+
     @property
     def depth(self):
         """Shortcut implementation of ctx.depth.
@@ -227,6 +270,7 @@ class EvalPropContext(object):
         # These will be filled in if and when a gentext starts.
         self.gentexting = False
         self.genseed = None
+        self.genengine = None
         self.gencount = None
         self.genparams = None
 
@@ -448,10 +492,18 @@ class EvalPropContext(object):
                         self.genseed = str(self.loctx.iid).encode()
                     except:
                         self.genseed = b'???'
-                tree = twcommon.gentext.parse(res.get('text', ''))
+                tree = twcommon.gentext.parse_cached(res.get('text', ''))
                 toplevel = (not self.gentexting)
                 if toplevel:
-                    tree.setup_context(self)
+                    # The world may choose a seed engine (see the
+                    # gentext module).
+                    engine = None
+                    if self.loctx is not None and self.loctx.wid is not None:
+                        ent = yield self.app.propcache.get(('worldprop', self.loctx.wid, None, 'gentext_engine'),
+                                                           dependencies=self.dependencies)
+                        if ent:
+                            engine = ent.val
+                    tree.setup_context(self, engine)
                 try:
                     yield tree.perform(self, symbol.encode())
                 finally:
@@ -497,18 +549,16 @@ class EvalPropContext(object):
         """
         self.task.tick()
 
-        ### This originlabel stuff is pretty much wrong. Also slow.
-        ### And unnecessary, now that the build interface test-parses?
-        if originlabel:
-            if type(originlabel) is dict and 'text' in originlabel:
-                originlabel = originlabel['text']
-            originlabel = '"%.20s"' % (originlabel,)
-        else:
-            originlabel = '<script>'
-            
-        tree = ast.parse(text, filename=originlabel)
-        assert type(tree) is ast.Module
+        if self.compile_code:
+            func = code_compile_cache.get(text)
+            if func is None:
+                tree = parse_code(text, originlabel)
+                func = two.compiler.compile_module(tree)
+                code_compile_cache.put(text, func)
+            res = yield func(self)
+            return res
 
+        tree = parse_code(text, originlabel)
         res = None
         for nod in tree.body:
             res = yield self.execcode_statement(nod)
@@ -911,7 +961,9 @@ class EvalPropContext(object):
             return newval
         if not two.symbols.type_callable(funcval):
             raise TypeError('%s is not callable' % (type(funcval).__name__))
-        return funcval(*args, **kwargs)
+        res = funcval(*args, **kwargs)
+        two.symbols.note_method_call(self.app, funcval, args)
+        return res
     
     @tornado.gen.coroutine
     def exec_call_object(self, funcval, args, kwargs):
@@ -943,7 +995,9 @@ class EvalPropContext(object):
             return newval
         if not two.symbols.type_callable(funcval):
             raise TypeError('%s is not callable' % (type(funcval).__name__))
-        return funcval(*args, **kwargs)
+        res = funcval(*args, **kwargs)
+        two.symbols.note_method_call(self.app, funcval, args)
+        return res
         
     @tornado.gen.coroutine
     def execcode_name(self, nod):
@@ -1100,7 +1154,6 @@ class EvalPropContext(object):
     @tornado.gen.coroutine
     def invoke_typed_dict(self, res, symbol=None):
         restype = res.get('type', None)
-        uid = self.uid
 
         if self.level != LEVEL_EXECUTE:
             # If we're not in an action, we invoke text/code snippets.
@@ -1131,6 +1184,10 @@ class EvalPropContext(object):
                 return newval
             # All other special objects are returned as-is.
             return res
+
+        # Only look at the player now; reading self.uid marks the task
+        # as player-dependent, which would spoil shared renders.
+        uid = self.uid
         
         if restype in ('text', 'gentext', 'selfdesc', 'editstr'):
             # Set focus to this symbol-name
@@ -1222,22 +1279,22 @@ class EvalPropContext(object):
         """
         self.task.tick()
         
-        nodls = twcommon.interp.parse(text)
-        
-        # While trawling through nodls, we may encounter $if/$end
-        # nodes. This keeps track of them. Specifically: a 0 value
-        # means "within a true conditional"; 1 means "within a
-        # false conditional"; 2 means "in an else/elif after a true
-        # conditional."
-        suppstack = []
-        # We suppress output if any value in suppstack is nonzero.
-        # It's easiest to track sum(suppstack), so that's what this is.
-        suppressed = 0
-        
-        for nod in nodls:
+        parsed = twcommon.interp.parse_cached(text)
+        nodls = parsed.nodes
+        jumps = parsed.jumps
+        count = len(nodls)
+
+        # The $if/$elif/$else/$end structure has already been worked out
+        # (see ParsedText). When a condition fails, we jump straight to
+        # the next branch; when we run into the next branch of a
+        # conditional we were executing, we jump past its $end.
+        pos = 0
+        while pos < count:
+            nod = nodls[pos]
+            pos += 1
             if not (isinstance(nod, InterpNode)):
                 # String.
-                if nod and not suppressed:
+                if nod:
                     self.accum_append(nod, raw=True)
                 continue
             
@@ -1246,75 +1303,33 @@ class EvalPropContext(object):
             # lookup table. But only if it gets long.
 
             if nodkey == 'If':
-                if suppressed:
-                    # Can't get any more suppressed.
-                    suppstack.append(0)
-                    continue
-                try:
-                    ifval = yield self.evalobj(nod.expr, evaltype=EVALTYPE_CODE)
-                except LookupError: # includes SymbolError
-                    ifval = None
-                except AttributeError:
-                    ifval = None
-                if ifval:
-                    suppstack.append(0)
-                else:
-                    suppstack.append(1)
-                    suppressed += 1
-                continue
-                    
-            if nodkey == 'ElIf':
-                if len(suppstack) == 0:
-                    self.accum_append('[$elif without matching $if]')
-                    continue
-                if not suppressed:
-                    # We follow a successful "if". Suppress now.
-                    suppstack[-1] = 2
-                    suppressed = sum(suppstack)
-                    continue
-                if suppstack[-1] == 2:
-                    # We had a successful "if" earlier, so no change.
-                    continue
-                # We follow an unsuccessful "if". Maybe suppress.
-                try:
-                    ifval = yield self.evalobj(nod.expr, evaltype=EVALTYPE_CODE)
-                except LookupError: # includes SymbolError
-                    ifval = None
-                except AttributeError:
-                    ifval = None
-                if ifval:
-                    suppstack[-1] = 0
-                else:
-                    suppstack[-1] = 1
-                suppressed = sum(suppstack)
-                continue
-                    
-            if nodkey == 'End':
-                if len(suppstack) == 0:
-                    self.accum_append('[$end without matching $if]')
-                    continue
-                suppstack.pop()
-                suppressed = sum(suppstack)
+                branch = pos-1
+                while branch < count:
+                    bnod = nodls[branch]
+                    if bnod.classname != 'If' and bnod.classname != 'ElIf':
+                        # Else or End; run from here.
+                        break
+                    try:
+                        ifval = yield self.evalobj(bnod.expr, evaltype=EVALTYPE_CODE)
+                    except LookupError: # includes SymbolError
+                        ifval = None
+                    except AttributeError:
+                        ifval = None
+                    if ifval:
+                        break
+                    branch = jumps[branch][0]
+                pos = branch+1
                 continue
 
-            if nodkey == 'Else':
-                if len(suppstack) == 0:
-                    self.accum_append('[$else without matching $if]')
+            if nodkey == 'ElIf' or nodkey == 'Else' or nodkey == 'End':
+                jump = jumps[pos-1]
+                if jump is None:
+                    self.accum_append('[$%s without matching $if]' % (nodkey.lower(),))
                     continue
-                val = suppstack[-1]
-                if val == 1:
-                    val = 0
-                else:
-                    val = 2
-                suppstack[-1] = val
-                suppressed = sum(suppstack)
+                # End of an executed branch. Skip to the $end.
+                pos = jump[1]+1
                 continue
 
-            # The rest of these nodes cannot affect the suppression
-            # state.
-            if suppressed:
-                continue
-            
             if nodkey == 'Link':
                 # Non-printing element, append directly
                 if not nod.external:
@@ -1375,7 +1390,7 @@ class EvalPropContext(object):
             self.accum.append(nod.describe())
 
         # End of nodls interaction.
-        if len(suppstack) > 0:
+        if parsed.unterminated:
             self.accum.append('[$if without matching $end]')
             
         # We used raw mode, but if the ctx is in cooked mode, we'll fake
@@ -1695,6 +1710,26 @@ def optimize_accum(ls):
         end = beg
     return
 
+def parse_code(text, originlabel=None):
+    """Parse a pile of script code into an ast.Module. Raises SyntaxError
+    if the code is invalid. Results are cached (see code_parse_cache).
+    """
+    tree = code_parse_cache.get(text)
+    if tree is None:
+        ### This originlabel stuff is pretty much wrong.
+        ### And unnecessary, now that the build interface test-parses?
+        if originlabel:
+            if type(originlabel) is dict and 'text' in originlabel:
+                originlabel = originlabel['text']
+            originlabel = '"%.20s"' % (originlabel,)
+        else:
+            originlabel = '<script>'
+            
+        tree = ast.parse(text, filename=originlabel)
+        assert type(tree) is ast.Module
+        code_parse_cache.put(text, tree)
+    return tree
+
 def parse_argument_spec(spec):
     """Take a function argument spec (e.g. "x, y=3") and parse it into a
     structure. Raises SyntaxError if the spec is invalid.
@@ -1705,9 +1740,21 @@ def parse_argument_spec(spec):
     The caller should immediately evaluate these (self.execcode_expr).
     (The tests and code both assume that spec.defaults and spec.kw_defaults
     are reassignable.)
+
+    Parsed specs are cached. Since the caller reassigns the defaults, we
+    return a shallow copy of the cached structure every time.
     """
     if not spec:
         spec = ''
+    res = argspec_parse_cache.get(spec)
+    if res is None:
+        res = parse_argument_spec_uncached(spec)
+        argspec_parse_cache.put(spec, res)
+    return copy.copy(res)
+
+def parse_argument_spec_uncached(spec):
+    """The guts of parse_argument_spec().
+    """
     val = 'lambda %s : None' % (spec,)
     tree = ast.parse(val)
     assert type(tree) is ast.Module
@@ -1797,6 +1844,7 @@ from twcommon.interp import InterpNode
 from twcommon.gentext import GenNodeClass, SymbolNode, SeqNode, AltNode, ShuffleNode, BeginNode, WordNode, ANode, AFormNode, AnFormNode, RunOnNode, RunOnExplicitNode, RunOnCapNode, ParaNode, StopNode, SemiNode, CommaNode
 import two.execute
 import two.symbols
+import two.compiler
 import twcommon.gentext
 import two.grammar
 from two.task import DIRTY_ALL, DIRTY_WORLD, DIRTY_LOCALE, DIRTY_POPULACE, DIRTY_FOCUS
@@ -11,6 +11,7 @@ module, not here.)
 import datetime
 
 import tornado.gen
+import tornado.concurrent
 from bson.objectid import ObjectId
 import motor
 
@@ -336,6 +337,8 @@ class RemoteRealmProxy(PropertyProxyMixin, object):
         
         if not self.perms.candelete(key):
             raise Exception('Cannot delete this key from foreign world: %s' % (key,))
+        if iid is not None:
+            ctx.task.claim_lane(('iid', iid))
         
         tup = ('instanceprop', iid, None, key)
         yield app.propcache.delete(tup)
@@ -352,6 +355,8 @@ class RemoteRealmProxy(PropertyProxyMixin, object):
         
         if not self.perms.canwrite(key, val):
             raise Exception('Cannot write this key value to foreign world: %s=%s' % (key, repr(val)))
+        if iid is not None:
+            ctx.task.claim_lane(('iid', iid))
         
         tup = ('instanceprop', iid, None, key)
         yield app.propcache.set(tup, val)
@@ -463,10 +468,12 @@ class BoundSubscriptProxy(object):
     @tornado.gen.coroutine
     def delete(self, ctx, loctx):
         del self.arg[self.subscript]
+        ctx.app.propcache.note_mutation(self.arg)
     
     @tornado.gen.coroutine
     def store(self, ctx, loctx, val):
         self.arg[self.subscript] = val
+        ctx.app.propcache.note_mutation(self.arg)
 
 class MultiBoundProxy(object):
     """A load/delete/store object for a tuple of l/d/s objects. This
@@ -1082,6 +1089,7 @@ def generate_update(task, conn, dirty):
                                {'iid':1, 'locid':1, 'focus':1})
     
     iid = playstate['iid']
+    conn.iid = iid
     if not iid:
         msg['world'] = {'world':app.localize('label.in_transition'), 'scope':'\u00A0', 'creator':'...'}
         msg['focus'] = False ### probably needs to be something for linking out of the void
@@ -1098,6 +1106,24 @@ def generate_update(task, conn, dirty):
     locid = playstate['locid']
     loctx = two.task.LocContext(uid, wid, scid, iid, locid)
 
+    # Warm up the property cache for the panes we're about to render,
+    # in one batch. What each pane looked at last time is a good guess
+    # at what it will look at now.
+    prefetchkeys = []
+    prefetchdeps = set()
+    if dirty & DIRTY_LOCALE:
+        prefetchkeys.append('desc')
+        prefetchdeps.update(conn.localedependencies)
+    if dirty & DIRTY_FOCUS:
+        focusobj = playstate.get('focus', None)
+        if type(focusobj) is str:
+            prefetchkeys.append(focusobj)
+        prefetchdeps.update(conn.focusdependencies)
+    if dirty & DIRTY_TOOL:
+        prefetchkeys.append('instancepane')
+        prefetchdeps.update(conn.tooldependencies)
+    yield two.symbols.prefetch_symbols(app, loctx, prefetchkeys, dependencies=prefetchdeps)
+
     if dirty & DIRTY_WORLD:
         scope = yield motor.Op(app.mongodb.scopes.find_one,
                                {'_id':scid})
@@ -1132,26 +1158,13 @@ def generate_update(task, conn, dirty):
         conn.localeactions.clear()
         conn.localedependencies.clear()
 
-        ctx = EvalPropContext(task, loctx=loctx, level=LEVEL_DISPLAY)
-        try:
-            localedesc = yield ctx.eval('desc')
-        except Exception as ex:
-            task.log.warning('Exception rendering locale: %s', ex, exc_info=app.debugstacktraces)
-            localedesc = '[Exception: %s]' % (str(ex),)
+        (localedesc, locname, linktargets, dependencies) = yield shared_render(
+            task, ('locale', iid, locid), render_locale, task, loctx)
         
-        if ctx.linktargets:
-            conn.localeactions.update(ctx.linktargets)
-        if ctx.dependencies:
-            conn.localedependencies.update(ctx.dependencies)
-
-        location = yield motor.Op(app.mongodb.locations.find_one,
-                                  {'_id':locid},
-                                  {'wid':1, 'name':1})
-
-        if not location or location['wid'] != wid:
-            locname = '[Location not found]'
-        else:
-            locname = location['name']
+        if linktargets:
+            conn.localeactions.update(linktargets)
+        if dependencies:
+            conn.localedependencies.update(dependencies)
 
         msg['locale'] = { 'name': locname, 'desc': localedesc }
 
@@ -1161,37 +1174,24 @@ def generate_update(task, conn, dirty):
         
         # Build a list of all the other people in the location.
         conn.populacedependencies.add( ('populace', iid, locid) )
-        cursor = app.mongodb.playstate.find({'iid':iid, 'locid':locid},
-                                            {'_id':1, 'lastmoved':1})
+        allpeople = yield shared_render(
+            task, ('populace', iid, locid), gather_populace, task, iid, locid)
         people = []
-        while (yield cursor.fetch_next):
-            ostate = cursor.next_object()
-            if ostate['_id'] == uid:
+        for (ouid, oname) in allpeople:
+            if ouid == uid:
                 continue
-            if not ostate.get('lastmoved', None):
-                # If no lastmoved field, set it to the beginning of time.
-                ostate['lastmoved'] = datetime.datetime.min
-            people.append(ostate)
             ackey = 'play' + EvalPropContext.build_action_key()
-            ostate['_ackey'] = ackey
-            conn.populaceactions[ackey] = ('player', ostate['_id'])
-            conn.populacedependencies.add( ('playstate', ostate['_id'], 'locid') )
-        # cursor autoclose
-        for ostate in people:
-            oplayer = yield motor.Op(app.mongodb.players.find_one,
-                                     {'_id':ostate['_id']},
-                                     {'name':1})
-            ostate['name'] = oplayer.get('name', '???')
+            people.append( (ackey, oname) )
+            conn.populaceactions[ackey] = ('player', ouid)
+            conn.populacedependencies.add( ('playstate', ouid, 'locid') )
 
         if not people:
             populacedesc = False
         else:
-            # Sort the list by lastmoved.
-            people.sort(key=lambda ostate:ostate['lastmoved'])
             populacedesc = [ 'You see ' ]  # Location property? Routine?
             pos = 0
             numpeople = len(people)
-            for ostate in people:
+            for (ackey, oname) in people:
                 if pos > 0:
                     if numpeople == 2:
                         populacedesc.append(' and ')
@@ -1199,8 +1199,8 @@ def generate_update(task, conn, dirty):
                         populacedesc.append(', and ')
                     else:
                         populacedesc.append(', ')
-                populacedesc.append(['link', ostate['_ackey']])
-                populacedesc.append(ostate['name'])
+                populacedesc.append(['link', ackey])
+                populacedesc.append(oname)
                 populacedesc.append(['/link'])
                 pos += 1
             populacedesc.append(' here.')
@@ -1537,6 +1537,102 @@ def perform_action(task, cmd, conn, target):
         conn.write({'cmd':'error', 'text':exmsg})
         
     
+@tornado.gen.coroutine
+def shared_render(task, key, func, *args):
+    """Call func(*args), which is a coroutine returning (result, shareable).
+    While the task is resolving, a shareable result is remembered under
+    key, and other connections asking for the same key get the same
+    result without rendering it again. (If several ask at once, they
+    wait for the first one.) A non-shareable result is only used by the
+    connection which rendered it; the others render their own.
+    Returns the result.
+    """
+    renders = task.sharedrenders
+    if renders is None:
+        (res, shareable) = yield func(*args)
+        return res
+    
+    fut = renders.get(key, None)
+    if fut is not None:
+        res = yield fut
+        if res is not None:
+            return res
+        (res, shareable) = yield func(*args)
+        return res
+
+    fut = tornado.concurrent.Future()
+    renders[key] = fut
+    try:
+        (res, shareable) = yield func(*args)
+    except:
+        fut.set_result(None)
+        raise
+    if shareable:
+        fut.set_result(res)
+    else:
+        fut.set_result(None)
+    return res
+
+@tornado.gen.coroutine
+def render_locale(task, loctx):
+    """The part of generate_update() that renders the location description.
+    Returns ((desc, name, linktargets, dependencies), shareable).
+    The result is shareable if the description never looked at which
+    player it was rendered for, and never called the random functions.
+    """
+    app = task.app
+    task.playerdependent = False
+    
+    ctx = EvalPropContext(task, loctx=loctx, level=LEVEL_DISPLAY)
+    try:
+        localedesc = yield ctx.eval('desc')
+    except Exception as ex:
+        task.log.warning('Exception rendering locale: %s', ex, exc_info=app.debugstacktraces)
+        localedesc = '[Exception: %s]' % (str(ex),)
+    shareable = not task.playerdependent
+
+    location = yield motor.Op(app.mongodb.locations.find_one,
+                              {'_id':loctx.locid},
+                              {'wid':1, 'name':1})
+
+    if not location or location['wid'] != loctx.wid:
+        locname = '[Location not found]'
+    else:
+        locname = location['name']
+
+    res = (localedesc, locname, ctx.linktargets, ctx.dependencies)
+    return (res, shareable)
+
+@tornado.gen.coroutine
+def gather_populace(task, iid, locid):
+    """The part of generate_update() that finds who is in a location.
+    Returns (list of (uid, name), shareable), sorted by arrival time.
+    This includes everybody, so it's always shareable; the caller
+    leaves itself out.
+    """
+    app = task.app
+    cursor = app.mongodb.playstate.find({'iid':iid, 'locid':locid},
+                                        {'_id':1, 'lastmoved':1})
+    people = []
+    while (yield cursor.fetch_next):
+        ostate = cursor.next_object()
+        if not ostate.get('lastmoved', None):
+            # If no lastmoved field, set it to the beginning of time.
+            ostate['lastmoved'] = datetime.datetime.min
+        people.append(ostate)
+    # cursor autoclose
+    for ostate in people:
+        oplayer = yield motor.Op(app.mongodb.players.find_one,
+                                 {'_id':ostate['_id']},
+                                 {'name':1})
+        ostate['name'] = oplayer.get('name', '???')
+
+    # Sort the list by lastmoved.
+    people.sort(key=lambda ostate:ostate['lastmoved'])
+    res = [ (ostate['_id'], ostate['name']) for ostate in people ]
+    return (res, True)
+
+
 # Late imports, to avoid circularity
 from two.task import DIRTY_ALL, DIRTY_WORLD, DIRTY_LOCALE, DIRTY_POPULACE, DIRTY_FOCUS, DIRTY_TOOL
 from two.evalctx import EvalPropContext
@@ -1,8 +1,8 @@
 """
 The collection of instances which are currently "awake", that is, in use
 by players. We use this to optimize resource usage -- timer events, in
-particular. (A future version will probably use this for property caching
-as well.)
+particular. It can also preload the property cache when an instance
+wakes up (see the propcache_warmup option).
 
 The scheduling queue for script events is based on these principles:
 
@@ -13,16 +13,37 @@ The scheduling queue for script events is based on these principles:
 - When an instance is asleep, it has no timer events in the queue. (All
   its events are dropped after the on_sleep call.) The on_wake call is
   responsible for setting these up if necessary.
-- The sched queue is purely in-memory; it has no database representation.
-  This means that if the server crashes or is shut down, all instances
-  are de facto asleep -- and the on_sleep call will not occur. Don't rely
-  on it.
+- By default, the sched queue is purely in-memory; it has no database
+  representation. This means that if the server crashes or is shut down,
+  all instances are de facto asleep -- and the on_sleep call will not
+  occur. Don't rely on it.
 - When the server starts up, on_wake calls occur for every inhabited
   instance. (Alternatively, we may boot all those players to the void and
   let the wake-ups occur if/when they reappear.)
+- If the persist_timers option is set, timer events are also stored in
+  the schedevents collection (except those whose function is a callable
+  object, which only exists in memory). Then, when the server starts up,
+  an inhabited instance which was awake when it went down just picks up
+  its stored timer events where they left off. It doesn't get an on_wake
+  call. Events which came due while the server was down fire right away
+  (repeating ones, just once). A repeating event which didn't miss a
+  firing just waits for its next one. But if the instance had an event
+  which couldn't be stored, it is marked (unstoredtimers), and it gets
+  an on_wake call as usual instead.
+
+All the instances' timer events live in a single TimerWheel, rather than
+each having its own IOLoop timeout. The wheel ticks (a couple of times a
+second) only while it holds any events.
 """
 
+import math
 import datetime
+import collections
+
+import tornado.gen
+import tornado.stack_context
+
+import motor
 
 import twcommon.misc
 from twcommon.excepts import ExecRunawayException
@@ -49,6 +70,9 @@ class InstancePool:
         # Maps iids (ObjectIds) to Instance objects.
         self.map = {}
 
+        # The timer events of all the instances.
+        self.wheel = TimerWheel(app)
+
     def count(self):
         """How many instances are currently awake?
         """
@@ -82,6 +106,24 @@ class InstancePool:
         self.map[iid] = instance
         return True
 
+    @tornado.gen.coroutine
+    def warm_up_instance(self, wid, iid, locid=None):
+        """Preload the property cache for a newly-awakened instance: all
+        its realm-level properties, plus those of the given location (if
+        any). This is limited to propcache_warmup bytes per instance;
+        if that option is zero, this does nothing.
+
+        This is only an optimization, so failures are logged and ignored.
+        """
+        budget = self.app.opts.propcache_warmup
+        if not budget:
+            return
+        try:
+            count = yield self.app.propcache.load_location(wid, iid, locid, budget)
+            self.log.info('Preloaded %d properties for instance %s', count, iid)
+        except Exception as ex:
+            self.log.warning('Unable to preload properties for instance %s: %s', iid, ex)
+
     def remove_instance(self, iid):
         """Remove an instance which has been put to sleep.
         """
@@ -91,11 +133,105 @@ class InstancePool:
         instance.remove_timer_events()
         instance.close()
 
+    @tornado.gen.coroutine
+    def store_timer_event(self, timer):
+        """Write a timer event to the database, if the persist_timers
+        option is set. (The sched() function calls this after
+        add_timer_event.)
+
+        This is only a safety net, so failures are logged and ignored.
+        """
+        if not self.app.opts.persist_timers:
+            return
+        func = timer.func
+        instance = timer.instance
+        if not (isinstance(func, str) or twcommon.misc.is_typed_dict(func, 'code')):
+            # A callable object can't be stored. We mark the instance,
+            # so that after a restart it gets an on_wake call rather
+            # than resuming without this event.
+            if instance.unstoredtimers:
+                return
+            instance.unstoredtimers = True
+            self.log.warning('Unable to store timer event for instance %s: %r is not code; the instance will be woken afresh after a restart', instance.iid, func)
+            try:
+                yield motor.Op(self.app.mongodb.instances.update,
+                               {'_id':instance.iid},
+                               {'$set':{'unstoredtimers':True}})
+            except Exception as ex:
+                self.log.warning('Unable to mark instance %s: %s', instance.iid, ex)
+            return
+        # The due time is stored as a datetime; for a repeating event,
+        # it's the first due time, so that the schedule can be worked
+        # out without updating it every time the event fires.
+        due = twcommon.misc.now() + datetime.timedelta(seconds=(timer.due - self.app.ioloop.time()))
+        doc = { 'iid':timer.instance.iid, 'due':due,
+                'delta':timer.delta.total_seconds(), 'repeat':timer.repeat,
+                'func':func, 'cancel':timer.cancel }
+        try:
+            dbid = yield motor.Op(self.app.mongodb.schedevents.insert, doc)
+            if timer not in timer.instance.timers:
+                # It fired (or was cancelled) while we were waiting.
+                yield motor.Op(self.app.mongodb.schedevents.remove,
+                               {'_id':dbid})
+            else:
+                timer.dbid = dbid
+        except Exception as ex:
+            self.log.warning('Unable to store timer event for instance %s: %s', timer.instance.iid, ex)
+
+    @tornado.gen.coroutine
+    def unstore_timer_events(self, timers):
+        """Delete stored timer events which have been cancelled (or have
+        fired, and don't repeat).
+        """
+        ls = [ timer.dbid for timer in timers if timer.dbid is not None ]
+        if not ls:
+            return
+        yield motor.Op(self.app.mongodb.schedevents.remove,
+                       {'_id':{'$in':ls}})
+
+    @tornado.gen.coroutine
+    def unstore_instance_timers(self, iid):
+        """Delete all the stored timer events for an instance which has
+        gone to sleep (or which is being woken afresh).
+        """
+        if not self.app.opts.persist_timers:
+            return
+        yield motor.Op(self.app.mongodb.schedevents.remove,
+                       {'iid':iid})
+        yield motor.Op(self.app.mongodb.instances.update,
+                       {'_id':iid},
+                       {'$unset':{'unstoredtimers':1}})
+
+    @tornado.gen.coroutine
+    def load_timer_events(self, iid, lastactive=None):
+        """Reload the stored timer events for an instance which was
+        awake when the server went down. (The instance must be in the
+        pool.) The lastactive argument is when the server was last known
+        to be running, if we know. Returns the number of events.
+        """
+        instance = self.map[iid]
+        nowdt = twcommon.misc.now()
+        count = 0
+        cursor = self.app.mongodb.schedevents.find({'iid':iid})
+        while (yield cursor.fetch_next):
+            doc = cursor.next_object()
+            if len(instance.timers) >= InstancePool.MAX_SCHED_EVENTS:
+                self.log.warning('Instance %s has too many stored timer events', iid)
+                break
+            instance.add_stored_timer_event(doc, nowdt, lastactive)
+            count += 1
+        # cursor autoclose
+        return count
+
 class Instance:
     def __init__(self, app, iid):
         self.app = app
         self.iid = iid
         self.timers = set()
+        # Maps cancel keys to sets of timers, so that unsched() doesn't
+        # have to search. (Timers with an unhashable cancel key are
+        # only in self.timers.)
+        self.cancelmap = {}
 
         now = twcommon.misc.now()
         
@@ -109,12 +245,16 @@ class Instance:
         # Total number of timer events that have run in this waking period.
         self.totaltimerevents = 0
 
+        # Set if a timer event couldn't be stored (see persist_timers).
+        self.unstoredtimers = False
+
     def close(self):
         if len(self.timers):
             self.app.log.warning('Instance had %d timers at close!', len(self.timers))
         self.app = None
         self.iid = None
         self.timers = None
+        self.cancelmap = None
 
     def ancientify(self):
         """Make this instance appear to not have been touched in a very
@@ -140,64 +280,275 @@ class Instance:
             raise ExecRunawayException('sched(): limit of %d events at a time' % (InstancePool.MAX_SCHED_EVENTS,))
 
         # Add the event.
-        timer = TimerEvent(delta, func, repeat=repeat, cancel=cancel)
+        cancel = cancel_key(cancel)
+        timer = TimerEvent(self, delta, func, repeat=repeat, cancel=cancel)
+        timer.due = self.app.ioloop.time() + delta.total_seconds()
         self.timers.add(timer)
+        if cancel is not None and is_hashable(cancel):
+            self.cancelmap.setdefault(cancel, set()).add(timer)
+        self.app.ipool.wheel.add(timer)
+        return timer
 
-        # We use IOLoop.add_timeout for both single and repeating events.
-        ### This means a bit of inevitable timer drift.
-        timer.cancelrock = self.app.ioloop.add_timeout(delta, lambda:self.fire_timer_event(timer))
+    def add_stored_timer_event(self, doc, nowdt, lastactive=None):
+        """Add a timer event loaded from the database. (See
+        InstancePool.load_timer_events.) The nowdt argument is the current
+        time, as a datetime; lastactive is when the server was last known
+        to be running (or None).
+        """
+        delta = datetime.timedelta(seconds=doc['delta'])
+        # BSON turns tuples into lists, so the cancel key must be
+        # converted back.
+        cancel = cancel_key(doc.get('cancel', None))
+        timer = TimerEvent(self, delta, doc['func'], repeat=doc['repeat'], cancel=cancel)
+        timer.dbid = doc['_id']
+        due = doc['due']
+        if timer.repeat and due < nowdt:
+            # The stored due time is the first one. Find the last time
+            # the event came due. If that was while the server was down
+            # (or we don't know when it went down), the event missed a
+            # firing, so it's overdue. Otherwise it already fired, and
+            # waits for the next period.
+            period = delta.total_seconds()
+            count = math.floor((nowdt - due).total_seconds() / period)
+            lastdue = due + datetime.timedelta(seconds=period*count)
+            if lastactive is not None and lastdue <= lastactive:
+                due = lastdue + delta
+        now = self.app.ioloop.time()
+        timer.due = now + (due - nowdt).total_seconds()
+        self.timers.add(timer)
+        if timer.cancel is not None and is_hashable(timer.cancel):
+            self.cancelmap.setdefault(timer.cancel, set()).add(timer)
+        # If it's overdue, it goes in the next tick. (A repeating event
+        # then skips ahead to its next due time, as usual.)
+        self.app.ipool.wheel.add(timer)
+        return timer
 
     def remove_timer_events(self, cancel=None):
         """Remove all timer events which match the given cancel key.
         If the argument is not provided or None, remove *all* timer events
-        for the instance.
+        for the instance. Returns a list of the removed events.
         """
+        cancel = cancel_key(cancel)
         if cancel is None:
             ls = list(self.timers)
+        elif is_hashable(cancel):
+            ls = list(self.cancelmap.get(cancel, ()))
         else:
             ls = [ timer for timer in self.timers if timer.cancel == cancel ]
         for timer in ls:
-            try:
-                if timer.cancelrock is not None:
-                    self.app.ioloop.remove_timeout(timer.cancelrock)
-            except:
-                pass
-            try:
-                self.timers.remove(timer)
-            except:
-                pass
+            self.drop_timer_event(timer)
             # Mark the timer as done-with.
             timer.delta = None
+        return ls
+
+    def drop_timer_event(self, timer):
+        """Take a timer event out of the wheel and out of our tables.
+        """
+        self.app.ipool.wheel.remove(timer)
+        self.timers.discard(timer)
+        if timer.cancel is not None and is_hashable(timer.cancel):
+            tset = self.cancelmap.get(timer.cancel, None)
+            if tset is not None:
+                tset.discard(timer)
+                if not tset:
+                    del self.cancelmap[timer.cancel]
+
+    def fire_timer_events(self, timers, now):
+        """Invoked by the wheel when some of our timer events come due
+        (in order of due time). Note that this is *not* called from the
+        command queue! We may be in the middle of some task. So we do
+        nothing except queue a command and (perhaps) reschedule the
+        timers.
+
+        All the events go into one timerevent command, so they run in
+        a single task.
+        """
+        funcs = []
+        dbids = []
+        for timer in timers:
+            try:
+                self.fire_timer_event(timer, now)
+                funcs.append(timer.func)
+                if not timer.repeat and timer.dbid is not None:
+                    dbids.append(timer.dbid)
+            except Exception as ex:
+                self.app.log.error('Error firing timer event: %s', ex, exc_info=True)
+        if funcs:
+            obj = {'cmd':'timerevent', 'iid':self.iid, 'funcs':funcs}
+            if dbids:
+                # Stored events are deleted once they've run.
+                obj['dbids'] = dbids
+            self.app.queue_command(obj)
 
-    def fire_timer_event(self, timer):
-        """Invoked when a timer event fires. Note that this is *not*
-        called from the command queue! We may be in the middle of some
-        task. So we do nothing except queue a command and (perhaps)
-        reschedule the timer.
+    def fire_timer_event(self, timer, now):
+        """Reschedule or discard one timer event which has come due.
+        (See fire_timer_events.)
         """
         if timer not in self.timers:
             raise Exception('Timer not in instance timers list!')
         if timer.delta is None:
             raise Exception('Timer executing after being cancelled!')
         
-        # It's out of the ioloop queue, so this cancelrock is no longer useful.
-        timer.cancelrock = None
-        
         if timer.repeat:
-            # Reschedule repeating events, and leave in timers list.
-            timer.cancelrock = self.app.ioloop.add_timeout(timer.delta, lambda:self.fire_timer_event(timer))
+            # Reschedule repeating events, and leave in timers list. The
+            # next time is counted from when this one was due, not from
+            # now, so the period doesn't drift. If we've fallen more than
+            # a whole period behind, skip the missed firings rather than
+            # running them all at once.
+            timer.due += timer.delta.total_seconds()
+            timer.skip_missed(now)
+            self.app.ipool.wheel.add(timer)
         else:
             # Remove from timers list.
-            self.timers.remove(timer)
-
-        self.app.queue_command({'cmd':'timerevent', 'iid':self.iid, 'func':timer.func})
+            self.drop_timer_event(timer)
         
 class TimerEvent:
     """Record of a scheduled timer event. Data-only class.
+
+    The due time is in IOLoop.time() seconds. While the event is in the
+    TimerWheel, tick is the wheel tick it's waiting for; otherwise None.
+    If the event is stored in the database, dbid is its _id there.
     """
-    def __init__(self, delta, func, repeat=False, cancel=None):
+
+    # Counter for generating seq values. Events with the same due time
+    # fire in the order they were set up.
+    counter = 1
+    
+    def __init__(self, instance, delta, func, repeat=False, cancel=None):
+        self.seq = TimerEvent.counter
+        TimerEvent.counter += 1
+        self.instance = instance
         self.delta = delta
         self.func = func
         self.repeat = repeat
         self.cancel = cancel
-        self.cancelrock = None
+        self.due = None
+        self.tick = None
+        self.dbid = None
+
+    def skip_missed(self, now):
+        """For a repeating event whose due time has passed: move the due
+        time ahead by whole periods, to the first one after now.
+        """
+        if self.due <= now:
+            period = self.delta.total_seconds()
+            self.due += period * (math.floor((now - self.due) / period) + 1)
+
+class TimerWheel:
+    """A hashed timing wheel, holding the timer events of every awake
+    instance.
+
+    Time is divided into ticks of TICK seconds. An event due at time t
+    goes in the slot for tick ceil(t/TICK), modulo the number of slots;
+    so adding and removing an event are constant-time. Events more than
+    a full turn of the wheel away share slots with nearer ones, and just
+    wait until their own tick comes around.
+
+    While the wheel holds any events, one IOLoop timeout fires at each
+    tick boundary, and fires every event that has come due. The events
+    for each instance are queued as a single command. When the wheel is
+    empty, it stops ticking.
+    """
+
+    TICK = 0.5   # seconds
+    SLOTS = 512  # so a turn of the wheel is about four minutes
+
+    def __init__(self, app):
+        self.app = app
+        self.slots = [ set() for ix in range(self.SLOTS) ]
+        self.count = 0
+        # The next tick to be processed, and the IOLoop timeout that
+        # will process it. Both None when the wheel is stopped.
+        self.curtick = None
+        self.timeout = None
+
+    def __len__(self):
+        return self.count
+
+    def add(self, timer):
+        """Put a timer event (whose due time is set) into the wheel.
+        """
+        assert timer.tick is None, 'Timer is already in the wheel'
+        if self.curtick is None:
+            self.curtick = int(math.floor(self.app.ioloop.time() / self.TICK)) + 1
+        # Never put an event behind the wheel's position; it would have
+        # to wait a whole turn.
+        tick = max(int(math.ceil(timer.due / self.TICK)), self.curtick)
+        timer.tick = tick
+        self.slots[tick % self.SLOTS].add(timer)
+        self.count += 1
+        if self.timeout is None:
+            self.schedule()
+
+    def remove(self, timer):
+        """Take a timer event out of the wheel, if it's there.
+        """
+        if timer.tick is None:
+            return
+        self.slots[timer.tick % self.SLOTS].discard(timer)
+        timer.tick = None
+        self.count -= 1
+
+    def schedule(self):
+        """Set up the IOLoop timeout for the next tick.
+        """
+        # (The timeout shouldn't hang onto the context of the task that
+        # set it up.)
+        with tornado.stack_context.NullContext():
+            self.timeout = self.app.ioloop.add_timeout(self.curtick * self.TICK, self.advance)
+
+    def advance(self):
+        """IOLoop callback: process every tick up to now, firing the
+        events that are due.
+        """
+        self.timeout = None
+        now = self.app.ioloop.time()
+        nowtick = int(math.floor(now / self.TICK))
+        fired = []
+        # If the loop was stalled for more than a turn of the wheel, we
+        # look at each slot once; that catches everything.
+        for tick in range(self.curtick, min(nowtick+1, self.curtick+self.SLOTS)):
+            slot = self.slots[tick % self.SLOTS]
+            if not slot:
+                continue
+            for timer in list(slot):
+                if timer.tick <= nowtick:
+                    slot.remove(timer)
+                    timer.tick = None
+                    self.count -= 1
+                    fired.append(timer)
+        self.curtick = max(self.curtick, nowtick+1)
+
+        # Fire in order of due time, gathered by instance. (Repeating
+        # events go back into the wheel here.)
+        fired.sort(key=lambda timer: (timer.due, timer.seq))
+        byinstance = collections.OrderedDict()
+        for timer in fired:
+            byinstance.setdefault(timer.instance, []).append(timer)
+        for (instance, timers) in byinstance.items():
+            instance.fire_timer_events(timers, now)
+
+        if self.count:
+            if self.timeout is None:
+                self.schedule()
+        else:
+            self.curtick = None
+
+def cancel_key(val):
+    """Convert a cancel key to the form we keep it in: lists become
+    tuples (recursively). A tuple key survives a trip through the
+    database that way, and a list key can go in the cancel map.
+    """
+    if isinstance(val, (list, tuple)):
+        return tuple([ cancel_key(subval) for subval in val ])
+    return val
+
+def is_hashable(val):
+    """Can this value be a dict key? (Script values are usually strings,
+    but they might be lists.)
+    """
+    try:
+        hash(val)
+        return True
+    except TypeError:
+        return False
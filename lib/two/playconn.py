@@ -2,9 +2,9 @@
 Keep track of which players are connected.
 
 Each player is connected through a tweb server, so each PlayerConnection
-is associated with a WebConnIOStream. (In fact, the way tworld is currently
-set up, each PlayerConnection is associated with the *same* WebConnIOStream.
-We only have one.)
+is associated with a WebConnIOStream. There may be several twebs; their
+connection IDs are partitioned by tweb node number, so a connid is unique
+across all of them.
 """
 
 from bson.objectid import ObjectId
@@ -23,10 +23,9 @@ class PlayerConnectionTable(object):
         self.log = self.app.log
 
         self.map = {}  # maps connids to PlayerConnections.
-        # If we wanted to set the system up with several twebs, we'd
-        # need to either partition connids among them (so they don't
-        # collide) or key this on (twwcid, connid). Currently we only
-        # support a single tweb, so I am ignoring the problem.
+        # Several twebs may be connected. Their connids are partitioned
+        # by node number (see wcproto.make_connid), so they don't collide,
+        # and we can key on connid alone.
 
         self.uidmap = {} # maps uids (ObjectIds) to sets of PlayerConnections.
 
@@ -35,6 +34,12 @@ class PlayerConnectionTable(object):
         # is punted to the void.
         self.disconnectedmap = {} # maps uids to disconnect timestamps
 
+        # Inverted index of the connections' dependency sets. Maps each
+        # change key to a dict of {connid: dirtybits}. The DependencySets
+        # keep this up to date as they change, so that resolving a task
+        # only has to look at the connections its changes affect.
+        self.depindex = {}
+
     def get(self, connid):
         """Look up a player connection by its ID. Returns None if not found.
         """
@@ -82,12 +87,15 @@ class PlayerConnectionTable(object):
         self.disconnectedmap.pop(conn.uid, None)
         return conn
 
-    def remove(self, connid):
+    def remove(self, connid, moved=False):
         """Remove a dead player connection. This should only be invoked
-        from the "disconnect" and "playerconnect" commands.
+        from the "disconnect" and "playerconnect" commands -- or, with
+        moved=True, when the player is being handed off to another
+        tworld shard. (A moved player doesn't count as disconnected.)
         """
         conn = self.map[connid]
-        self.disconnectedmap[conn.uid] = twcommon.misc.now()
+        if not moved:
+            self.disconnectedmap[conn.uid] = twcommon.misc.now()
         del self.map[connid]
         uset = self.uidmap.get(conn.uid, None)
         if uset:
@@ -96,6 +104,19 @@ class PlayerConnectionTable(object):
                 del self.uidmap[conn.uid]
         conn.close()
 
+    def dirty_for_changes(self, changeset):
+        """Given a set of change keys, work out which connections need
+        updating. Returns a dict mapping connids to dirty bits. Connections
+        which don't depend on any of the changes are not included.
+        """
+        res = {}
+        for key in changeset:
+            entry = self.depindex.get(key, None)
+            if entry:
+                for (connid, dirty) in entry.items():
+                    res[connid] = res.get(connid, 0) | dirty
+        return res
+
     def disconnected_time_uid(self, uid):
         """How long ago the given uid disconnected. Returns None if there
         is no disconnect record (or if the uid is still connected).
@@ -121,6 +142,13 @@ class PlayerConnectionTable(object):
             self.log.debug('ERROR: empty set in uidmap!')
         if uidsum != len(self.map):
             self.log.debug('ERROR: uidmap has %d entries!', uidsum)
+        self.log.debug('Dependency index has %d keys', len(self.depindex))
+        for (key, entry) in self.depindex.items():
+            if not entry:
+                self.log.debug('ERROR: empty entry in depindex for %s!', key)
+            for connid in entry:
+                if connid not in self.map:
+                    self.log.debug('ERROR: depindex for %s refers to dead connection %d!', key, connid)
 
 class PlayerConnection(object):
     """PlayerConnection represents one connected player.
@@ -139,6 +167,11 @@ class PlayerConnection(object):
         self.stream = stream   # WebConnIOStream that handles this connection
         self.twwcid = stream.twwcid
 
+        # The instance the player was in, as of the last update we
+        # generated. (None if unknown or in the void.) The command
+        # scheduler uses this to decide what can run concurrently.
+        self.iid = None
+
         # Map action codes to bits of script, for the player's current
         # location (and focus).
         # (We don't try to keep these in the database, because if the
@@ -150,11 +183,11 @@ class PlayerConnection(object):
         self.toolactions = {}
 
         # Sets of what change keys will cause the location (focus, etc)
-        # text to change.
-        self.localedependencies = set()
-        self.focusdependencies = set()
-        self.populacedependencies = set()
-        self.tooldependencies = set()
+        # text to change. These are entered in the table's depindex.
+        self.localedependencies = DependencySet(table, connid, two.task.DIRTY_LOCALE)
+        self.focusdependencies = DependencySet(table, connid, two.task.DIRTY_FOCUS)
+        self.populacedependencies = DependencySet(table, connid, two.task.DIRTY_POPULACE)
+        self.tooldependencies = DependencySet(table, connid, two.task.DIRTY_TOOL)
 
         # Only used by the /eval command.
         self.debuglocals = {}
@@ -165,6 +198,12 @@ class PlayerConnection(object):
     def close(self):
         """Clean up dangling references.
         """
+        # Remove our entries from the table's depindex.
+        self.localedependencies.clear()
+        self.focusdependencies.clear()
+        self.populacedependencies.clear()
+        self.tooldependencies.clear()
+        
         self.table = None
         self.connid = None
         self.stream = None
@@ -189,3 +228,55 @@ class PlayerConnection(object):
         except Exception as ex:
             self.table.log.error('Unable to write to %d: %s', self.connid, ex)
             return False
+
+class DependencySet(set):
+    """A set of change keys which one pane of a PlayerConnection depends
+    on. Changes to the set are mirrored in the PlayerConnectionTable's
+    depindex.
+
+    Only the add(), update(), discard(), and clear() methods do this!
+    Other ways of modifying the set in place (|=, pop(), etc) would leave
+    the index out of date, so don't use them.
+    """
+
+    def __init__(self, table, connid, dirtybit):
+        set.__init__(self)
+        self.depindex = table.depindex
+        self.connid = connid
+        self.dirtybit = dirtybit
+
+    def add(self, key):
+        if key in self:
+            return
+        set.add(self, key)
+        entry = self.depindex.get(key, None)
+        if entry is None:
+            self.depindex[key] = { self.connid: self.dirtybit }
+        else:
+            entry[self.connid] = entry.get(self.connid, 0) | self.dirtybit
+
+    def update(self, *others):
+        for keys in others:
+            for key in keys:
+                self.add(key)
+
+    def discard(self, key):
+        if key not in self:
+            return
+        set.discard(self, key)
+        entry = self.depindex[key]
+        dirty = entry[self.connid] & ~self.dirtybit
+        if dirty:
+            entry[self.connid] = dirty
+        else:
+            del entry[self.connid]
+            if not entry:
+                del self.depindex[key]
+
+    def clear(self):
+        for key in list(self):
+            self.discard(key)
+
+
+# Late imports, to avoid circularity
+import two.task
@@ -8,39 +8,65 @@ When a property is changed or deleted, we add a cache entry with the dirty
 flag. At the end of the task, we call write_all_dirty() to resolve these
 back to the database (update or delete).
 
-This also tracks mutable values. If a list or dict changes, write_all_dirty()
-detects that too and does an update.
-
-Currently, this lives in the app, but its lifespan is just the duration of one
-task. A future version may hang around longer.
-
-### Future version should also do work in write_all_dirty() to break apart
-### objmap sets larger than 1. Deepcopy all values, so that there's no
-### id sharing any more.
+This also tracks mutable values. Every list and dict inside a cached value
+is noted in the containermap. Script code which changes a list or dict in
+place calls note_mutation(), which marks the owning entries as changed.
+At the end of the task, note_changed_entries() turns those into dirty
+entries, and write_all_dirty() updates them. (Code outside the script
+sandbox which modifies cached values must call note_mutation() too.)
+
+Each running task has its own cache; the app makes it current as
+app.propcache. By default its lifespan is just the duration of one task. If
+the app is configured with a propcache_limit, caches hang around for the
+life of the process instead, and are handed from task to task. Clean
+entries are kept from task to task (most-recently-used first), and the
+cache is trimmed back to the limit at the end of each task. Anything we
+can't trust at that point -- entries which failed to write back, or were
+mutated without being noted -- is dropped.
+
+A long-lived cache only sees writes that go through it. (The app passes
+along each task's writes to the other caches.) Code which writes property
+collections directly (the /setprop debug commands, build edits from tweb,
+guest cleanup) must call invalidate() or one of its siblings, on every
+cache in app.all_propcaches(), with the same dependency keys it reports
+through set_data_change().
 """
 
 import datetime
+import collections
 
 import tornado.gen
 import bson
 from bson.objectid import ObjectId
 import motor
 
+import twcommon.misc
+
 # Collections that code may update. (As opposed to 'worldprop', etc,
 # which may only be updated by build code.)
 writable_collections = set(['instanceprop', 'iplayerprop'])
 
 class PropCache:
-    def __init__(self, app):
+    def __init__(self, app, limit=0):
         # Keep a link to the owning application.
         self.app = app
         self.log = self.app.log
 
-        self.propmap = {}  # maps tuple to PropEntry
+        # If nonzero, this cache persists across tasks, and we keep at
+        # most this many entries between tasks.
+        self.limit = limit
+
+        self.propmap = collections.OrderedDict()  # maps tuple to PropEntry
+        # propmap is kept in least-recently-used order, so that trimming
+        # can pop entries off the front.
         self.objmap = {}  # maps id(val) to set of PropEntry
         # objmap only contains entries for mutable values. A given value
         # may be in more than one property; that's why objmap contains
-        # sets. (But we break these apart at write_all_dirty() time.)
+        # sets. (A persistent cache breaks these apart in finish_task().)
+        self.containermap = {}  # maps id(list or dict) to set of PropEntry
+        # containermap covers every container inside a mutable value,
+        # including the value itself.
+        self.changedset = set()  # entries changed since note_changed_entries
 
     def final(self):
         """Shut down and clean up.
@@ -56,11 +82,15 @@ class PropCache:
         # PropCache someday and that would be a ref cycle.
         self.objmap.clear()
         self.propmap.clear()
+        self.containermap.clear()
+        self.changedset.clear()
 
         # Shut down.
         self.app = None
         self.objmap = None
         self.propmap = None
+        self.containermap = None
+        self.changedset = None
 
     def dump(self):
         """Print out cache contents. For debugging only.
@@ -72,6 +102,8 @@ class PropCache:
             print('...and %d in objmap' % (len(self.objmap)))
             for (id, oset) in self.objmap.items():
                 print('  %s: %s' % (id, oset,))
+        if self.containermap:
+            print('...and %d in containermap' % (len(self.containermap)))
 
     @staticmethod
     def query_for_tuple(tup):
@@ -90,6 +122,21 @@ class PropCache:
             return {'iid':id1, 'uid':id2, 'key':key}
         raise Exception('Unknown collection: %s' % (db,))
 
+    @staticmethod
+    def tuple_for_document(db, doc):
+        """The inverse of query_for_tuple: takes a collection name and
+        a document from that collection, and returns the four-el tuple.
+        """
+        if db == 'worldprop':
+            return (db, doc['wid'], doc.get('locid', None), doc['key'])
+        if db == 'instanceprop':
+            return (db, doc['iid'], doc.get('locid', None), doc['key'])
+        if db == 'wplayerprop':
+            return (db, doc['wid'], doc.get('uid', None), doc['key'])
+        if db == 'iplayerprop':
+            return (db, doc['iid'], doc.get('uid', None), doc['key'])
+        raise Exception('Unknown collection: %s' % (db,))
+
     @tornado.gen.coroutine
     def get(self, tup, dependencies=None):
         """Fetch a value from the database, or the cache if it's cached.
@@ -111,6 +158,8 @@ class PropCache:
             
         ent = self.propmap.get(tup, None)
         if ent is not None:
+            if self.limit:
+                self.propmap.move_to_end(tup)
             if not ent.found:
                 # Cached "not found" value
                 return None
@@ -121,13 +170,138 @@ class PropCache:
         res = yield motor.Op(self.app.mongodb[dbname].find_one,
                              query,
                              {'val':1})
-        if not res:
-            ent = PropEntry(None, tup, query, found=False)
+        ent = self.propmap.get(tup, None)
+        if ent is None:
+            if not res:
+                ent = PropEntry(None, tup, query, found=False)
+            else:
+                val = res['val']
+                ent = PropEntry(val, tup, query, found=True)
+            self.add_entry(ent)
+        # Otherwise, a concurrent get() (or set()) filled this in while
+        # we waited. Keep that one, so that there's only one entry per
+        # tuple.
+
+        if not ent.found:
+            # Cached "not found" value
+            return None
+        return ent
+
+    @tornado.gen.coroutine
+    def prefetch(self, tups):
+        """Load a bunch of tuples into the cache at once, so that later
+        get() calls for them don't have to hit the database. (Tuples which
+        are already cached are skipped.) This does one query per
+        collection, rather than one per tuple. Missing properties are
+        cached as not-found, just as get() would.
+
+        This does not record dependencies; get() does that when the value
+        is actually used.
+        """
+        bydb = {}
+        for tup in tups:
+            if tup in self.propmap:
+                continue
+            ls = bydb.get(tup[0], None)
+            if ls is None:
+                bydb[tup[0]] = [tup]
+            else:
+                ls.append(tup)
+        if not bydb:
+            return
+        yield [ self.prefetch_collection(dbname, ls)
+                for (dbname, ls) in bydb.items() ]
+
+    @tornado.gen.coroutine
+    def prefetch_collection(self, dbname, tups):
+        """The guts of prefetch(), for a single collection.
+        """
+        # Group the keys by (id1, id2), so that the query is an $or
+        # over a few {id1, id2, key:{$in}} clauses.
+        groups = {}
+        for tup in tups:
+            ls = groups.get(tup[1:3], None)
+            if ls is None:
+                groups[tup[1:3]] = [tup[3]]
+            else:
+                ls.append(tup[3])
+        clauses = []
+        for ((id1, id2), keys) in groups.items():
+            query = PropCache.query_for_tuple( (dbname, id1, id2, None) )
+            query['key'] = {'$in':keys}
+            clauses.append(query)
+        if len(clauses) == 1:
+            query = clauses[0]
         else:
-            val = res['val']
-            ent = PropEntry(val, tup, query, found=True)
-            
-        self.propmap[tup] = ent
+            query = {'$or':clauses}
+        
+        fields = PropCache.query_for_tuple( (dbname, 1, 1, 1) )
+        fields['val'] = 1
+        found = {}
+        cursor = self.app.mongodb[dbname].find(query, fields)
+        while (yield cursor.fetch_next):
+            res = cursor.next_object()
+            tup = PropCache.tuple_for_document(dbname, res)
+            found[tup] = res['val']
+        # cursor autoclose
+
+        for tup in tups:
+            if tup in self.propmap:
+                # Someone got here first (maybe a set() while we waited).
+                continue
+            query = PropCache.query_for_tuple(tup)
+            if tup in found:
+                ent = PropEntry(found[tup], tup, query, found=True)
+            else:
+                ent = PropEntry(None, tup, query, found=False)
+            self.add_entry(ent)
+
+    @tornado.gen.coroutine
+    def load_location(self, wid, iid, locid, budget):
+        """Load all the properties of a location into the cache: instance
+        and world properties, both location-level and realm-level. (If
+        locid is None, just the realm-level ones.) This streams one cursor
+        per collection, rather than fetching keys one at a time as they
+        are used.
+
+        We stop loading when the (BSON-encoded) size of the loaded
+        documents exceeds budget bytes. Instance properties go first, since
+        find_symbol() checks them first. Tuples which are already cached
+        are left alone.
+
+        Returns the number of entries added.
+        """
+        if locid is None:
+            locquery = None
+        else:
+            locquery = {'$in':[None, locid]}
+        count = 0
+        for (dbname, query) in [
+            ('instanceprop', {'iid':iid, 'locid':locquery}),
+            ('worldprop', {'wid':wid, 'locid':locquery}) ]:
+            if dbname == 'instanceprop' and iid is None:
+                continue
+            cursor = self.app.mongodb[dbname].find(query)
+            while (yield cursor.fetch_next):
+                res = cursor.next_object()
+                budget -= len(bson.BSON.encode(res))
+                if budget < 0:
+                    break
+                tup = PropCache.tuple_for_document(dbname, res)
+                if tup in self.propmap:
+                    continue
+                entquery = PropCache.query_for_tuple(tup)
+                self.add_entry(PropEntry(res['val'], tup, entquery, found=True))
+                count += 1
+            yield motor.Op(cursor.close)
+            if budget < 0:
+                break
+        return count
+
+    def add_entry(self, ent):
+        """Add a freshly-loaded (clean) entry to the cache.
+        """
+        self.propmap[ent.tup] = ent
         if ent.mutable:
             assert ent.found
             oset = self.objmap.get(ent.id, None)
@@ -135,11 +309,7 @@ class PropCache:
                 self.objmap[ent.id] = set((ent,))
             else:
                 oset.add(ent)
-
-        if not ent.found:
-            # Cached "not found" value
-            return None
-        return ent
+            self.index_entry(ent)
 
     @tornado.gen.coroutine
     def set(self, tup, val):
@@ -155,13 +325,7 @@ class PropCache:
                 # It's already there (exactly the same object).
                 return
             # A property is cached. Drop this entry.
-            del self.propmap[tup]
-            if ent.mutable:
-                oset = self.objmap.get(ent.id, None)
-                if oset is not None:
-                    oset.discard(ent)
-                    if not oset:
-                        del self.objmap[ent.id]
+            self.remove_entry(ent)
             ent = None
 
         # Create new entry.
@@ -176,6 +340,7 @@ class PropCache:
                 self.objmap[ent.id] = set((ent,))
             else:
                 oset.add(ent)
+            self.index_entry(ent)
         
     @tornado.gen.coroutine
     def delete(self, tup):
@@ -188,13 +353,7 @@ class PropCache:
                 # It's already non-there.
                 return
             # A property is cached. Drop this entry.
-            del self.propmap[tup]
-            if ent.mutable:
-                oset = self.objmap.get(ent.id, None)
-                if oset is not None:
-                    oset.discard(ent)
-                    if not oset:
-                        del self.objmap[ent.id]
+            self.remove_entry(ent)
             ent = None
 
         # Create new (not-found) entry.
@@ -204,6 +363,137 @@ class PropCache:
         ent = PropEntry(None, tup, query, found=False, dirty=True)
         self.propmap[tup] = ent
         
+    def remove_entry(self, ent):
+        """Drop an entry from the cache (propmap, objmap, containermap).
+        This does not touch the database.
+        """
+        del self.propmap[ent.tup]
+        if ent.mutable:
+            oset = self.objmap.get(ent.id, None)
+            if oset is not None:
+                oset.discard(ent)
+                if not oset:
+                    del self.objmap[ent.id]
+            self.unindex_entry(ent)
+            self.changedset.discard(ent)
+
+    def index_entry(self, ent):
+        """Note every container in a mutable entry's value in the
+        containermap, so that note_mutation() can find the entry. Any
+        earlier record is dropped first, since the value may have
+        gained or lost containers since then.
+
+        This walks the value, but it doesn't copy it.
+        """
+        self.unindex_entry(ent)
+        ids = []
+        collect_container_ids(ent.val, ids)
+        ent.containerids = ids
+        for cid in ids:
+            eset = self.containermap.get(cid, None)
+            if eset is None:
+                self.containermap[cid] = set((ent,))
+            else:
+                eset.add(ent)
+
+    def unindex_entry(self, ent):
+        """Remove a mutable entry's containers from the containermap.
+        """
+        for cid in ent.containerids:
+            eset = self.containermap.get(cid, None)
+            if eset is not None:
+                eset.discard(ent)
+                if not eset:
+                    del self.containermap[cid]
+        ent.containerids = ()
+
+    def note_mutation(self, container):
+        """A list or dict has just been changed in place. If it's part
+        of any cached values, mark those entries as changed.
+
+        This is called for every subscript assignment and every call to a
+        mutating list or dict method, so it has to be cheap when the
+        container isn't ours.
+
+        A container which was added to a value after the value was cached
+        won't be found here. But adding it was itself a change, so the
+        entry is already marked. (It gets reindexed when it's written.)
+        """
+        eset = self.containermap.get(id(container), None)
+        if eset:
+            for ent in eset:
+                ent.changed = True
+                self.changedset.add(ent)
+
+    def invalidate(self, tup):
+        """Drop the entry for a given dependency key, if we have one. Call
+        this when the database has been changed behind the cache's back.
+
+        Dirty entries are left alone; they will be written back at the
+        end of the task, superseding whatever the database now contains.
+        """
+        ent = self.propmap.get(tup, None)
+        if ent is not None and not ent.dirty:
+            self.remove_entry(ent)
+
+    def invalidate_matching(self, func):
+        """Drop every (clean) entry whose dependency key satisfies func.
+        This is a linear scan, so it's only for rare bulk operations.
+        """
+        ls = [ ent for ent in self.propmap.values()
+               if (not ent.dirty) and func(ent.tup) ]
+        for ent in ls:
+            self.remove_entry(ent)
+
+    def invalidate_instance(self, iid):
+        """Drop all entries for an instance's properties (including its
+        iplayerprops).
+        """
+        self.invalidate_matching(lambda tup: (tup[0] in writable_collections and tup[1] == iid))
+        
+    def invalidate_player(self, uid):
+        """Drop all entries for a player's properties (iplayerprop and
+        wplayerprop).
+        """
+        self.invalidate_matching(lambda tup: (tup[0] in ('iplayerprop', 'wplayerprop') and tup[2] == uid))
+
+    def clear(self):
+        """Drop all clean entries.
+        """
+        self.invalidate_matching(lambda tup: True)
+
+    def finish_task(self):
+        """Clean up at the end of a task, for a cache which persists
+        across tasks. (A per-task cache should call final() instead.)
+
+        This does not write back dirty data. Be sure to call write_all_dirty()
+        before this. Any entries which are still dirty at this point (a
+        write failed, or the entry was in a read-only collection) no longer
+        match the database, so we drop them. Same goes for entries whose
+        values were mutated without being noted (the task wasn't writable).
+
+        We also break apart objmap sets larger than 1, by dropping them.
+        Every property gets its own value when it's next loaded.
+
+        Finally, trim the cache down to its limit, least-recently-used
+        first.
+        """
+        ls = [ ent for ent in self.propmap.values()
+               if ent.dirty or ent.haschanged() ]
+        if ls:
+            self.log.warning('propcache: dropping %d untrustworthy entries at end of task', len(ls))
+            for ent in ls:
+                self.remove_entry(ent)
+        
+        ls = [ oset for oset in self.objmap.values() if len(oset) > 1 ]
+        for oset in ls:
+            for ent in list(oset):
+                self.remove_entry(ent)
+
+        while len(self.propmap) > self.limit:
+            ent = next(iter(self.propmap.values()))
+            self.remove_entry(ent)
+
     def get_by_object(self, val):
         """Check whether a value is in the cache. This is keyed by the
         *identity* of the value! Only locates mutable entries.
@@ -221,27 +511,87 @@ class PropCache:
         return [ ent for ent in self.propmap.values() if ent.dirty ]
 
     def note_changed_entries(self):
-        """Check for (mutable) entries whose values have changed.
-        Mark them dirty. Then return the list of dep keys.
+        """Take the (mutable) entries whose values have changed since the
+        last call (see note_mutation). Mark them dirty. Then return the
+        list of dep keys.
         (We ignore entries that are already marked dirty, because nothing
         needs to be done there.)
         """
-        ls = [ ent for ent in self.propmap.values() if (not ent.dirty) and ent.haschanged() ]
-        if ls:
-            # Yes, this is awkward. Saves us a list-allocate, though.
-            for (ix, ent) in enumerate(ls):
-                ent.dirty = True
-                ls[ix] = ent.tup
+        ls = [ ent.tup for ent in self.changedset if not ent.dirty ]
+        for ent in self.changedset:
+            ent.dirty = True
+        self.changedset.clear()
         return ls
 
     @tornado.gen.coroutine
     def write_all_dirty(self):
         """Write back all dirty entries. Be sure to call note_changed_entries()
         first.
+
+        The entries are grouped by collection, and all the writes go out
+        at once rather than waiting on each other in turn. A write which
+        fails is logged, and its entry stays dirty; the rest go through
+        regardless.
         """
         ls = self.dirty_entries()
+        if not ls:
+            return
+        starttime = twcommon.misc.now()
+        bycollection = {}
         for ent in ls:
+            ents = bycollection.get(ent.dbname, None)
+            if ents is None:
+                bycollection[ent.dbname] = [ ent ]
+            else:
+                ents.append(ent)
+        yield [ self.write_collection(dbname, ents)
+                for (dbname, ents) in bycollection.items() ]
+        failures = len([ ent for ent in ls if ent.dirty ])
+        elapsed = twcommon.misc.now() - starttime
+        write_stats.note(len(ls), failures, elapsed)
+        self.log.debug('propcache: wrote back %d entries (%d collections, %d failed) in %.3f ms', len(ls), len(bycollection), failures, elapsed.total_seconds() * 1000)
+
+    @tornado.gen.coroutine
+    def write_collection(self, dbname, ents):
+        """Write back the dirty entries for one collection. All the deletes
+        go out as a single remove. The updates are sent concurrently.
+        """
+        if dbname not in writable_collections:
+            # Let resolve_dirty complain about these.
+            for ent in ents:
+                yield self.resolve_dirty(ent)
+            return
+        deletes = [ ent for ent in ents if not ent.found ]
+        ops = [ self.resolve_dirty_logged(ent) for ent in ents if ent.found ]
+        if len(deletes) == 1:
+            ops.append(self.resolve_dirty_logged(deletes[0]))
+        elif deletes:
+            ops.append(self.resolve_deletes(dbname, deletes))
+        yield ops
+
+    @tornado.gen.coroutine
+    def resolve_dirty_logged(self, ent):
+        """Call resolve_dirty, logging (rather than raising) any error.
+        """
+        try:
             yield self.resolve_dirty(ent)
+        except Exception as ex:
+            self.log.error('Unable to write back %s: %s', ent.tup, ex)
+
+    @tornado.gen.coroutine
+    def resolve_deletes(self, dbname, ents):
+        """Delete several (not-found) entries from a collection with a
+        single remove. Then mark them clean. If the remove fails, we
+        don't know which deletes happened, so they all stay dirty.
+        """
+        query = { '$or': [ ent.query for ent in ents ] }
+        try:
+            yield motor.Op(self.app.mongodb[dbname].remove, query)
+        except Exception as ex:
+            self.log.error('Unable to delete %d %s entries: %s', len(ents), dbname, ex)
+            return
+        for ent in ents:
+            ent.dirty = False
 
     @tornado.gen.coroutine
     def resolve_dirty(self, ent):
@@ -252,8 +602,7 @@ class PropCache:
             # Maybe we should update the equivalent writable entry here,
             # but we'll just skip it.
             self.log.warning('Unable to update %s entry: %s', dbname, ent.key)
-            if ent.mutable:
-                ent.origval = deepcopy(ent.val)
+            ent.changed = False
             return
 
         if ent.found:
@@ -269,14 +618,42 @@ class PropCache:
             yield motor.Op(self.app.mongodb[dbname].update,
                            ent.query, newval,
                            upsert=True)
+            ent.changed = False
             if ent.mutable:
-                ent.origval = deepcopy(ent.val)
+                self.index_entry(ent)
         else:
             # Resolve delete.
             yield motor.Op(self.app.mongodb[dbname].remove,
                            ent.query)
         ent.dirty = False
 
+class WriteStats:
+    """Running totals for write_all_dirty(), for the logcachestats command.
+    """
+    def __init__(self):
+        self.flushes = 0
+        self.entries = 0
+        self.failures = 0
+        self.maxentries = 0
+        self.totaltime = datetime.timedelta()
+        self.maxtime = datetime.timedelta()
+
+    def __repr__(self):
+        if not self.flushes:
+            return '<WriteStats: no flushes>'
+        return '<WriteStats: %d flushes, %d entries (%.1f avg, %d max), %d failed; %.3f ms avg, %.3f ms max>' % (self.flushes, self.entries, self.entries / self.flushes, self.maxentries, self.failures, self.totaltime.total_seconds() * 1000 / self.flushes, self.maxtime.total_seconds() * 1000)
+
+    def note(self, count, failures, elapsed):
+        self.flushes += 1
+        self.entries += count
+        self.failures += failures
+        self.maxentries = max(self.maxentries, count)
+        self.totaltime += elapsed
+        self.maxtime = max(self.maxtime, elapsed)
+
+# Global write-back statistics, over all PropCaches.
+write_stats = WriteStats()
+
 class PropEntry:
     """Represents a database entry, or perhaps the lack of a database entry.
     """
@@ -289,16 +666,15 @@ class PropEntry:
         self.query = query  # Query in the collection
         self.found = found  # Was a database entry found at all?
         self.dirty = dirty  # Needs to be written back?
+        self.changed = False  # Modified in place? (See note_mutation)
 
-        # Mutable entries will be added to objmap.
+        # Mutable entries will be added to objmap and containermap.
+        self.containerids = ()
         if not found:
             self.mutable = False
         else:
             self.id = id(val)
             self.mutable = isinstance(val, (list, dict))
-            if self.mutable:
-                # Keep a copy, to check for possible changes
-                self.origval = deepcopy(val)
 
     def __repr__(self):
         if not self.found:
@@ -316,16 +692,34 @@ class PropEntry:
         return '<PropEntry %s%s: %s>' % (isdirty, self.tup, val)
 
     def haschanged(self):
-        """Has this value changed since we cached it?
+        """Has this value changed since we cached it (or last wrote it)?
         (This catches changes in mutable entries, not entries that
         are brand-new.)
-        
-        ### This will fail to detect changes that compare equal. That is,
-        ### if an array [1] changes to [1.0], this will not notice the
-        ### difference.
         """
-        if self.mutable and (self.val != self.origval):
-            return True
+        return self.changed
+
+def collect_container_ids(val, ids, depth=0):
+    """Append the id() of every list and dict in a value (including the
+    value itself) to ids.
+
+    Like deepcopy(), this guards against loopy data structures.
+    """
+    if isinstance(val, list):
+        if depth >= 8:
+            raise TypeError('Database object cannot be recursive')
+        ids.append(id(val))
+        newdepth = depth+1
+        for subval in val:
+            if isinstance(subval, (list, dict)):
+                collect_container_ids(subval, ids, depth=newdepth)
+    elif isinstance(val, dict):
+        if depth >= 8:
+            raise TypeError('Database object cannot be recursive')
+        ids.append(id(val))
+        newdepth = depth+1
+        for subval in val.values():
+            if isinstance(subval, (list, dict)):
+                collect_container_ids(subval, ids, depth=newdepth)
 
 def deepcopy(val, depth=0):
     """Return a copy of a value. For immutable values, this returns the
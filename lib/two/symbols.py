@@ -678,7 +678,7 @@ def define_globals():
             raise KeyError('No such location: %s' % (obj,))
         return two.execute.LocationProxy(res['_id'])
 
-    @scriptfunc('sched', group='_')
+    @scriptfunc('sched', group='_', yieldy=True)
     def global_sched(delta, func, repeat=False, cancel=None):
         """Schedule an event to occur in the future. The delta argument
         must be a timedelta or a number of seconds. The func should be
@@ -699,9 +699,10 @@ def define_globals():
             raise Exception('Current instance is not awake')
         if not isinstance(delta, datetime.timedelta):
             delta = datetime.timedelta(seconds=delta)
-        instance.add_timer_event(delta, func, repeat=repeat, cancel=cancel)
+        timer = instance.add_timer_event(delta, func, repeat=repeat, cancel=cancel)
+        yield app.ipool.store_timer_event(timer)
 
-    @scriptfunc('unsched', group='_')
+    @scriptfunc('unsched', group='_', yieldy=True)
     def global_unsched(cancel=None):
         """Cancel all upcoming scheduled events for this instance.
         If the cancel argument is given, this only cancels events that
@@ -716,7 +717,8 @@ def define_globals():
         instance = app.ipool.get(ctx.loctx.iid)
         if not instance:
             raise Exception('Current instance is not awake')
-        instance.remove_timer_events(cancel=cancel)
+        timers = instance.remove_timer_events(cancel=cancel)
+        yield app.ipool.unstore_timer_events(timers)
 
     @scriptfunc('player', group='_propmap')
     def global_player():
@@ -1195,10 +1197,17 @@ def define_globals():
 
         return two.execute.RemoteRealmProxy(newwid, newscid, newiid, perms=perms, worldname=world.get('name', '???'))
         
+    def random_unshareable():
+        # A random result differs from player to player, so whatever
+        # we're rendering can't be shared. (See generate_update.)
+        ctx = EvalPropContext.get_current_context()
+        ctx.task.playerdependent = True
+
     @scriptfunc('choice', group='random')
     def random_choice(seq):
         """Choose a random member of a list.
         """
+        random_unshareable()
         return random.choice(seq)
 
     @scriptfunc('randint', group='random')
@@ -1206,12 +1215,14 @@ def define_globals():
         """Return a random integer in range [a, b], including both end
         points.
         """
+        random_unshareable()
         return random.randint(a, b)
 
     @scriptfunc('randrange', group='random')
     def random_randrange(start, stop=None, step=1):
         """Return a random integer from range(start, stop[, step]).
         """
+        random_unshareable()
         return random.randrange(start, stop=stop, step=1)
     
     @scriptfunc('partial', group='functools')
@@ -1249,12 +1260,13 @@ def define_globals():
         If key is {code} or a callable, it is applied to each list element
         to produce a sorting key. If reverse is True, the order is reversed.
         """
+        ctx = EvalPropContext.get_current_context()
         if key is None:
             # The simple case (no code called, non-yieldy)
             list.sort(ls, reverse=reverse)
+            ctx.app.propcache.note_mutation(ls)
             return
         # The code-calling case is ugly and not very efficient. Too bad.
-        ctx = EvalPropContext.get_current_context()
         tmpls = []
         nokwargs = {}
         for val in ls:
@@ -1262,6 +1274,7 @@ def define_globals():
             tmpls.append( (kval, val) )
         list.sort(tmpls, key=lambda tup:tup[0], reverse=reverse)
         ls[:] = [ tup[1] for tup in tmpls ]
+        ctx.app.propcache.note_mutation(ls)
         return
     
     # Copy the collection of top-level functions.
@@ -1378,6 +1391,24 @@ type_getattr_table = {
 # Condensing the above for fast access: the set of id()s of valid types.
 type_getattr_idset = frozenset({ id(key) for key in type_getattr_table.keys() })
 
+# The list and dict methods in the above table which change the object in
+# place. The propcache has to hear about these; see note_method_call().
+type_mutating_methods = frozenset(
+    ['append', 'clear', 'extend', 'insert', 'pop', 'popitem', 'remove', 'reverse', 'setdefault', 'update'])
+
+def note_method_call(app, funcval, args):
+    """Script code has just called a native callable (which passed the
+    type_callable test). If it was a method which changes its list or
+    dict, let the propcache know.
+    """
+    typ = type(funcval)
+    if typ is types.BuiltinMethodType:
+        if funcval.__name__ in type_mutating_methods:
+            app.propcache.note_mutation(funcval.__self__)
+    elif typ is MethodDescriptorType:
+        if args and funcval.__name__ in type_mutating_methods:
+            app.propcache.note_mutation(args[0])
+
 def type_callable(val):
     """Given an object, is it legitimate to call it? We don't want to
     rely on Python's callable() here; we want to exclude file() and other
@@ -1515,6 +1546,49 @@ def find_symbol(app, loctx, key, locals=None, dependencies=None):
 
     raise SymbolError('Name "%s" is not found' % (key,))
 
+@tornado.gen.coroutine
+def prefetch_symbols(app, loctx, keys, dependencies=None):
+    """Load into the property cache every property that find_symbol()
+    might check for the given keys, in one batch (one query per
+    collection). This is just an optimization; find_symbol() works the
+    same either way.
+
+    The dependencies argument is a set of dependency keys left over
+    from a previous evaluation (e.g., conn.localedependencies). These
+    are a good guess at what the next evaluation will need -- including
+    player properties and properties of nested symbols, which we
+    couldn't predict from the keys alone. Only property keys belonging to
+    loctx's world and instance are loaded.
+    """
+    wid = loctx.wid
+    iid = loctx.iid
+    locid = loctx.locid
+    
+    tups = set()
+    for key in keys:
+        if key.startswith('_') or key in immutable_symbol_table:
+            continue
+        if (locid is not None) and (iid is not None):
+            tups.add( ('instanceprop', iid, locid, key) )
+        if locid is not None:
+            tups.add( ('worldprop', wid, locid, key) )
+        if iid is not None:
+            tups.add( ('instanceprop', iid, None, key) )
+        tups.add( ('worldprop', wid, None, key) )
+        
+    if dependencies:
+        for tup in dependencies:
+            db = tup[0]
+            if db == 'worldprop' or db == 'wplayerprop':
+                if tup[1] == wid:
+                    tups.add(tup)
+            elif db == 'instanceprop' or db == 'iplayerprop':
+                if iid is not None and tup[1] == iid:
+                    tups.add(tup)
+
+    if tups:
+        yield app.propcache.prefetch(tups)
+
 
 # Late imports, to avoid circularity
 from twcommon.misc import is_typed_dict
@@ -1,12 +1,14 @@
 import datetime
+import collections
+import functools
 
 import tornado.gen
+import tornado.stack_context
 from bson.objectid import ObjectId
 import motor
 
-import two.execute
-from two.playconn import PlayerConnection
 import twcommon.misc
+from twcommon import wcproto
 from twcommon.excepts import MessageException, ErrorMessageException
 from twcommon.excepts import SymbolError, ExecRunawayException
 
@@ -78,6 +80,10 @@ class Task(object):
         self.queuetime = queuetime
         # When we started working on the command:
         self.starttime = twcommon.misc.now()
+        # The set of lanes this task holds, if it's running alongside
+        # other tasks; None if it has the server to itself. (See
+        # Tworld.task_lanes.)
+        self.lanes = None
 
         # Hard limit on how much script code we'll execute for this task.
         self.cputicks = 0
@@ -95,6 +101,18 @@ class Task(object):
         # Values in this map should always be nonzero; if a connection
         # is non-dirty, it should not be in the map.
         self.updateconns = None
+        # Whether the data changes should be passed along to the other
+        # tworld shards, if there are any. (Not if they came from there,
+        # or from a tweb which told every shard already.)
+        self.relaychanges = True
+
+        # Set whenever script evaluation looks at the identity of the
+        # player it's running for (see EvalPropContext.uid), or makes a
+        # random choice.
+        self.playerdependent = False
+        # While resolving, this maps keys to Futures for renders which
+        # can be shared between connections. (See generate_update.)
+        self.sharedrenders = None
 
     def close(self):
         """Clean up any large member variables. This probably reduces
@@ -106,6 +124,22 @@ class Task(object):
         #self.loctxmap = None
         self.updateconns = None
         self.changeset = None
+        self.sharedrenders = None
+
+    def claim_lane(self, lane):
+        """Make sure this task holds the given lane, for the rest of its
+        run. (Used when script code writes into an instance outside the
+        task's own lanes.) If the lane is free, we take it; if another
+        task holds it, we raise an exception rather than clobber that
+        task's changes. A task with the server to itself needs nothing.
+        """
+        if self.lanes is None or lane in self.lanes:
+            return
+        if lane in self.app.busylanes:
+            raise Exception('Cannot change an instance which is busy with another command: %s' % (lane[1],))
+        # Modify the set in place, since subtasks share it.
+        self.app.busylanes.add(lane)
+        self.lanes.add(lane)
 
     def tick(self, val=1):
         self.cputicks = self.cputicks + 1
@@ -174,6 +208,11 @@ class Task(object):
                 if subls:
                     for conn in subls:
                         conn.write({'cmd':'event', 'text':text})
+                elif self.app.shardcount > 1:
+                    # The player may be connected through another shard.
+                    # The twebs know where.
+                    for stream in self.app.webconns.all():
+                        stream.write(wcproto.message(0, {'cmd':'playerevent', 'uid':obj, 'text':text}, version=stream.twversion))
             else:
                 self.log.warning('write_event: unrecognized %s', obj)
 
@@ -325,6 +364,11 @@ class Task(object):
             return 
 
         conn = self.app.playconns.get(connid)
+        if conn and twwcid and conn.twwcid != twwcid:
+            # Connids are partitioned among the twebs, so one tweb should
+            # never send a message for another tweb's connection.
+            self.log.error('Message for connid %d arrived from the wrong tweb stream (%d, not %d)', connid, twwcid, conn.twwcid)
+            return
 
         # Command from a player (via conn). A MessageException here passes
         # an error back to the player.
@@ -455,28 +499,32 @@ class Task(object):
         if not (changeset or updateconns):
             return
 
-        connections = self.app.playconns.all()
-
         # Go through the data changes, setting dirty bits as needed.
-        # (But we try to do as little work as possible.)
+        # The connection table keeps an index from change keys to the
+        # connections that depend on them, so we only look at the
+        # connections which are actually affected.
         if changeset:
             #self.log.debug('Task changeset: %s', changeset)
-            for conn in connections:
-                dirty = updateconns.get(conn.connid, 0)
-                if not (dirty & DIRTY_LOCALE):
-                    if not conn.localedependencies.isdisjoint(changeset):
-                        dirty |= DIRTY_LOCALE
-                if not (dirty & DIRTY_POPULACE):
-                    if not conn.populacedependencies.isdisjoint(changeset):
-                        dirty |= DIRTY_POPULACE
-                if not (dirty & DIRTY_FOCUS):
-                    if not conn.focusdependencies.isdisjoint(changeset):
-                        dirty |= DIRTY_FOCUS
-                if not (dirty & DIRTY_TOOL):
-                    if not conn.tooldependencies.isdisjoint(changeset):
-                        dirty |= DIRTY_TOOL
-                if dirty:
-                    updateconns[conn.connid] = dirty
+            changedconns = self.app.playconns.dirty_for_changes(changeset)
+            for (connid, dirty) in changedconns.items():
+                updateconns[connid] = updateconns.get(connid, 0) | dirty
+
+        # If other tasks are running alongside us, we can only update
+        # connections in our own instances (or, for a player in the
+        # void, our own player). The rest are passed along as connupdate
+        # commands, which will run in the right lanes.
+        if self.lanes is not None:
+            for (connid, dirty) in list(updateconns.items()):
+                conn = self.app.playconns.get(connid)
+                if not conn:
+                    continue
+                if conn.iid:
+                    lane = ('iid', conn.iid)
+                else:
+                    lane = ('uid', conn.uid)
+                if lane not in self.lanes:
+                    del updateconns[connid]
+                    self.app.queue_command({'cmd':'connupdate', 'connid':connid, 'dirty':dirty})
 
         # Again, we might be done.
         if not updateconns:
@@ -487,11 +535,60 @@ class Task(object):
         # If two connections are on the same player, this won't be
         # as efficient as it might be -- we'll generate text twice.
         # But that's a rare case.
-        for (connid, dirty) in updateconns.items():
+
+        # We generate several updates at a time, since each one spends
+        # most of its time waiting on the database. Each worker pulls
+        # connections off the (sorted, so deterministic) pending queue.
+        # Each connection still sends exactly one update message.
+        pending = collections.deque(sorted(updateconns.items()))
+        concurrency = max(1, min(self.app.opts.update_concurrency, len(pending)))
+        # Renders which turn out to be the same for every player in a
+        # location are done once and shared.
+        self.sharedrenders = {}
+        workers = []
+        for ix in range(concurrency):
+            # Interleaved workers must not share EvalPropContext's
+            # context stack. The StackContext swaps in a private stack
+            # whenever this worker is running.
+            stack = []
+            with tornado.stack_context.StackContext(functools.partial(EvalPropContext.swapped_context_stack, stack)):
+                workers.append(self.update_worker(pending))
+        yield workers
+        self.sharedrenders = None
+
+    @tornado.gen.coroutine
+    def update_worker(self, pending):
+        """Generate updates for connections in the pending queue until
+        it's empty. Each update runs in a subtask, so that it gets its own
+        tick count (as if it had run alone). The subtask's ticks are
+        added into our totals afterwards.
+        """
+        while pending:
+            (connid, dirty) = pending.popleft()
+            subtask = self.subtask()
             try:
-                self.resetticks()
                 conn = self.app.playconns.get(connid)
-                yield two.execute.generate_update(self, conn, dirty)
+                yield two.execute.generate_update(subtask, conn, dirty)
             except Exception as ex:
                 self.log.error('Error updating while resolving task: %s', self.cmdobj, exc_info=True)
-        
+            subtask.resetticks()
+            self.totalcputicks = self.totalcputicks + subtask.totalcputicks
+            self.maxcputicks = max(self.maxcputicks, subtask.maxcputicks)
+            subtask.close()
+
+    def subtask(self):
+        """Create a Task for the same command, with its own tick count.
+        It is not writable, but shares our sharedrenders. (Used by
+        resolve().)
+        """
+        task = Task(self.app, self.cmdobj, self.connid, self.twwcid, self.queuetime)
+        task.starttime = self.starttime
+        task.sharedrenders = self.sharedrenders
+        task.lanes = self.lanes
+        return task
+
+
+# Late imports, to avoid circularity
+import two.execute
+from two.playconn import PlayerConnection
+from two.evalctx import EvalPropContext
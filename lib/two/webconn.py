@@ -1,9 +1,18 @@
 """
 Keep track of the tweb servers that are connected.
 
-(The way tworld is currently built, there will be no more than one tweb
-connected at a time. But we have some of the infrastructure necessary
-for several.)
+Several twebs may be connected at once. Each tells us its node number
+when it connects, and the player connection IDs it uses are partitioned
+by node number (see twcommon.wcproto.make_connid), so they never collide.
+
+If tworld is sharded, each shard listens on its own port (tworld_port
+plus the shard number), and every tweb connects to all of them.
+
+Outgoing messages are coalesced. While a command is running, everything
+written to a tweb stream is held in a buffer, and the whole buffer goes
+out as a single write when the command's updates have been resolved (or
+when the buffer passes write_coalesce_limit bytes). A command that
+broadcasts to a crowded room thus costs one socket write, not hundreds.
 """
 
 import types
@@ -28,7 +37,7 @@ class WebConnectionTable(object):
 
         self.ioloop = None
         self.listensock = None
-        self.map = {}  # maps twwcids to IOStreams (normally just one)
+        self.map = {}  # maps twwcids to IOStreams (one per tweb)
 
     def close(self):
         """Close every socket, including the listener, in preparation
@@ -38,6 +47,7 @@ class WebConnectionTable(object):
             self.listensock.close()
             self.listensock = None
         for conn in self.all():
+            conn.twflush()
             conn.close()
 
     def get(self, twwcid):
@@ -45,11 +55,27 @@ class WebConnectionTable(object):
         """
         return self.map.get(twwcid, None)
 
+    def get_for_node(self, node):
+        """Look up the WebConnIOStream which has registered the given
+        node number. Returns None if not found.
+        """
+        for conn in self.map.values():
+            if conn.twnode == node:
+                return conn
+        return None
+
     def all(self):
         """A (non-dynamic) list of all tweb connections.
         """
         return list(self.map.values())
 
+    def flush_all(self):
+        """Send out all the coalesced messages on every tweb connection.
+        The app calls this at the end of each task.
+        """
+        for conn in self.map.values():
+            conn.twflush()
+
     def listen(self):
         """Begin listening for incoming tweb connections. This is called
         when the ioloop begins.
@@ -62,7 +88,9 @@ class WebConnectionTable(object):
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,
             (sock.getsockopt (socket.SOL_SOCKET, socket.SO_REUSEADDR) | 1))
         sock.setblocking(0)
-        sock.bind( ('localhost', self.app.opts.tworld_port) )
+        # Each shard has its own port.
+        port = self.app.opts.tworld_port + self.app.shard
+        sock.bind( (self.app.opts.tworld_host, port) )
         sock.listen(32)
         
         self.ioloop.add_handler(
@@ -70,7 +98,7 @@ class WebConnectionTable(object):
             self.listen_ready,
             tornado.ioloop.IOLoop.READ)
         
-        self.log.info('Listening on port %d', self.app.opts.tworld_port)
+        self.log.info('Listening on port %d (shard %d of %d)', port, self.app.shard, self.app.shardcount)
 
     def listen_ready(self, fd, events):
         """Callback: invoked when somebody connects to the listening socket.
@@ -109,24 +137,32 @@ class WebConnIOStream(tornado.iostream.IOStream):
         tornado.iostream.IOStream.__init__(self, socket)
         self.twhost = host
         self.twtable = table
-        self.twbuffer = bytearray()
+        # The protocol version stays at 1 until tweb's connect message
+        # negotiates something better.
+        self.twversion = wcproto.PROTOCOL_JSON
+        self.twreader = wcproto.MessageReader(version=self.twversion, namespace=True)
+        # The tweb's node number, once its connect message arrives.
+        self.twnode = None
+        # Outgoing data waiting for twflush().
+        self.twoutbuf = []
+        self.twoutlen = 0
         self.twwcid = WebConnIOStream.counter
         WebConnIOStream.counter += 1
 
     def __repr__(self):
-        return '<WebConnIOStream %d (%s)>' % (self.twwcid, self.twhost,)
+        return '<WebConnIOStream %d (%s, node %s)>' % (self.twwcid, self.twhost, self.twnode,)
         
     def twread(self, dat):
         """Callback: invoked when the stream receives new data.
         """
         if not self.twtable:
             return  # must have already closed
-        self.twbuffer.extend(dat)
+        self.twreader.feed(dat)
         while True:
-            # This slices a chunk off the buffer and returns it, if a
+            # This pulls a chunk out of the buffer and returns it, if a
             # complete chunk is available.
             try:
-                tup = wcproto.check_buffer(self.twbuffer, namespace=True)
+                tup = self.twreader.check()
                 if not tup:
                     return
                 (connid, raw, obj) = tup
@@ -134,6 +170,48 @@ class WebConnIOStream(tornado.iostream.IOStream):
             except Exception as ex:
                 self.twtable.log.info('Malformed message: %s', ex)
 
+    def write(self, data, callback=None):
+        """Send data to tweb. (This overrides IOStream.write.)
+
+        If a command is running, the data is held until the app calls
+        twflush() at the end of the task, or until too much piles up.
+        Outside of commands (or if there's a callback), the data goes
+        out immediately, after anything already held.
+        """
+        if self.twtable:
+            app = self.twtable.app
+            limit = app.opts.write_coalesce_limit
+            if limit and app.runningtasks and callback is None:
+                self.twoutbuf.append(data)
+                self.twoutlen += len(data)
+                if self.twoutlen >= limit:
+                    self.twflush()
+                return
+        self.twflush()
+        tornado.iostream.IOStream.write(self, data, callback)
+
+    def twflush(self):
+        """Send out all the held data as a single write.
+        """
+        if not self.twoutbuf:
+            return
+        data = b''.join(self.twoutbuf)
+        self.twoutbuf = []
+        self.twoutlen = 0
+        try:
+            tornado.iostream.IOStream.write(self, data)
+        except Exception as ex:
+            if self.twtable:
+                self.twtable.log.error('Unable to write to %s: %s', self, ex)
+
+    def twsetversion(self, version):
+        """Switch to a new protocol version, for messages in both
+        directions. (Called by the connect command, after it replies.)
+        """
+        self.twversion = version
+        if self.twreader is not None:
+            self.twreader.version = version
+
     def twclose(self, dat):
         """Callback: invoked when the stream closes.
         """
@@ -149,7 +227,9 @@ class WebConnIOStream(tornado.iostream.IOStream):
         self.twtable.log.warning('Closed: %s', self)
         # Clean up dangling references.
         self.twhost = None
-        self.twbuffer = None
+        self.twreader = None
+        self.twoutbuf = []
+        self.twoutlen = 0
         self.twtable = None
         self.twwcid = None
         
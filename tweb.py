@@ -99,10 +99,25 @@ tornado.options.define(
 tornado.options.define(
     'tworld_port', type=int, default=4001,
     help='port number for communication between tweb and tworld')
+tornado.options.define(
+    'tworld_host', type=str, default='localhost',
+    help='host name or address of the tworld server')
+tornado.options.define(
+    'tworld_shards', type=int, default=1,
+    help='number of tworld processes sharing the instances (tweb connects to tworld_port and the ports after it)')
+tornado.options.define(
+    'tweb_node', type=int, default=0,
+    help='node number of this tweb, if several share one tworld (0 to 255; each must be different)')
+tornado.options.define(
+    'tworld_protocol', type=int, default=2,
+    help='highest protocol version to offer tworld (1 for JSON only)')
 
 tornado.options.define(
     'mongo_database', type=str, default='tworld',
     help='name of mongodb database')
+tornado.options.define(
+    'session_cache_ttl', type=int, default=60,
+    help='seconds to keep looked-up sessions in memory (0 to always read the database)')
 tornado.options.define(
     'cookie_secret', type=str,
     help='cookie secret key (see Tornado docs)')
@@ -182,6 +197,7 @@ handlers = [
     (r'/build/trash/([0-9a-f]+)', tweblib.bhandlers.BuildTrashWorldHandler),
     (r'/build/loc/([0-9a-f]+)', tweblib.bhandlers.BuildLocHandler),
     (r'/build/export/([0-9a-f]+)', tweblib.bhandlers.BuildExportWorldHandler),
+    (r'/build/import/([0-9a-f]+)', tweblib.bhandlers.BuildImportWorldHandler),
     (r'/build/addworld', tweblib.bhandlers.BuildAddWorldHandler),
     (r'/build/addloc', tweblib.bhandlers.BuildAddLocHandler),
     (r'/build/delloc', tweblib.bhandlers.BuildDelLocHandler),
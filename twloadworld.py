@@ -11,6 +11,12 @@ modify or overwrite any world.
 I built this as a temporary measure, awaiting a full-fledged world-creation
 interface. However, I suspect it will remain useful for various cases
 (wiping and rebuilding a Tworld database, etc).
+
+With --incremental, a hash of each section of the file is kept in a
+sidecar file (worldfile.twhash). The next --incremental load only parses,
+checks, and loads the locations whose text has changed since then. (If
+the world has been edited some other way, such as on the build pages,
+do a plain load to bring everything back in line.)
 """
 
 import sys
@@ -18,6 +24,9 @@ import os
 import datetime
 import ast
 import keyword
+import json
+import hashlib
+import collections
 
 import bson
 from bson.objectid import ObjectId
@@ -58,6 +67,14 @@ tornado.options.define(
     'check', type=bool,
     help='only check consistency of the file')
 
+tornado.options.define(
+    'prune', type=bool,
+    help='remove properties which are not in the file (when loading the whole world)')
+
+tornado.options.define(
+    'incremental', type=bool,
+    help='only parse and load the locations which changed since the last load')
+
 # Parse 'em up.
 args = tornado.options.parse_command_line()
 opts = tornado.options.options
@@ -73,6 +90,12 @@ if '--display' in args:
 if '--remove' in args:
     args.remove('--remove')
     opts.remove = True
+if '--prune' in args:
+    args.remove('--prune')
+    opts.prune = True
+if '--incremental' in args:
+    args.remove('--incremental')
+    opts.incremental = True
 if '--removeworld' in args:
     args.remove('--removeworld')
     opts.removeworld = True
@@ -82,10 +105,11 @@ if opts.python_path:
 
 import twcommon.access
 import twcommon.interp
+import twcommon.worldimport
 from twcommon.misc import sluggify
 
 if not args:
-    print('usage: twloadworld.py worldfile [ room ... or room.prop ... ]')
+    print('usage: twloadworld.py [ --prune ] [ --incremental ] worldfile [ room ... or room.prop ... ]')
     sys.exit(-1)
 
 class World(object):
@@ -173,10 +197,77 @@ class Location(object):
     def __repr__(self):
         return '<Location %s: "%s">' % (self.key, self.name)
 
-def parse_world(filename):
+def location_line(ln):
+    """Parse a location line (with the leading "*"): either "*key: name"
+    or just "*name". Returns (lockey, locname).
+    """
+    lockey, dummy, locname = ln[1:].partition(':')
+    lockey = lockey.strip()
+    locname = locname.strip()
+    if not locname:
+        locname = lockey
+        lockey = sluggify(locname)
+    return (lockey, locname)
+
+def hash_sections(filename):
+    """Read through the world file and compute a hash of each section:
+    the realm section at the top (key '.'), and then each location (by
+    location key). Returns an OrderedDict of hex digests. This is much
+    cheaper than parse_world(), so it's how the --incremental option
+    finds out which locations need parsing.
+    """
+    res = collections.OrderedDict()
+    curkey = '.'
+    hasher = hashlib.md5()
+    fl = open(filename)
+    for ln in fl:
+        val = ln.strip()
+        if val.startswith('***'):
+            break
+        if val.startswith('*'):
+            res[curkey] = hasher.hexdigest()
+            curkey, dummy = location_line(val)
+            hasher = hashlib.md5()
+        hasher.update(ln.encode())
+    fl.close()
+    res[curkey] = hasher.hexdigest()
+    return res
+
+def read_hash_index(path):
+    """Read the hash index left by the last whole-world load, if there is
+    one. It's only good for the database named in the options. Returns
+    None if it's missing or unusable.
+    """
+    try:
+        fl = open(path)
+        index = json.load(fl)
+        fl.close()
+    except Exception as ex:
+        if os.path.exists(path):
+            print('Unable to read hash index %s: %s' % (path, ex,))
+        return None
+    if type(index) is not dict or type(index.get('sections', None)) is not dict:
+        return None
+    if index.get('database', None) != opts.mongo_database:
+        return None
+    return index
+
+def write_hash_index(path, wid, hashes):
+    index = { 'database':opts.mongo_database, 'wid':str(wid),
+              'sections':hashes }
+    fl = open(path, 'w')
+    json.dump(index, fl, indent=True)
+    fl.close()
+
+def parse_world(filename, skip=frozenset()):
+    """Parse the world file. The locations whose keys are in skip are
+    created, but their contents are not parsed (or checked); this is
+    for --incremental loads.
+    """
     world = World()
     curloc = None
     curprop = None
+    skipping = False
     
     fl = open(filename)
     while True:
@@ -198,18 +289,18 @@ def parse_world(filename):
         if ln.startswith('*'):
             # New location.
             curprop = None
-            lockey, dummy, locname = ln[1:].partition(':')
-            lockey = lockey.strip()
-            locname = locname.strip()
-            if not locname:
-                locname = lockey
-                lockey = sluggify(locname)
+            lockey, locname = location_line(ln)
             if lockey in world.locations:
                 error('Location defined twice: %s' % (lockey,))
             curloc = Location(locname, lockey)
             world.locations[lockey] = curloc
             world.locationlist.append(lockey)
             curprop = 'desc'
+            skipping = (lockey in skip)
+            continue
+
+        if skipping:
+            # Unchanged since the last load.
             continue
 
         if isindent and curprop is not None:
@@ -491,7 +582,27 @@ def error(msg):
 
 filename = args.pop(0)
 
-world = parse_world(filename)
+# The hash index lives next to the world file. It records the hash of
+# each section of the file as of the last whole-world load, so that an
+# --incremental load can skip the locations that haven't changed.
+hashindexpath = filename + '.twhash'
+hashindex = None
+sectionhashes = None
+skipkeys = set()
+
+if opts.incremental:
+    if args or opts.display or opts.remove:
+        print('--incremental only applies to loading (or checking) the whole world.')
+        sys.exit(-1)
+    sectionhashes = hash_sections(filename)
+    hashindex = read_hash_index(hashindexpath)
+    if hashindex is not None:
+        oldhashes = hashindex['sections']
+        skipkeys = set([ key for (key, val) in sectionhashes.items()
+                         if key != '.' and oldhashes.get(key, None) == val ])
+        print('%d of %d locations unchanged since the last load.' % (len(skipkeys), len(sectionhashes)-1))
+
+world = parse_world(filename, skip=skipkeys)
 
 if errorcount:
     print('%d errors; stopping here.' % (errorcount,))
@@ -598,6 +709,19 @@ else:
 
 world.wid = wid
 
+if hashindex is not None and hashindex.get('wid', None) != str(wid):
+    # The index was for a different world, so we need the whole file.
+    print('Hash index is for a different world; loading everything.')
+    hashindex = None
+    skipkeys = set()
+    creatoruid = world.creatoruid
+    world = parse_world(filename)
+    if errorcount:
+        print('%d errors; stopping here.' % (errorcount,))
+        sys.exit(1)
+    world.creatoruid = creatoruid
+    world.wid = wid
+
 # Check for existing portlists
 world.allportlists = list(db.portlists.find({'type':'world', 'wid':world.wid}))
 world.allportlists.sort(key = lambda x:x['_id'])
@@ -653,11 +777,71 @@ if opts.remove:
             db.worldprop.remove({'wid':wid, 'locid':loc.locid, 'key':key})
             print('removing property in %s: %s' % (lockey, key,))
 
+    # The database no longer matches the file, so the hash index is
+    # out of date.
+    if os.path.exists(hashindexpath):
+        os.remove(hashindexpath)
     sys.exit(0)
 
 # The adding-stuff-to-the-database case.
 if not args:
-    args = ['.', '$player'] + world.locationlist
+    # Loading the whole world. We compare it against the database and
+    # write only the changes, in batches.
+    # In an incremental load, we only compare the sections of the file
+    # which changed since the last load (plus the locations which were
+    # removed from the file, in case of --prune).
+    if hashindex is not None:
+        oldhashes = hashindex['sections']
+        realmchanged = (oldhashes.get('.', None) != sectionhashes['.'])
+        loadkeys = [ key for key in world.locationlist if key not in skipkeys ]
+        removedkeys = [ key for key in oldhashes if key != '.' and key not in sectionhashes ]
+    else:
+        realmchanged = True
+        loadkeys = world.locationlist
+        removedkeys = None
+
+    importworld = twcommon.worldimport.ImportWorld(world.name)
+    if realmchanged:
+        for key in world.proplist:
+            importworld.realmprops[key] = world.props[key]
+        for key in world.playerproplist:
+            importworld.playerprops[key] = world.playerprops[key]
+    for lockey in loadkeys:
+        loc = world.locations[lockey]
+        importloc = importworld.add_location(loc.key, loc.name)
+        for key in loc.proplist:
+            importloc.props[key] = transform_prop(world, db, loc.props[key])
+
+    if removedkeys is None:
+        dblocs = list(db.locations.find({'wid':wid}))
+        dbprops = list(db.worldprop.find({'wid':wid}))
+    else:
+        dblocs = list(db.locations.find({'wid':wid, 'key':{'$in':loadkeys+removedkeys}}))
+        locids = [ loc['_id'] for loc in dblocs ]
+        if realmchanged:
+            locids.append(None)
+        dbprops = list(db.worldprop.find({'wid':wid, 'locid':{'$in':locids}}))
+    if realmchanged:
+        dbplayerprops = list(db.wplayerprop.find({'wid':wid, 'uid':None}))
+    else:
+        dbplayerprops = []
+    plan = twcommon.worldimport.plan_import(importworld, wid, dblocs, dbprops, dbplayerprops, prune=opts.prune)
+    for step in plan.steps():
+        for (collection, method, opargs) in step.ops:
+            getattr(db[collection], method)(*opargs)
+        print(step.label)
+    print(plan.summary())
+    for lockey in plan.extralocs:
+        print('Location is in the database but not the file: %s' % (lockey,))
+
+    # Record what we loaded. (If there's an index from an earlier
+    # incremental load, it has to be brought up to date too.)
+    if opts.incremental or os.path.exists(hashindexpath):
+        if sectionhashes is None:
+            sectionhashes = hash_sections(filename)
+        write_hash_index(hashindexpath, wid, sectionhashes)
+    sys.exit(0)
+
 for val in args:
     if '.' in val:
         lockey, dummy, key = val.partition('.')
@@ -748,3 +932,7 @@ for val in args:
                             {'wid':wid, 'locid':loc.locid, 'key':key, 'val':val},
                             upsert=True)
         
+
+# Loading part of the world leaves the hash index out of date.
+if os.path.exists(hashindexpath):
+    os.remove(hashindexpath)
@@ -48,11 +48,39 @@ tornado.options.define(
 tornado.options.define(
     'tworld_port', type=int, default=4001,
     help='port number for communication between tweb and tworld')
+tornado.options.define(
+    'tworld_host', type=str, default='localhost',
+    help='address to listen on for tweb connections')
+tornado.options.define(
+    'tworld_shards', type=int, default=1,
+    help='number of tworld processes sharing the instances')
+tornado.options.define(
+    'tworld_shard', type=int, default=0,
+    help='which of the tworld processes this is (0 to tworld_shards-1); it listens on tworld_port plus this')
 
 tornado.options.define(
     'mongo_database', type=str, default='tworld',
     help='name of mongodb database')
 
+tornado.options.define(
+    'propcache_limit', type=int, default=0,
+    help='number of property entries to keep cached between commands (0 to discard the cache after each command)')
+tornado.options.define(
+    'propcache_warmup', type=int, default=0,
+    help='bytes of properties to preload into the cache when an instance wakes up (0 to disable)')
+tornado.options.define(
+    'update_concurrency', type=int, default=8,
+    help='number of player updates to generate at once after a command')
+tornado.options.define(
+    'command_concurrency', type=int, default=1,
+    help='number of commands to run at once, if they involve different instances')
+tornado.options.define(
+    'persist_timers', type=bool, default=False,
+    help='store scheduled timer events in the database, so that they survive a restart')
+tornado.options.define(
+    'write_coalesce_limit', type=int, default=65536,
+    help='bytes of outgoing messages to hold until the end of a command (0 to send each message immediately)')
+
 # Parse 'em up.
 tornado.options.parse_command_line()
 opts = tornado.options.options
@@ -223,6 +223,8 @@ db.portlists.create_index('wid', sparse=True)
 # Compound index
 db.scopeaccess.create_index([('uid', pymongo.ASCENDING), ('scid', pymongo.ASCENDING)], unique=True)
 
+db.schedevents.create_index('iid')  # not unique
+
 # Create some config entries if they don't exist, but leave them alone
 # if they do exist.
 